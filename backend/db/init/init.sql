@@ -16,7 +16,8 @@ CREATE TABLE IF NOT EXISTS clothing_items (
     clothing_id INT AUTO_INCREMENT PRIMARY KEY,
     name VARCHAR(100) NOT NULL,
     category VARCHAR(50) NOT NULL,
-    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_clothing_items_name_category (name, category)
 );
 
 -- ユーザーの服装選択履歴（学習データ）
@@ -37,12 +38,100 @@ CREATE TABLE IF NOT EXISTS user_locations (
     user_id INT NOT NULL,
     latitude FLOAT NOT NULL,
     longitude FLOAT NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    -- ユーザーの最新位置をこのインデックスの末尾1行だけで引けるようにする
+    INDEX idx_user_locations_user_created (user_id, created_at),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+
+-- 事前計算した推薦（天気予報をもとに夜間ジョブが作る。/suggest は条件が合えばこれを返す）
+CREATE TABLE IF NOT EXISTS precomputed_suggestions (
+    user_id INT NOT NULL,
+    target_hour DATETIME NOT NULL,          -- 推薦対象の時刻（時単位に切り捨て）
+    cell_lat INT NOT NULL,                  -- 天気キャッシュのマス（位置が変わっていないかの判定用）
+    cell_lon INT NOT NULL,
+    temperature FLOAT NOT NULL,             -- 予報の気温・天気
+    weather VARCHAR(20) NOT NULL,
+    recommendations JSON NOT NULL,
+    suggestion_text TEXT,
+    image_keywords VARCHAR(255),
+    image_url VARCHAR(1024),
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, target_hour),
+    INDEX idx_precomputed_suggestions_target (target_hour),
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
--- 初期データ（服装アイテム）
-INSERT INTO clothing_items (name, category) VALUES
+-- 既存DB向けのマイグレーション（CREATE TABLE IF NOT EXISTS は既存テーブルを変えないので、後から足した列・キーはここで足す）
+-- 何度流してもよい: mysql -u root -p < init.sql
+
+-- clothing_items の (name, category) ユニークキー
+-- 先に重複行を一番小さい clothing_id に寄せてから消す（選択履歴の参照も付け替える）
+UPDATE user_clothing_choices c
+JOIN clothing_items i ON i.clothing_id = c.clothing_id
+JOIN (
+    SELECT name, category, MIN(clothing_id) AS keep_id
+    FROM clothing_items
+    GROUP BY name, category
+    HAVING COUNT(*) > 1
+) d ON d.name = i.name AND d.category = i.category
+SET c.clothing_id = d.keep_id
+WHERE c.clothing_id <> d.keep_id;
+
+DELETE i FROM clothing_items i
+JOIN (
+    SELECT name, category, MIN(clothing_id) AS keep_id
+    FROM clothing_items
+    GROUP BY name, category
+    HAVING COUNT(*) > 1
+) d ON d.name = i.name AND d.category = i.category
+WHERE i.clothing_id <> d.keep_id;
+
+SET @ddl = IF(
+    (SELECT COUNT(*) FROM information_schema.statistics
+     WHERE table_schema = DATABASE() AND table_name = 'clothing_items'
+       AND index_name = 'uq_clothing_items_name_category') = 0,
+    'ALTER TABLE clothing_items ADD UNIQUE KEY uq_clothing_items_name_category (name, category)',
+    'DO 0'
+);
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+-- user_locations の created_at 列と (user_id, created_at) インデックス
+-- 列がなかった DB の既存行は登録時刻がわからないので、最後に更新された時刻で埋める
+SET @add_created_at = (
+    SELECT COUNT(*) FROM information_schema.columns
+    WHERE table_schema = DATABASE() AND table_name = 'user_locations' AND column_name = 'created_at'
+) = 0;
+SET @ddl = IF(@add_created_at,
+    'ALTER TABLE user_locations ADD COLUMN created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP AFTER longitude',
+    'DO 0');
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+SET @ddl = IF(@add_created_at,
+    'UPDATE user_locations SET created_at = updated_at WHERE updated_at IS NOT NULL',
+    'DO 0');
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+SET @ddl = IF(
+    (SELECT COUNT(*) FROM information_schema.statistics
+     WHERE table_schema = DATABASE() AND table_name = 'user_locations'
+       AND index_name = 'idx_user_locations_user_created') = 0,
+    'ALTER TABLE user_locations ADD INDEX idx_user_locations_user_created (user_id, created_at)',
+    'DO 0'
+);
+PREPARE migration FROM @ddl;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+-- 初期データ（服装アイテム）（既にあれば入れない）
+INSERT IGNORE INTO clothing_items (name, category) VALUES
   ('Tシャツ', 'tops'),
   ('長袖シャツ', 'tops'),
   ('ジーンズ', 'bottoms'),
@@ -54,6 +143,6 @@ INSERT INTO clothing_items (name, category) VALUES
   ('マフラー', 'accessory'),
   ('帽子', 'accessory');
 
--- 初期ユーザー（テスト用）
-INSERT INTO users (name, email, password) VALUES
+-- 初期ユーザー（テスト用）（既にあれば入れない）
+INSERT IGNORE INTO users (name, email, password) VALUES
   ('テストユーザー', 'daichi@example.com', 'password');
\ No newline at end of file
@@ -1,10 +1,13 @@
 package handlers
 
 import (
+	"bytes"
 	"encoding/json"
 	"net/http"
+	"os"
 	"strconv"
 	"log"
+	"time"
 
 	"github.com/gorilla/mux"
 	"backend/utils"
@@ -45,7 +48,34 @@ func PostUserLocation(w http.ResponseWriter, r *http.Request) {
 		return
 	}
 
+	// ML API の最新位置キャッシュを更新（失敗しても登録自体は成功扱い）
+	go notifyLocationSaved(userID, loc)
+
 	w.Header().Set("Content-Type", "application/json")
 	w.WriteHeader(http.StatusCreated)
 	json.NewEncoder(w).Encode(map[string]string{"message": "位置情報を保存しました"})
 }
+
+var mlAPIClient = &http.Client{Timeout: 2 * time.Second}
+
+// ML_API_URL（例: http://mlapi:8000）が設定されていれば、登録した位置を ML API に通知する
+func notifyLocationSaved(userID int, loc utils.Location) {
+	baseURL := os.Getenv("ML_API_URL")
+	if baseURL == "" {
+		return
+	}
+	body, err := json.Marshal(map[string]interface{}{
+		"user_id":   userID,
+		"latitude":  loc.Latitude,
+		"longitude": loc.Longitude,
+	})
+	if err != nil {
+		return
+	}
+	resp, err := mlAPIClient.Post(baseURL+"/api/v1/locations/notify", "application/json", bytes.NewReader(body))
+	if err != nil {
+		log.Println("位置情報の通知失敗:", err)
+		return
+	}
+	resp.Body.Close()
+}
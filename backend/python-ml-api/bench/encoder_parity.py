@@ -0,0 +1,92 @@
+"""
+FeatureEncoder（表引きによる OneHot 変換）と学習済み Pipeline の一致確認
+
+    cd backend/python-ml-api
+    python -m bench.encoder_parity --rows 2000
+
+各カテゴリのモデルについて、語彙からランダムに作った行（未知値も混ぜる）を
+Pipeline の ColumnTransformer と FeatureEncoder の両方に通し、
+OneHot 行列と予測ラベルが完全に一致するかを確認する。1件でも違えば終了コード 1。
+"""
+import argparse
+import random
+import sys
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ml_logic.features import FEATURE_ORDER, build_feature_row
+from ml_logic.inference import CompiledCategoryModel
+from ml_logic.model_registry import CATEGORIES, MODEL_DIR, model_path, unpack_bundle
+
+UNKNOWN = "__unknown__"
+
+
+def sample_rows(model, n, unknown_rate, seed):
+    rng = random.Random(seed)
+    vocab = {column: list(values) for column, values in model.vocab.items()}
+    rows = []
+    for _ in range(n):
+        rows.append({
+            column: UNKNOWN if rng.random() < unknown_rate else rng.choice(vocab[column])
+            for column in FEATURE_ORDER
+        })
+    return rows
+
+
+def same_matrix(a, b) -> bool:
+    if sparse.issparse(a) != sparse.issparse(b):
+        return False
+    if sparse.issparse(a):
+        return a.shape == b.shape and abs(a - b).sum() == 0
+    return np.array_equal(np.asarray(a), np.asarray(b))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FeatureEncoder と Pipeline の一致確認")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--unknown-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # temp_bin は共通定義を通した値もサンプルに入れる（学習と推論の定義ずれの検出用）
+    extra = [build_feature_row({
+        "weather": "clear", "user_id": 1, "month": 7, "day": 13, "hour": 15, "weekday": 6,
+        "temperature": t,
+    }) for t in np.arange(-10, 40, 0.5)]
+
+    ok = True
+    for category in CATEGORIES:
+        path = model_path(category, args.model_dir)
+        try:
+            pipeline, label_encoder = unpack_bundle(joblib.load(path))
+        except (OSError, TypeError) as e:
+            print(f"⚠ スキップ [{category}]: {e}")
+            continue
+
+        model = CompiledCategoryModel.from_pipeline(pipeline, label_encoder)
+        rows = sample_rows(model, args.rows, args.unknown_rate, args.seed) + extra
+        df = pd.DataFrame(rows, columns=FEATURE_ORDER)
+
+        expected_X = pipeline.named_steps["preprocessor"].transform(df)
+        actual_X = model.encoder.transform(rows, sparse_output=model.sparse_output)
+        expected = label_encoder.inverse_transform(pipeline.predict(df))
+        actual = np.array([model.predict_row(row) for row in rows])
+
+        matrix_ok = same_matrix(expected_X, actual_X)
+        mismatches = int((expected != actual).sum())
+        # 学習時に見た温度帯の範囲（共通定義の値が語彙に含まれているかの目安）
+        known_bins = sum(row["temp_bin"] in model.vocab["temp_bin"] for row in extra)
+        mark = "✅" if matrix_ok and mismatches == 0 else "❌"
+        print(f"{mark} [{category}] 行列一致: {matrix_ok}, 予測不一致: {mismatches}/{len(rows)}, "
+              f"temp_bin 既知率: {known_bins}/{len(extra)}")
+        ok &= matrix_ok and mismatches == 0
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
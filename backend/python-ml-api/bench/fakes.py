@@ -0,0 +1,183 @@
+"""
+ベンチマーク用の外部サービスのスタンドイン
+
+- OpenWeather / Pixabay: ローカルの HTTP サーバー（本番と同じ HTTP クライアント経路を通す）
+- MySQL（位置情報・事前計算の保存先）/ Gemini: プロセス内の差し替え関数・オブジェクト
+
+いずれも応答前に指定した遅延（秒）を入れる。
+"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeUpstreamServer:
+    """OpenWeather と Pixabay の API を真似るローカル HTTP サーバー"""
+
+    def __init__(self, weather_latency: float = 0.0, image_latency: float = 0.0):
+        self.weather_latency = weather_latency
+        self.image_latency = image_latency
+        self.calls = {"weather": 0, "forecast": 0, "image": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    @staticmethod
+    def current(lat: float) -> dict:
+        """緯度から決まる天気（OpenWeather の応答形式）"""
+        return {
+            "main": {"temp": round(10 + (lat * 7) % 20, 1)},
+            "weather": [{"main": "Clear" if int(lat * 10) % 3 else "Rain"}],
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/data/2.5/weather":
+                    fake._count("weather")
+                    time.sleep(fake.weather_latency)
+                    lat = float(query.get("lat", ["35"])[0])
+                    self._send_json(fake.current(lat))
+                elif url.path == "/data/2.5/forecast":
+                    # 3時間刻み・5日分（予報は現在の天気がそのまま続く想定にして、事前計算が当たるようにする）
+                    fake._count("forecast")
+                    time.sleep(fake.weather_latency)
+                    lat = float(query.get("lat", ["35"])[0])
+                    start = int(time.time()) // 10800 * 10800
+                    self._send_json({"list": [
+                        dict(fake.current(lat), dt=start + i * 10800) for i in range(40)
+                    ]})
+                elif url.path == "/api/":
+                    fake._count("image")
+                    time.sleep(fake.image_latency)
+                    q = query.get("q", [""])[0].replace(" ", "-")
+                    self._send_json({"hits": [{"webformatURL": f"{fake.base_url}/images/{q}.jpg"}]})
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass  # ベンチ中のアクセスログは出さない
+
+        return Handler
+
+    def start(self) -> "FakeUpstreamServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeLocationStore:
+    """crud.aget_latest_location の代わり（MySQL の往復遅延だけを再現する）"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    @staticmethod
+    def location(user_id):
+        # ユーザーごとに少しずつ違う地点（天気キャッシュのマスが分かれるように）
+        return {
+            "user_id": user_id,
+            "latitude": 35.0 + (user_id % 97) * 0.1,
+            "longitude": 135.0 + (user_id % 89) * 0.1,
+        }
+
+    async def aget_latest_location(self, user_id):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.location(user_id)
+
+    async def aget_latest_locations(self, user_ids):
+        """crud.aget_latest_locations の代わり（1回の往復で全員分）"""
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {user_id: self.location(user_id) for user_id in user_ids}
+
+
+class FakePrecomputedStore:
+    """precomputed_suggestions テーブルの代わり（保存・取得ともにメモリ上）"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def save(self, rows):
+        for row in rows:
+            self.rows[(row["user_id"], row["target_hour"])] = dict(row)
+        return len(rows)
+
+    def purge(self, before):
+        stale = [key for key in self.rows if key[1] < before]
+        for key in stale:
+            del self.rows[key]
+        return len(stale)
+
+    async def aget(self, user_id, target_hour):
+        row = self.rows.get((user_id, target_hour))
+        return dict(row) if row is not None else None
+
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """textgen の GenerativeModel の代わり（構造化出力の JSON を返す）"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    # ストリーミング時の分割数（最初の断片までは遅延の 1/STREAM_CHUNKS、残りは均等に届く）
+    STREAM_CHUNKS = 8
+
+    def _response(self) -> _FakeResponse:
+        self.calls += 1
+        return _FakeResponse(json.dumps({
+            "advice_text": "今日は過ごしやすい天気です。軽めの服装がおすすめです。",
+            "image_keywords": ["casual", "jacket", "sneakers"],
+        }, ensure_ascii=False))
+
+    async def _stream(self, text: str):
+        size = -(-len(text) // self.STREAM_CHUNKS)
+        for i in range(0, len(text), size):
+            await asyncio.sleep(self.latency / self.STREAM_CHUNKS)
+            yield _FakeResponse(text[i:i + size])
+
+    def generate_content(self, prompt, **kwargs):
+        time.sleep(self.latency)
+        return self._response()
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        if stream:
+            return self._stream(self._response().text)
+        await asyncio.sleep(self.latency)
+        return self._response()
@@ -0,0 +1,109 @@
+"""
+main.py の import 時間を測り、予算を超えたら失敗する
+
+    cd backend/python-ml-api
+    python -m bench.import_budget --budget-ms 1500 --top 15
+
+`python -X importtime` の結果から import にかかった時間の合計と遅いモジュールを表示し、
+起動時に読み込まれてはいけない重いライブラリ（ウォームアップまで遅らせる前提のもの）が
+入っていないかも確認する。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# import main の時点では読み込まれていてほしくないモジュール
+DEFERRED_MODULES = ["numpy", "scipy", "pandas", "sklearn", "xgboost", "joblib", "google.generativeai", "aiomysql"]
+
+_PROBE = (
+    "import json, sys, time\n"
+    "start = time.perf_counter()\n"
+    "import {target}\n"
+    "seconds = time.perf_counter() - start\n"
+    "loaded = sorted(m for m in {modules!r} if m in sys.modules)\n"
+    "print(json.dumps({{'seconds': seconds, 'loaded': loaded}}))\n"
+)
+
+
+def run_importtime(target: str):
+    """
+    新しいプロセスで target を import し、
+    (import の秒数, プロセス全体の秒数, importtime の行, 読み込まれた遅延対象) を返す
+    """
+    code = _PROBE.format(target=target, modules=DEFERRED_MODULES)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=os.getcwd(),
+    )
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        raise SystemExit(f"❌ import {target} に失敗しました")
+    lines = [line for line in proc.stderr.splitlines() if line.startswith("import time:")]
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return result["seconds"], elapsed, lines, result["loaded"]
+
+
+def parse_importtime(lines):
+    """
+    "import time: self [us] | cumulative | imported package" の行を
+    (モジュール名, self 秒, cumulative 秒, ネストの深さ) の一覧にする
+    """
+    entries = []
+    for line in lines[1:]:  # 先頭はヘッダー
+        _, _, rest = line.partition("import time:")
+        self_us, cumulative_us, name = rest.split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import 時間の予算チェック")
+    parser.add_argument("--target", default="main", help="import するモジュール")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "1500")))
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    total, elapsed, lines, loaded = run_importtime(args.target)
+    entries = parse_importtime(lines)
+
+    print(f"⏱ import {args.target}: {total * 1000:.1f} ms（プロセス起動込み {elapsed * 1000:.1f} ms, 予算 {args.budget_ms:.0f} ms）")
+    print(f"\n遅いモジュール（cumulative 上位 {args.top}）:")
+    for name, self_s, cumulative, depth in sorted(entries, key=lambda e: -e[2])[:args.top]:
+        print(f"  {cumulative * 1000:8.1f} ms  (self {self_s * 1000:6.1f} ms)  {name}")
+
+    ok = True
+    if total * 1000 > args.budget_ms:
+        print(f"\n❌ import 時間が予算を超えています: {total * 1000:.1f} ms > {args.budget_ms:.0f} ms")
+        ok = False
+    if loaded:
+        print(f"\n❌ 起動時に読み込まれてはいけないモジュールが import されています: {loaded}")
+        ok = False
+    if ok:
+        print("\n✅ import 時間は予算内です")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "target": args.target,
+                "import_ms": round(total * 1000, 1),
+                "process_ms": round(elapsed * 1000, 1),
+                "budget_ms": args.budget_ms,
+                "deferred_modules_loaded": loaded,
+                "slowest": [
+                    {"module": name, "cumulative_ms": round(c * 1000, 1), "self_ms": round(s * 1000, 1)}
+                    for name, s, c, _ in sorted(entries, key=lambda e: -e[2])[:args.top]
+                ],
+            }, f, ensure_ascii=False, indent=2)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+推薦の事前計算ジョブをローカルのスタンドインで動かす
+
+    cd backend/python-ml-api
+    python -m bench.prescore_bench --users 2000 --weather-latency-ms 80 --llm-latency-ms 800
+
+位置情報・予報・Gemini・Pixabay・保存先をすべてスタンドインにして run_prescore を1回実行し、
+予報の取得回数（天気マス数）・アドバイス生成回数・所要時間と、
+保存した推薦が /suggest 時点の天気（フェイクの現在の天気）と一致する割合を表示する。
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from bench.fakes import FakeGeminiModel, FakeLocationStore, FakePrecomputedStore, FakeUpstreamServer
+
+
+async def run(args):
+    upstream = FakeUpstreamServer(
+        weather_latency=args.weather_latency_ms / 1000,
+        image_latency=args.image_latency_ms / 1000,
+    ).start()
+    os.environ["OPENWEATHER_BASE_URL"] = upstream.base_url
+    os.environ["PIXABAY_API_URL"] = f"{upstream.base_url}/api/"
+    os.environ.setdefault("OPENWEATHER_API_KEY", "bench")
+    os.environ.setdefault("PIXABAY_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+    from ml_logic import textgen
+    from ml_logic.clients import aclose_clients
+    from ml_logic.data import afetch_weather
+    from ml_logic.model_registry import registry
+    from ml_logic.prescore import matches_conditions, run_prescore
+
+    textgen.model = FakeGeminiModel(latency=args.llm_latency_ms / 1000)
+    locations = FakeLocationStore(latency=args.db_latency_ms / 1000)
+    store = FakePrecomputedStore()
+    registry.load_all()
+
+    # 選択履歴: 一部のユーザーは履歴なし（既定の時刻になる）
+    rng = random.Random(args.seed)
+    active = {
+        user_id: {} if rng.random() < 0.2 else {rng.choice([7, 8, 12, 18]): rng.randint(1, 30)}
+        for user_id in range(1, args.users + 1)
+    }
+
+    start = time.perf_counter()
+    summary = await run_prescore(
+        load_active=lambda since: active,
+        load_locations=locations.aget_latest_locations,
+        store=store.save,
+        purge=store.purge,
+    )
+    elapsed = time.perf_counter() - start
+
+    hits = 0
+    for (user_id, _), row in store.rows.items():
+        location = locations.location(user_id)
+        weather_data = await afetch_weather(location["latitude"], location["longitude"])
+        hits += matches_conditions(row, location, weather_data)
+
+    await aclose_clients()
+    upstream.stop()
+
+    print(f"⏱ 事前計算: {elapsed:.2f}s")
+    print(f"  ユーザー {summary['users']}, 天気マス {summary['cells']} (予報取得 {upstream.calls['forecast']} 回)")
+    print(f"  保存 {summary['rows']} 件, アドバイス生成 {textgen.model.calls} 回, 画像検索 {upstream.calls['image']} 回")
+    print(f"  実際の天気と一致: {hits}/{len(store.rows)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事前計算ジョブのスタンドイン実行")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--db-latency-ms", type=float, default=2)
+    parser.add_argument("--weather-latency-ms", type=float, default=80)
+    parser.add_argument("--llm-latency-ms", type=float, default=800)
+    parser.add_argument("--image-latency-ms", type=float, default=150)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+/api/v1/suggest のエンドツーエンド遅延ベンチマーク（外部サービスはすべてローカルのスタンドイン）
+
+    cd backend/python-ml-api
+    python -m bench.suggest_bench --concurrency 1 8 32 --requests 200 \\
+        --db-latency-ms 2 --weather-latency-ms 80 --llm-latency-ms 800 --image-latency-ms 150 \\
+        --output bench_results.json --compare bench_results.prev.json
+
+並列度ごとに全体と各ステージ（db / weather / inference / llm / image）の
+p50 / p95 / p99 とスループットを測り、JSON に書き出す。
+--stream を付けると /api/v1/suggest/stream を叩き、最初の行（推薦）が届くまでの時間も測る。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from bench.fakes import FakeGeminiModel, FakeLocationStore, FakePrecomputedStore, FakeUpstreamServer
+
+STAGES = ["db", "weather", "inference", "llm", "image"]
+
+
+def percentile(values, p):
+    """最近接順位法のパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values_ms):
+    if not values_ms:
+        return {"count": 0}
+    return {
+        "count": len(values_ms),
+        "mean": round(sum(values_ms) / len(values_ms), 3),
+        "p50": round(percentile(values_ms, 50), 3),
+        "p95": round(percentile(values_ms, 95), 3),
+        "p99": round(percentile(values_ms, 99), 3),
+        "max": round(max(values_ms), 3),
+    }
+
+
+def configure_environment(args, upstream):
+    """アプリの import 前に、外部 API の向き先とキャッシュ設定を環境変数で与える"""
+    os.environ["OPENWEATHER_BASE_URL"] = upstream.base_url
+    os.environ["PIXABAY_API_URL"] = f"{upstream.base_url}/api/"
+    os.environ.setdefault("OPENWEATHER_API_KEY", "bench")
+    os.environ.setdefault("PIXABAY_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ["PIXABAY_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "pixabay.sqlite3")
+    if not args.warm_caches:
+        # 毎回上流まで行く経路を測る
+        os.environ["WEATHER_CACHE_TTL"] = "0"
+        os.environ["ADVICE_CACHE_TTL"] = "0"
+        os.environ["PIXABAY_CACHE_TTL"] = "0"
+        os.environ["PIXABAY_CACHE_MAX_STALE"] = "0"
+
+
+class StageRecorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def reset(self):
+        self.samples = defaultdict(list)
+
+    def wrap_async(self, stage, fn):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.samples[stage].append((time.perf_counter() - start) * 1000)
+        return wrapper
+
+    def wrap_sync(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.samples[stage].append((time.perf_counter() - start) * 1000)
+        return wrapper
+
+    def wrap_async_gen(self, stage, fn):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+            finally:
+                self.samples[stage].append((time.perf_counter() - start) * 1000)
+        return wrapper
+
+
+def install_fakes(main, textgen, recorder, args):
+    """main が参照している各ステージの関数をスタンドイン + 計測付きに差し替える"""
+    store = FakeLocationStore(latency=args.db_latency_ms / 1000)
+    gemini = FakeGeminiModel(latency=args.llm_latency_ms / 1000)
+    textgen.model = gemini
+
+    main.aget_latest_location = recorder.wrap_async("db", store.aget_latest_location)
+    # 事前計算は空（毎回通常の推薦経路を測る）
+    main.aget_precomputed_suggestion = FakePrecomputedStore().aget
+    main.afetch_weather = recorder.wrap_async("weather", main.afetch_weather)
+    main.agenerate_advice_and_keywords = recorder.wrap_async("llm", main.agenerate_advice_and_keywords)
+    main.astream_advice_and_keywords = recorder.wrap_async_gen("llm", main.astream_advice_and_keywords)
+    main.asearch_pixabay_image = recorder.wrap_async("image", main.asearch_pixabay_image)
+
+    original_get_engine = main._get_engine
+
+    class TimedEngine:
+        def __init__(self, engine):
+            self._engine = engine
+            self.predict = recorder.wrap_sync("inference", engine.predict)
+
+        def __getattr__(self, name):
+            return getattr(self._engine, name)
+
+    main._get_engine = lambda: TimedEngine(original_get_engine())
+    return store, gemini
+
+
+async def run_level(client, concurrency, total_requests, user_offset, stream=False):
+    latencies = []
+    first_content = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(total_requests):
+        queue.put_nowait(user_offset + i)
+
+    async def request(user_id, start):
+        if not stream:
+            response = await client.post("/api/v1/suggest", json={"user_id": user_id})
+            return response.status_code == 200
+        events = set()
+        async with client.stream("POST", "/api/v1/suggest/stream", json={"user_id": user_id}) as response:
+            if response.status_code != 200:
+                return False
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)["event"]
+                if event == "recommendations":
+                    first_content.append((time.perf_counter() - start) * 1000)
+                events.add(event)
+        return "done" in events and "error" not in events
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                if not await request(user_id, start):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return latencies, first_content, errors, elapsed
+
+
+async def run(args):
+    import httpx
+
+    upstream = FakeUpstreamServer(
+        weather_latency=args.weather_latency_ms / 1000,
+        image_latency=args.image_latency_ms / 1000,
+    ).start()
+    configure_environment(args, upstream)
+
+    import main
+    from ml_logic import textgen
+    from ml_logic.clients import aclose_clients
+    from ml_logic.model_registry import registry
+
+    recorder = StageRecorder()
+    install_fakes(main, textgen, recorder, args)
+    registry.load_all()
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        # ウォームアップ（推論エンジンの組み立てや接続確立を計測から外す）
+        await run_level(client, 1, args.warmup, user_offset=10_000_000, stream=args.stream)
+
+        user_offset = 0
+        for concurrency in args.concurrency:
+            recorder.reset()
+            latencies, first_content, errors, elapsed = await run_level(
+                client, concurrency, args.requests, user_offset, stream=args.stream)
+            user_offset += args.requests
+            level = {
+                "concurrency": concurrency,
+                "requests": len(latencies),
+                "errors": errors,
+                "elapsed_s": round(elapsed, 3),
+                "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+                "latency_ms": summarize(latencies),
+                "first_content_ms": summarize(first_content),
+                "stages": {stage: summarize(recorder.samples.get(stage, [])) for stage in STAGES},
+            }
+            results.append(level)
+            print_level(level)
+
+    await aclose_clients()
+    upstream.stop()
+
+    return {
+        "benchmark": "suggest",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {
+            "requests_per_level": args.requests,
+            "warm_caches": args.warm_caches,
+            "stream": args.stream,
+            "injected_latency_ms": {
+                "db": args.db_latency_ms,
+                "weather": args.weather_latency_ms,
+                "llm": args.llm_latency_ms,
+                "image": args.image_latency_ms,
+            },
+        },
+        "levels": results,
+    }
+
+
+def print_level(level):
+    lat = level["latency_ms"]
+    print(f"\n=== concurrency {level['concurrency']}: {level['throughput_rps']} req/s, "
+          f"errors {level['errors']} ===")
+    print(f"  total     p50 {lat.get('p50')} ms  p95 {lat.get('p95')} ms  p99 {lat.get('p99')} ms")
+    first = level.get("first_content_ms", {})
+    if first.get("count"):
+        print(f"  first     p50 {first['p50']} ms  p95 {first['p95']} ms  p99 {first['p99']} ms")
+    for stage, stats in level["stages"].items():
+        if stats["count"]:
+            print(f"  {stage:<9} p50 {stats['p50']} ms  p95 {stats['p95']} ms  p99 {stats['p99']} ms")
+
+
+def compare(current, previous_path, threshold):
+    """前回結果と並列度ごとの p95 / スループットを比べ、悪化があれば True を返す"""
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    prev_levels = {level["concurrency"]: level for level in previous.get("levels", [])}
+
+    regressed = False
+    print(f"\n--- 前回結果との比較 ({previous_path}, 閾値 {threshold:.0%}) ---")
+    for level in current["levels"]:
+        prev = prev_levels.get(level["concurrency"])
+        if not prev:
+            continue
+        for label, now, before, worse_if_higher in [
+            ("p95", level["latency_ms"].get("p95"), prev["latency_ms"].get("p95"), True),
+            ("rps", level["throughput_rps"], prev["throughput_rps"], False),
+        ]:
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            worse = change > threshold if worse_if_higher else change < -threshold
+            regressed |= worse
+            mark = "❌" if worse else "✅"
+            print(f"{mark} concurrency {level['concurrency']} {label}: {before} → {now} ({change:+.1%})")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/api/v1/suggest のローカルベンチマーク")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="並列度ごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--db-latency-ms", type=float, default=2)
+    parser.add_argument("--weather-latency-ms", type=float, default=80)
+    parser.add_argument("--llm-latency-ms", type=float, default=800)
+    parser.add_argument("--image-latency-ms", type=float, default=150)
+    parser.add_argument("--warm-caches", action="store_true",
+                        help="天気・アドバイス・画像キャッシュを有効にしたまま測る（既定は無効）")
+    parser.add_argument("--stream", action="store_true",
+                        help="/api/v1/suggest/stream を測る（最初の行が届くまでの時間も記録）")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="比較する前回の結果 JSON")
+    parser.add_argument("--regression-threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n📁 結果を書き出しました: {args.output}")
+
+    if args.compare and compare(result, args.compare, args.regression_threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,69 @@
-import joblib
+import argparse
+import json
 import os
-from sklearn.pipeline import Pipeline
-
-CATEGORIES = ["bottoms", "shoes", "outer", "tops", "accessory"]
-
-for category in CATEGORIES:
-    path = f"models/{category}_model.pkl"
-    print(f"\n🔍 カテゴリ: {category}")
-    print(f"📍 モデルパス: {path}")
-
-    if not os.path.exists(path):
-        print(f"❌ モデルファイルなし: {path}")
-        continue
-
-    try:
-        bundle = joblib.load(path)
-    except Exception as e:
-        print(f"❌ 読み込みエラー: {e}")
-        continue
-
-    if isinstance(bundle, tuple) and len(bundle) == 2:
-        model, label_encoder = bundle
-        print(f"📦 モデル型: {type(model)}")
-        if isinstance(model, Pipeline):
-            classifier = model.named_steps.get("classifier", None)
-            print(f"🧠 使用分類器: {type(classifier)}")
+import sys
+from ml_logic.model_check import (
+    check_category, format_measurement, holdout_examples, measure_model, print_check, split_holdout,
+)
+from ml_logic.model_registry import CATEGORIES, MODEL_DIR
+
+
+def load_holdout(dataset_dir):
+    """学習データセットの held-out（カテゴリごとの新しい側）を {カテゴリ: (行, ラベル)} で返す"""
+    if not os.path.isdir(dataset_dir):
+        print(f"⚠ 学習データセットがないため精度は測りません: {dataset_dir}")
+        return {}
+    # 学習と同じ特徴量の作り方を使う（学習用の依存は精度を測るときだけ読み込む）
+    from ml_logic.dataset import TrainingDataset
+    from ml_logic.train_models_by_category import CATEGORY_NAME_MAP, prepare_data
+
+    frame = TrainingDataset(dataset_dir).to_pandas()
+    if frame.empty:
+        return {}
+    _, holdout = split_holdout(frame)
+    return {
+        CATEGORY_NAME_MAP.get(category, category): holdout_examples(data)
+        for category, data in prepare_data(holdout).items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モデルの性能測定（--candidate 指定時はデプロイ済みと比べる回帰ゲート）")
+    parser.add_argument("--deployed", default=MODEL_DIR, help="デプロイ済みモデルのディレクトリ")
+    parser.add_argument("--candidate", help="候補モデルのディレクトリ（悪化していれば終了コード 1）")
+    parser.add_argument("--dataset", default=os.getenv("TRAINING_DATASET_DIR", os.path.join(MODEL_DIR, "training_dataset")),
+                        help="精度を測る学習データセット")
+    parser.add_argument("--categories", nargs="*", default=CATEGORIES)
+    parser.add_argument("--json", help="測定結果の保存先")
+    args = parser.parse_args()
+
+    holdout = load_holdout(args.dataset)
+    results = []
+    for category in args.categories:
+        rows, labels = holdout.get(category, ([], []))
+        if args.candidate:
+            result = check_category(category, args.candidate, args.deployed, rows, labels)
+            print_check(result)
         else:
-            print("❓ モデルは Pipeline ではありません")
-    else:
-        print("❌ 想定外のモデル形式")
-        print(f"📦 内容: {bundle}")
+            print(f"\n🔍 カテゴリ: {category}")
+            try:
+                measurement = measure_model(args.deployed, category, rows, labels)
+            except Exception as e:
+                print(f"❌ 読み込みエラー: {e}")
+                measurement = None
+            print(f"📦 {format_measurement(measurement)}")
+            result = {"category": category, "deployed": measurement, "passed": measurement is not None}
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = [r["category"] for r in results if not r["passed"]]
+    if args.candidate and failed:
+        print(f"❌ 悪化したカテゴリ: {failed}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
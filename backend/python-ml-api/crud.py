@@ -1,25 +1,453 @@
-from db import get_connection
+import json
+import os
+import threading
+import time
+import mysql.connector
+from db import PoolTimeout, async_connection, connection
+from ml_logic.cache import AsyncSingleFlight, TTLCache
+
+# clothing_items を全件読み直す間隔（秒）
+CLOTHING_CACHE_TTL = float(os.getenv("CLOTHING_CACHE_TTL", "300"))
+
+# 最新位置キャッシュ: ユーザーごとの現在地を TTL 秒だけ使い回す
+# （位置登録時は /api/v1/locations/notify で更新されるが、通知はワーカー1つにしか届かないので
+#   他のワーカーで古い位置を返しうる時間の上限が TTL になる）
+LOCATION_CACHE_TTL = float(os.getenv("LOCATION_CACHE_TTL", "60"))
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", "100000"))
+
+location_cache = TTLCache(maxsize=LOCATION_CACHE_SIZE, ttl=LOCATION_CACHE_TTL)
+_async_location_flight = AsyncSingleFlight()
+
+# (user_id, created_at) のインデックスを逆順に1行読むだけで済む（created_at が同じなら後の行）
+_LATEST_LOCATION_SQL = """
+    SELECT user_id, latitude, longitude FROM user_locations
+    WHERE user_id = %s
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+"""
+
+def _dict_cursor(conn):
+    # aiomysql は非同期 API を初めて使うときに読み込む（db.get_async_pool と同じ）
+    from aiomysql import DictCursor
+    return conn.cursor(DictCursor)
+
+def remember_location(user_id, latitude, longitude):
+    """位置登録の通知を受けてキャッシュを最新にする"""
+    location_cache.set(user_id, {"user_id": user_id, "latitude": latitude, "longitude": longitude})
+
+def invalidate_location(user_id):
+    location_cache.delete(user_id)
 
 def get_latest_location(user_id):
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM user_locations WHERE user_id = %s ORDER BY created_at DESC LIMIT 1", (user_id,))
-    location = cursor.fetchone()
-    conn.close()
-    return location
+    cached = location_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(_LATEST_LOCATION_SQL, (user_id,))
+        location = cursor.fetchone()
+        cursor.close()
+    if location is not None:  # 未登録のユーザーはキャッシュしない（登録直後に拾えるように）
+        location_cache.set(user_id, location)
+        return dict(location)
+    return None
+
+async def aget_latest_location(user_id):
+    """get_latest_location の非同期版（接続プールを使う。キャッシュは共有）"""
+    cached = location_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
+    async def load():
+        async with async_connection() as conn:
+            async with _dict_cursor(conn) as cursor:
+                await cursor.execute(_LATEST_LOCATION_SQL, (user_id,))
+                location = await cursor.fetchone()
+        if location is not None:
+            location_cache.set(user_id, location)
+        return location
+
+    location = await _async_location_flight.do(user_id, load)
+    return dict(location) if location is not None else None
 
 def get_clothing_choices(user_id):
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM user_clothing_choices WHERE user_id = %s", (user_id,))
-    data = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM user_clothing_choices WHERE user_id = %s", (user_id,))
+        data = cursor.fetchall()
+        cursor.close()
     return data
 
 def get_clothing_items():
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM clothing_items")
-    data = cursor.fetchall()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM clothing_items")
+        data = cursor.fetchall()
+        cursor.close()
     return data
+
+# ユーザーごとの最新 created_at は (user_id, created_at) のインデックスだけで求まる
+_LATEST_LOCATIONS_SQL = """
+    SELECT l.user_id, l.latitude, l.longitude
+    FROM user_locations l
+    JOIN (
+        SELECT user_id, MAX(created_at) AS created_at
+        FROM user_locations
+        WHERE user_id IN ({placeholders})
+        GROUP BY user_id
+    ) latest ON l.user_id = latest.user_id AND l.created_at = latest.created_at
+    ORDER BY l.id
+"""
+
+def _split_cached(user_ids):
+    """キャッシュにあるユーザーの位置と、DB から読む必要のあるユーザー一覧に分ける"""
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        cached = location_cache.get(user_id)
+        if cached is not None:
+            found[user_id] = dict(cached)
+        else:
+            missing.append(user_id)
+    return found, missing
+
+def _remember_rows(found, rows):
+    # created_at が同じ行が複数あれば id の大きい方（後から登録された方）が残る
+    for row in rows:
+        found[row["user_id"]] = row
+    for user_id in {row["user_id"] for row in rows}:
+        location_cache.set(user_id, dict(found[user_id]))
+    return found
+
+def get_latest_locations(user_ids):
+    """
+    複数ユーザーの最新位置情報をまとめて取得する（キャッシュにないユーザーだけ1クエリで読む）
+
+    Returns:
+        {user_id: 位置情報} の辞書（位置情報がないユーザーは含まない）
+    """
+    found, missing = _split_cached(user_ids)
+    if not missing:
+        return found
+    placeholders = ", ".join(["%s"] * len(missing))
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(_LATEST_LOCATIONS_SQL.format(placeholders=placeholders), tuple(missing))
+        data = cursor.fetchall()
+        cursor.close()
+    return _remember_rows(found, data)
+
+async def aget_latest_locations(user_ids):
+    """get_latest_locations の非同期版"""
+    found, missing = _split_cached(user_ids)
+    if not missing:
+        return found
+    placeholders = ", ".join(["%s"] * len(missing))
+    async with async_connection() as conn:
+        async with _dict_cursor(conn) as cursor:
+            await cursor.execute(_LATEST_LOCATIONS_SQL.format(placeholders=placeholders), tuple(missing))
+            data = await cursor.fetchall()
+    return _remember_rows(found, data)
+
+class ClothingItemCache:
+    """
+    (アイテム名, カテゴリ) → clothing_id のプロセス内キャッシュ
+
+    clothing_id は一度採番されたら変わらないので、全件を読み込んでおき、
+    ない組み合わせだけまとめて登録する。他プロセスでの追加を拾うため
+    ttl 秒ごとに全件を読み直す。
+
+    DB とのやりとり（読み直し・登録）はロックの外で行い、結果を反映するときだけロックを取る
+    （往復の間も他のリクエストはキャッシュを引ける）
+    """
+
+    def __init__(self, ttl=CLOTHING_CACHE_TTL):
+        self.ttl = ttl
+        self._ids = {}
+        self._loaded_at = None
+        self._reloading = False
+        self._lock = threading.Lock()
+
+    def _load(self, cursor):
+        cursor.execute("SELECT clothing_id, name, category FROM clothing_items")
+        return {(name, category): clothing_id for clothing_id, name, category in cursor.fetchall()}
+
+    def _reload(self, cursor):
+        started = time.monotonic()
+        try:
+            ids = self._load(cursor)
+        finally:
+            with self._lock:
+                self._reloading = False
+        with self._lock:
+            # 後から始まった読み直しが先に終わっていれば、そちらを残す
+            if self._loaded_at is None or self._loaded_at < started:
+                self._ids = ids
+                self._loaded_at = started
+
+    def _insert(self, conn, cursor, missing):
+        values = ", ".join(["(%s, %s)"] * len(missing))
+        params = [v for pair in missing for v in pair]
+        # (name, category) のユニークキーで重複登録を防ぐ
+        cursor.execute(f"""
+            INSERT INTO clothing_items (name, category) VALUES {values}
+            ON DUPLICATE KEY UPDATE clothing_id = clothing_id
+        """, params)
+        cursor.execute(f"""
+            SELECT clothing_id, name, category FROM clothing_items
+            WHERE (name, category) IN ({values})
+        """, params)
+        rows = cursor.fetchall()
+        found = {(name, category): clothing_id for clothing_id, name, category in rows}
+        # 照合順序（utf8mb4_unicode_ci）は大文字小文字・全角半角を区別しないので、
+        # 'tシャツ' や 'Ｔシャツ' は登録済みの 'Tシャツ' の行に当たり、SELECT はその表記で返ってくる。
+        # 一致しなかったものは1件ずつ引き、リクエストの表記のままキャッシュする
+        for name, category in missing:
+            if (name, category) in found:
+                continue
+            cursor.execute(
+                "SELECT clothing_id FROM clothing_items WHERE name = %s AND category = %s LIMIT 1",
+                (name, category),
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                found[(name, category)] = row[0]
+        conn.commit()
+        return found
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def resolve(self, conn, pairs):
+        """
+        (name, category) の一覧を clothing_id に変換する。未登録のものは一括で登録する
+        （登録はその場でコミットするので、後続の INSERT が失敗してもキャッシュと食い違わない）
+
+        Returns:
+            {(name, category): clothing_id}
+        """
+        with self._lock:
+            expired = self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+            # 期限切れの読み直しは1スレッドに任せ、他は読み直し前の内容を使う（初回だけは全員待つ）
+            reload = expired and (self._loaded_at is None or not self._reloading)
+            if reload:
+                self._reloading = True
+
+        cursor = conn.cursor()
+        try:
+            if reload:
+                self._reload(cursor)
+            with self._lock:
+                missing = list(dict.fromkeys(p for p in pairs if p not in self._ids))
+            added = {}
+            if missing:
+                added = self._insert(conn, cursor, missing)
+                with self._lock:
+                    self._ids.update(added)
+        finally:
+            cursor.close()
+
+        with self._lock:
+            return {pair: added[pair] if pair in added else self._ids[pair] for pair in pairs}
+
+clothing_item_cache = ClothingItemCache()
+
+# 動作の前提になるインデックス（init.sql の CREATE TABLE にあるが、それより前に作った DB にはない）
+# （ClothingItemCache の INSERT ... ON DUPLICATE KEY はユニークキーがないと重複行を作る）
+REQUIRED_INDEXES = [
+    ("clothing_items", "uq_clothing_items_name_category"),
+    ("user_locations", "idx_user_locations_user_created"),  # 最新位置の読み出し（created_at 列ごと後から足した）
+]
+
+def missing_indexes():
+    """REQUIRED_INDEXES のうち DB にないものを "テーブル.インデックス" の一覧で返す"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT table_name, index_name FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+        """)
+        existing = {(table, index) for table, index in cursor.fetchall()}
+        cursor.close()
+    return [f"{table}.{index}" for table, index in REQUIRED_INDEXES if (table, index) not in existing]
+
+def save_clothing_choices(user_id, items, choice_date, weather, temperature, is_recommended):
+    """
+    1回分の服装選択をまとめて保存する（アイテム解決 + 複数行 INSERT 1回）
+
+    Args:
+        items: (アイテム名, カテゴリ) の一覧
+    """
+    with connection() as conn:
+        try:
+            ids = clothing_item_cache.resolve(conn, items)
+        except KeyError:
+            # 他プロセスで削除された等でキャッシュと食い違ったら読み直して再試行
+            clothing_item_cache.invalidate()
+            ids = clothing_item_cache.resolve(conn, items)
+
+        cursor = conn.cursor()
+        try:
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(items))
+            params = []
+            for pair in items:
+                params.extend([user_id, ids[pair], choice_date, weather, temperature, is_recommended])
+            cursor.execute(f"""
+                INSERT INTO user_clothing_choices (
+                    user_id, clothing_id, choice_date, weather, temperature, is_recommended
+                ) VALUES {values}
+            """, params)
+            conn.commit()
+        except mysql.connector.errors.IntegrityError:
+            # キャッシュ中の clothing_id が消えていた場合も次回は読み直す
+            clothing_item_cache.invalidate()
+            raise
+        finally:
+            cursor.close()
+
+def save_clothing_choice_batch(records):
+    """
+    複数回分の服装選択を1トランザクション・複数行 INSERT 1回で保存する（write-behind の書き込み用）
+
+    Args:
+        records: user_id, items（[アイテム名, カテゴリ] の一覧）, choice_date, weather, temperature,
+                 is_recommended, created_at（受け付けた時刻）を持つ dict の一覧
+    """
+    pairs = [tuple(item) for record in records for item in record["items"]]
+    with connection() as conn:
+        try:
+            ids = clothing_item_cache.resolve(conn, pairs)
+        except KeyError:
+            clothing_item_cache.invalidate()
+            ids = clothing_item_cache.resolve(conn, pairs)
+
+        cursor = conn.cursor()
+        try:
+            params = []
+            for record in records:
+                for item in record["items"]:
+                    params.extend([
+                        record["user_id"], ids[tuple(item)], record["choice_date"], record["weather"],
+                        record["temperature"], record["is_recommended"], record["created_at"],
+                    ])
+            values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * (len(params) // 7))
+            # 選択時刻は受け付けた時刻にする（学習の時刻特徴量・事前計算の時刻に使う）
+            cursor.execute(f"""
+                INSERT INTO user_clothing_choices (
+                    user_id, clothing_id, choice_date, weather, temperature, is_recommended, created_at
+                ) VALUES {values}
+            """, params)
+            conn.commit()
+        except mysql.connector.errors.IntegrityError:
+            clothing_item_cache.invalidate()
+            raise
+        finally:
+            cursor.close()
+
+def is_transient_write_error(e):
+    """待てば成功しうる書き込みエラーか（接続断・DB の再起動・接続プールの空き待ちなど）
+
+    それ以外（存在しないユーザー・型の不一致・コードの不具合など）は再試行しても同じなので、
+    write-behind キューは1件ずつ書き直して書けないものだけ退避する
+    """
+    return isinstance(e, (
+        mysql.connector.errors.OperationalError,
+        mysql.connector.errors.InterfaceError,
+        PoolTimeout,
+    ))
+
+# --- 事前計算した推薦 ---
+
+# 直近に選択・位置登録のあったユーザーと、選択をよく記録する時刻（時）
+_ACTIVE_USER_HOURS_SQL = """
+    SELECT user_id, HOUR(created_at) AS hour, COUNT(*) AS n
+    FROM user_clothing_choices
+    WHERE created_at >= %s
+    GROUP BY user_id, HOUR(created_at)
+    UNION ALL
+    SELECT DISTINCT user_id, NULL AS hour, 0 AS n
+    FROM user_locations
+    WHERE created_at >= %s
+"""
+
+def get_active_user_hours(since):
+    """
+    since 以降に使われたユーザーごとの {時: 回数}
+
+    位置登録だけのユーザーは空の dict になる
+    """
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(_ACTIVE_USER_HOURS_SQL, (since, since))
+        rows = cursor.fetchall()
+        cursor.close()
+    hours = {}
+    for row in rows:
+        counts = hours.setdefault(row["user_id"], {})
+        if row["hour"] is not None:
+            counts[int(row["hour"])] = int(row["n"])
+    return hours
+
+def save_precomputed_suggestions(rows):
+    """
+    事前計算した推薦をまとめて保存する（同じユーザー・時刻は上書き）
+
+    Args:
+        rows: user_id, target_hour, cell_lat, cell_lon, temperature, weather,
+              recommendations (dict), suggestion_text, image_keywords, image_url を持つ dict の一覧
+    """
+    if not rows:
+        return 0
+    params = [
+        (
+            row["user_id"], row["target_hour"], row["cell_lat"], row["cell_lon"],
+            row["temperature"], row["weather"], json.dumps(row["recommendations"], ensure_ascii=False),
+            row.get("suggestion_text"), row.get("image_keywords"), row.get("image_url"),
+        )
+        for row in rows
+    ]
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.executemany("""
+                INSERT INTO precomputed_suggestions (
+                    user_id, target_hour, cell_lat, cell_lon, temperature, weather,
+                    recommendations, suggestion_text, image_keywords, image_url
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    cell_lat = VALUES(cell_lat), cell_lon = VALUES(cell_lon),
+                    temperature = VALUES(temperature), weather = VALUES(weather),
+                    recommendations = VALUES(recommendations), suggestion_text = VALUES(suggestion_text),
+                    image_keywords = VALUES(image_keywords), image_url = VALUES(image_url),
+                    created_at = CURRENT_TIMESTAMP
+            """, params)
+            conn.commit()
+        finally:
+            cursor.close()
+    return len(params)
+
+def delete_precomputed_before(before):
+    """対象時刻を過ぎた事前計算結果を消す"""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM precomputed_suggestions WHERE target_hour < %s", (before,))
+        deleted = cursor.rowcount
+        conn.commit()
+        cursor.close()
+    return deleted
+
+async def aget_precomputed_suggestion(user_id, target_hour):
+    """ユーザー・時刻（時単位）の事前計算結果。なければ None"""
+    async with async_connection() as conn:
+        async with _dict_cursor(conn) as cursor:
+            await cursor.execute("""
+                SELECT user_id, target_hour, cell_lat, cell_lon, temperature, weather,
+                       recommendations, suggestion_text, image_keywords, image_url
+                FROM precomputed_suggestions
+                WHERE user_id = %s AND target_hour = %s
+            """, (user_id, target_hour))
+            row = await cursor.fetchone()
+    if row is not None and isinstance(row["recommendations"], (str, bytes)):
+        row["recommendations"] = json.loads(row["recommendations"])
+    return row
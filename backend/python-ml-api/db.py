@@ -1,8 +1,18 @@
-import mysql.connector
 import os
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import mysql.connector
 
-def get_connection():
-    return mysql.connector.connect(
+# 接続プール設定
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "10"))
+MYSQL_POOL_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", "5"))  # 空き待ちの上限（秒）
+MYSQL_POOL_PING_INTERVAL = float(os.getenv("MYSQL_POOL_PING_INTERVAL", "30"))  # この秒数以上使っていない接続は貸し出し前に確認
+
+def _db_settings():
+    return dict(
         user=os.getenv("MYSQL_USER", "root"),
         password=os.getenv("MYSQL_PASSWORD", "root"),
         host=os.getenv("MYSQL_HOST", "mysql2"),  # docker-composeのサービス名を使う
@@ -10,3 +20,225 @@ def get_connection():
         port=int(os.getenv("MYSQL_PORT", "3308")),
         charset="utf8mb4"
     )
+
+
+class PoolTimeout(Exception):
+    """プールの空き待ちがタイムアウトした"""
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0            # 空きがなく待たされた回数
+        self.wait_seconds = 0.0   # 待ち時間の合計
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0        # ヘルスチェック・エラーで捨てた接続数
+
+    def record_checkout(self, waited: float, had_to_wait: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            if had_to_wait:
+                self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def incr(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_seconds_total": round(self.wait_seconds, 6),
+                "wait_seconds_max": round(self.max_wait_seconds, 6),
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "discarded": self.discarded,
+            }
+
+
+class ConnectionPool:
+    """
+    mysql.connector の接続を使い回すプール
+
+    - 最大 size 本まで接続を作り、空きがなければ timeout 秒まで待つ
+    - しばらく使っていない接続は貸し出し前に ping して、切れていれば作り直す
+    - connection() を with で使えば例外時も必ずプールに戻る
+    """
+
+    def __init__(self, size: int = MYSQL_POOL_SIZE, timeout: float = MYSQL_POOL_TIMEOUT,
+                 ping_interval: float = MYSQL_POOL_PING_INTERVAL):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._idle: "queue.LifoQueue" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.stats = PoolStats()
+        self._in_use = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = mysql.connector.connect(**_db_settings())
+        self.stats.incr("created")
+        return conn
+
+    def _healthy(self, conn, idle_since: float) -> bool:
+        if time.monotonic() - idle_since < self.ping_interval:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        start = time.monotonic()
+        had_to_wait = not self._slots.acquire(blocking=False)
+        if had_to_wait and not self._slots.acquire(timeout=self.timeout):
+            self.stats.incr("timeouts")
+            raise PoolTimeout(f"DB 接続プールの空き待ちが {self.timeout} 秒を超えました")
+        self.stats.record_checkout(time.monotonic() - start, had_to_wait)
+
+        try:
+            conn = None
+            while conn is None:
+                try:
+                    candidate, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect()
+                    break
+                if self._healthy(candidate, idle_since):
+                    conn = candidate
+                else:
+                    self._discard(candidate)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def _discard(self, conn) -> None:
+        self.stats.incr("discarded")
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def release(self, conn, broken: bool = False) -> None:
+        try:
+            if not broken:
+                try:
+                    # 読み取りだけでも暗黙のトランザクションが残るので、戻す前に必ず終わらせる
+                    if conn.in_transaction:
+                        conn.rollback()
+                except Exception:
+                    broken = True
+            if broken:
+                self._discard(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            # 通信エラーの接続は使い回さない
+            self.release(conn, broken=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def status(self) -> dict:
+        stats = self.stats.as_dict()
+        stats.update({"size": self.size, "in_use": self._in_use, "idle": self._idle.qsize()})
+        return stats
+
+
+# ワーカー内で共有する同期用プール
+pool = ConnectionPool()
+
+def connection():
+    """
+    プールから接続を借りるコンテキストマネージャ
+
+        with connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            ...
+    """
+    return pool.connection()
+
+# 非同期 API 用の接続プール（イベントループ上で1つだけ作る）
+_async_pool = None
+async_pool_stats = PoolStats()
+
+async def get_async_pool():
+    global _async_pool
+    if _async_pool is None:
+        # 非同期ドライバは非同期 API を初めて使うときに読み込む
+        import aiomysql
+
+        settings = _db_settings()
+        _async_pool = await aiomysql.create_pool(
+            user=settings["user"],
+            password=settings["password"],
+            host=settings["host"],
+            db=settings["database"],
+            port=settings["port"],
+            charset=settings["charset"],
+            minsize=int(os.getenv("MYSQL_ASYNC_POOL_MIN", "1")),
+            maxsize=int(os.getenv("MYSQL_ASYNC_POOL_MAX", "10")),
+            pool_recycle=3600,
+            autocommit=True,
+        )
+    return _async_pool
+
+@asynccontextmanager
+async def async_connection():
+    """非同期プールから接続を借りる（待ち時間を記録する）"""
+    db_pool = await get_async_pool()
+    # 空き接続がなく、上限まで作り切っている場合は待ちが発生する
+    had_to_wait = db_pool.freesize == 0 and db_pool.size >= db_pool.maxsize
+    start = time.monotonic()
+    async with db_pool.acquire() as conn:
+        async_pool_stats.record_checkout(time.monotonic() - start, had_to_wait)
+        yield conn
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        _async_pool.close()
+        await _async_pool.wait_closed()
+        _async_pool = None
+
+def pool_status() -> dict:
+    status = {"sync": pool.status(), "async": async_pool_stats.as_dict()}
+    if _async_pool is not None:
+        status["async"].update({"size": _async_pool.size, "free": _async_pool.freesize, "maxsize": _async_pool.maxsize})
+    return status
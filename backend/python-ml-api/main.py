@@ -1,60 +1,184 @@
-from fastapi import FastAPI, HTTPException, APIRouter
+import asyncio
+import json
+import os
+import time
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from crud import get_latest_location
-from ml_logic.recommend import recommend_all
-from ml_logic.data import fetch_weather
-from ml_logic.textgen import generate_advice_and_keywords
-from ml_logic.pixabay import search_pixabay_image  # ✅ 1枚取得に変更
-from datetime import datetime
 from dotenv import load_dotenv
-from routes import save_choice
 
+# 各モジュールが import 時に環境変数を読むので、.env は最初に1回だけ読み込む
 load_dotenv()
 
+from crud import (
+    aget_latest_location, aget_latest_locations, aget_precomputed_suggestion, invalidate_location,
+    location_cache, missing_indexes, remember_location,
+)
+from db import close_async_pool, pool, pool_status
+from ml_logic.features import build_feature_row, build_features
+from ml_logic.model_registry import registry
+from ml_logic.clients import aclose_clients
+from ml_logic.data import afetch_weather, last_known_weather, weather_cache_stats, weather_cell
+from ml_logic.textgen import (
+    advice_cache, agenerate_advice_and_keywords, astream_advice_and_keywords, get_model, template_advice,
+)
+from ml_logic.pixabay import asearch_pixabay_image, cached_pixabay_image  # ✅ 1枚取得に変更
+from ml_logic.resilience import breaker_stats, current_deadline, request_budget, within_budget
+from ml_logic.prescore import matches_conditions, truncate_hour
+from ml_logic.metrics import (
+    cache_lookups, http_request_duration, log_event, metrics, new_request_id, register_cache, request_context, timed,
+)
+from datetime import datetime
+from routes import save_choice
+
+# /suggest の外部 API 呼び出し（天気・Gemini・Pixabay）に使ってよい合計秒数
+SUGGEST_BUDGET_SECONDS = float(os.getenv("SUGGEST_BUDGET_SECONDS", "8"))
+# /suggest/batch の外部 API 呼び出しに使ってよい合計秒数
+SUGGEST_BATCH_BUDGET_SECONDS = float(os.getenv("SUGGEST_BATCH_BUDGET_SECONDS", "30"))
+
+# バッチ推薦で1回に受け付ける最大ユーザー数
+MAX_BATCH_SIZE = int(os.getenv("SUGGEST_BATCH_MAX_USERS", "5000"))
+# バッチ推薦で同時に投げる Gemini / Pixabay 呼び出しの上限
+BATCH_ADVICE_CONCURRENCY = int(os.getenv("SUGGEST_BATCH_ADVICE_CONCURRENCY", "8"))
+
 router = APIRouter(prefix="/api/v1")
 
 class SuggestRequest(BaseModel):
     user_id: int
 
+class LocationNotice(BaseModel):
+    user_id: int
+    latitude: Optional[float] = None   # 位置が分かっていればキャッシュをその値で更新
+    longitude: Optional[float] = None  # 省略時はキャッシュを捨てて次回 DB から読む
+
+class BatchSuggestRequest(BaseModel):
+    user_ids: List[int]
+    include_advice: bool = False  # Gemini のアドバイス文を付けるか
+    include_image: bool = False   # Pixabay の画像を付けるか（include_advice が必要）
+
+def _get_engine():
+    # 推論エンジンは numpy / scipy ごと読み込むので、import はスレッド（ウォームアップ・リクエスト）で行う
+    from ml_logic.inference import get_engine
+    return get_engine()
+
+async def _load_precomputed(user_id, target_hour):
+    # 事前計算の読み込み失敗は「なし」と同じ扱い（通常の推薦にフォールバック）
+    try:
+        return await aget_precomputed_suggestion(user_id, target_hour)
+    except Exception as e:
+        print(f"⚠ 事前計算の読み込みに失敗: {e}")
+        return None
+
+def _stored_response(stored, weather_data, degraded):
+    return {
+        "recommendations": stored["recommendations"],
+        "suggestion_text": stored["suggestion_text"],
+        "image_keywords": stored["image_keywords"],
+        "image_url": stored["image_url"],
+        "temperature": weather_data.get("temperature"),
+        "weather": weather_data.get("weather"),
+        "degraded": degraded,
+    }
+
+async def _prepare_suggestion(user_id):
+    """
+    位置情報・天気・推論までを行う（アドバイス文と画像の前まで）
+
+    Returns:
+        (天気情報, 推薦, 事前計算の応答, 縮退した項目の一覧) 事前計算が使えるときは推薦は None
+
+    Raises:
+        HTTPException: 位置情報がない・天気が取れない（最後に取得できた天気もない）場合
+    """
+    degraded = []
+    # モデル更新の確認・推論エンジンの組み立てを DB / 天気の待ち時間と重ねる
+    engine_task = asyncio.ensure_future(run_in_threadpool(_get_engine))
+
+    try:
+        # 最新位置情報取得
+        with timed("db"):
+            location = await aget_latest_location(user_id)
+        if not location:
+            raise HTTPException(status_code=404, detail="Location not found")
+
+        # 天気情報取得（事前計算済みの推薦の読み込みと並行）
+        now = datetime.now()
+        with timed("weather"):
+            weather_data, stored = await asyncio.gather(
+                within_budget(afetch_weather(location["latitude"], location["longitude"]), "weather"),
+                _load_precomputed(user_id, truncate_hour(now)),
+            )
+        if not weather_data:
+            # 天気 API が使えなければ、そのマスで最後に取得できた天気で推薦する
+            weather_data = last_known_weather(location["latitude"], location["longitude"])
+            if not weather_data:
+                raise HTTPException(status_code=500, detail="Weather fetch failed")
+            degraded.append("weather")
+
+        # 予報で事前計算した推薦が実際の天気と合っていれば、推論・生成をせずにそのまま使う
+        if stored is not None:
+            if matches_conditions(stored, location, weather_data):
+                cache_lookups.inc("precomputed", "hit")
+                return weather_data, None, _stored_response(stored, weather_data, degraded), degraded
+            cache_lookups.inc("precomputed", "stale")
+        else:
+            cache_lookups.inc("precomputed", "miss")
+
+        # 特徴量作成
+        features = build_features(user_id, weather_data, now)
+
+        # 推論実行（CPU 処理なのでスレッドプールで実行し、イベントループは塞がない）
+        with timed("model_ready"):
+            engine = await engine_task
+        with timed("inference"):
+            recommendations = await run_in_threadpool(engine.predict, features)
+        return weather_data, recommendations, None, degraded
+    finally:
+        # 推論まで進まなかったとき（404・事前計算を返す・途中の例外）はタスクを残さない
+        if not engine_task.done():
+            engine_task.cancel()
+        elif not engine_task.cancelled():
+            engine_task.exception()  # 読み込みの失敗を「取り出されなかった例外」にしない
+
+async def _find_image(image_keywords, degraded):
+    # Pixabayで画像を1枚取得（時間切れ・失敗時はキャッシュ済みの画像か代替画像）
+    with timed("image"):
+        image_url = await within_budget(asearch_pixabay_image(image_keywords), "image")
+    if not image_url:
+        degraded.append("image")
+        image_url = cached_pixabay_image(image_keywords)
+    return image_url
+
 @router.post("/suggest")
-def suggest(req: SuggestRequest):
-    # 最新位置情報取得
-    location = get_latest_location(req.user_id)
-    if not location:
-        raise HTTPException(status_code=404, detail="Location not found")
-
-    # 天気情報取得
-    weather_data = fetch_weather(location["latitude"], location["longitude"])
-    if not weather_data:
-        raise HTTPException(status_code=500, detail="Weather fetch failed")
-    
-    print("✅ 天気情報:", weather_data)
-
-    # 特徴量作成
-    features = weather_data.copy()
-    features["user_id"] = req.user_id
-    now = datetime.now()
-    features.update({
-        "month": now.month,
-        "day": now.day,
-        "hour": now.hour,
-        "weekday": now.weekday(),
-    })
-    
-    features["temp_bin"] = str(int(float(features["temperature"]) // 5))
-
-    # 推論実行（服装カテゴリごと）
-    recommendations = recommend_all(features)
-
-    # アドバイス文 + 画像キーワード生成（Gemini使用）
-    temperature = float(weather_data["temperature"])
-    weather = weather_data["weather"]
-    result = generate_advice_and_keywords(recommendations, temperature, weather)
-    advice_text = result["advice_text"]
-    image_keywords = result["image_keywords"]
-
-    # Pixabayで画像を1枚取得
-    image_url = search_pixabay_image(image_keywords)
+async def suggest(req: SuggestRequest):
+    """
+    推薦・アドバイス文・画像を返す
+
+    外部 API 呼び出しは合計 SUGGEST_BUDGET_SECONDS 秒に収め、間に合わない・失敗した部分は
+    縮退応答（最後に取得できた天気・定型のアドバイス文・キャッシュ済みか代替の画像）にして
+    "degraded" に項目名を入れる。
+    """
+    with request_budget(SUGGEST_BUDGET_SECONDS):
+        weather_data, recommendations, precomputed, degraded = await _prepare_suggestion(req.user_id)
+        if precomputed is not None:
+            return precomputed
+
+        # アドバイス文 + 画像キーワード生成（Gemini使用）
+        temperature = float(weather_data["temperature"])
+        weather = weather_data["weather"]
+        with timed("advice"):
+            result = await within_budget(
+                agenerate_advice_and_keywords(recommendations, temperature, weather), "advice"
+            )
+        if result is None:
+            degraded.append("advice")
+            result = template_advice(recommendations, temperature, weather)
+        advice_text = result["advice_text"]
+        image_keywords = result["image_keywords"]
+
+        image_url = await _find_image(image_keywords, degraded)
 
     return {
         "recommendations": recommendations,
@@ -62,10 +186,347 @@ def suggest(req: SuggestRequest):
         "image_keywords": image_keywords,
         "image_url": image_url,  # ✅ 単数
         "temperature": weather_data.get("temperature"),
-        "weather": weather_data.get("weather")
+        "weather": weather_data.get("weather"),
+        "degraded": degraded,
     }
 
+def _format_event(event, data, sse):
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"event": event, **data}, ensure_ascii=False) + "\n"
+
+@router.post("/suggest/stream")
+async def suggest_stream(req: SuggestRequest, request: Request):
+    """
+    /suggest のストリーミング版（Accept: text/event-stream なら SSE、それ以外は NDJSON）
+
+    届く順番:
+        recommendations … 推薦・気温・天気（DB + 天気 + 推論が終わった時点）
+        advice_delta    … Gemini から届いたアドバイス文の続き（複数回）
+        advice          … アドバイス文の全文と画像キーワード（途中で縮退した場合は定型文に置き換わる）
+        image           … 画像 URL
+        done            … 終わり（縮退した項目の一覧 "degraded" 付き。想定外の失敗は error の後に done）
+    位置情報がない・天気が取れない場合はストリームを始める前に /suggest と同じエラーを返す。
+    時間予算は /suggest と同じで、ストリーム中も引き継ぐ。
+    """
+    with request_budget(SUGGEST_BUDGET_SECONDS):
+        weather_data, recommendations, precomputed, degraded = await _prepare_suggestion(req.user_id)
+        deadline = current_deadline()
+    sse = "text/event-stream" in request.headers.get("accept", "")
+
+    async def events():
+        base = {"temperature": weather_data.get("temperature"), "weather": weather_data.get("weather")}
+        if precomputed is not None:
+            yield _format_event("recommendations", {"recommendations": precomputed["recommendations"], **base}, sse)
+            yield _format_event("advice", {
+                "suggestion_text": precomputed["suggestion_text"],
+                "image_keywords": precomputed["image_keywords"],
+            }, sse)
+            yield _format_event("image", {"image_url": precomputed["image_url"]}, sse)
+            yield _format_event("done", {"degraded": degraded}, sse)
+            return
+
+        yield _format_event("recommendations", {"recommendations": recommendations, **base}, sse)
+        temperature = float(weather_data["temperature"])
+        weather = weather_data["weather"]
+        try:
+            with request_budget(deadline=deadline):
+                result = None
+                with timed("advice"):
+                    try:
+                        async for kind, value in astream_advice_and_keywords(recommendations, temperature, weather):
+                            if kind == "delta":
+                                yield _format_event("advice_delta", {"text": value}, sse)
+                            else:
+                                result = value
+                    except Exception as e:
+                        # 時間切れ・ブレーカー作動・API エラーは定型文に切り替える
+                        log_event("degraded", stage="advice", reason=type(e).__name__)
+                if result is None:
+                    degraded.append("advice")
+                    result = template_advice(recommendations, temperature, weather)
+                yield _format_event("advice", {
+                    "suggestion_text": result["advice_text"],
+                    "image_keywords": result["image_keywords"],
+                }, sse)
+
+                image_url = await _find_image(result["image_keywords"], degraded)
+                yield _format_event("image", {"image_url": image_url}, sse)
+        except Exception as e:
+            # ヘッダー送信後はステータスを変えられないので、イベントで失敗を知らせる
+            log_event("stream_failed", error=str(e))
+            yield _format_event("error", {"detail": str(e)}, sse)
+        yield _format_event("done", {"degraded": degraded}, sse)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        # プロキシにバッファさせない（nginx）
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/suggest/batch")
+async def suggest_batch(req: BatchSuggestRequest):
+    """
+    複数ユーザーの推薦をまとめて返す（通知配信などのスケジューラ向け）
+
+    - 位置情報は1クエリで取得
+    - 同じ天気マスのユーザーは天気取得を1回にまとめ、マス同士は並行して取得
+    - 推論はカテゴリごとに全ユーザー分を1回の predict で行う
+    - 外部 API 呼び出しは合計 SUGGEST_BATCH_BUDGET_SECONDS 秒まで（以降は /suggest と同じ縮退応答）
+    """
+    with request_budget(SUGGEST_BATCH_BUDGET_SECONDS):
+        return await _suggest_batch(req)
+
+async def _suggest_batch(req: BatchSuggestRequest):
+    user_ids = list(dict.fromkeys(req.user_ids))
+    if len(user_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"user_ids は {MAX_BATCH_SIZE} 件までです")
+
+    locations = await aget_latest_locations(user_ids)
+    errors = [
+        {"user_id": user_id, "detail": "Location not found"}
+        for user_id in user_ids if user_id not in locations
+    ]
+
+    # 同じ天気キャッシュのマスにいるユーザーで天気取得を共有
+    points_by_cell = {}
+    for location in locations.values():
+        cell = weather_cell(location["latitude"], location["longitude"])
+        points_by_cell.setdefault(cell, (location["latitude"], location["longitude"]))
+    weathers = await asyncio.gather(*[
+        within_budget(afetch_weather(*point), "weather") for point in points_by_cell.values()
+    ])
+    weather_by_cell = dict(zip(points_by_cell, weathers))
+    # 取得できなかったマスは最後に取得できた天気を使う
+    stale_cells = set()
+    for cell, point in points_by_cell.items():
+        if not weather_by_cell[cell]:
+            weather_by_cell[cell] = last_known_weather(*point)
+            stale_cells.add(cell)
+
+    now = datetime.now()
+    scored_users = []
+    rows = []
+    for user_id in user_ids:
+        location = locations.get(user_id)
+        if location is None:
+            continue
+        cell = weather_cell(location["latitude"], location["longitude"])
+        weather_data = weather_by_cell[cell]
+        if not weather_data:
+            errors.append({"user_id": user_id, "detail": "Weather fetch failed"})
+            continue
+        features = build_features(user_id, weather_data, now)
+        scored_users.append((user_id, weather_data, ["weather"] if cell in stale_cells else []))
+        rows.append(build_feature_row(features))
+
+    # カテゴリごとに全ユーザー分をまとめて推論
+    labels_by_category = {}
+    if rows:
+        engine = await run_in_threadpool(_get_engine)
+        labels_by_category = await run_in_threadpool(engine.predict_rows, rows)
+
+    results = []
+    advice_keys = {}
+    for i, (user_id, weather_data, degraded) in enumerate(scored_users):
+        recommendations = {
+            category: labels[i] if labels else None
+            for category, labels in labels_by_category.items()
+        }
+        results.append({
+            "user_id": user_id,
+            "recommendations": recommendations,
+            "temperature": weather_data.get("temperature"),
+            "weather": weather_data.get("weather"),
+            "degraded": degraded,
+        })
+        if req.include_advice:
+            # 同じ服装・天気の組み合わせはバッチ内で1回だけ生成
+            key = (tuple(sorted(recommendations.items())), weather_data["temperature"], weather_data["weather"])
+            advice_keys.setdefault(key, (recommendations, weather_data))
+            results[-1]["_advice_key"] = key
+
+    if req.include_advice:
+        semaphore = asyncio.Semaphore(BATCH_ADVICE_CONCURRENCY)
+
+        async def generate(recommendations, weather_data):
+            temperature = float(weather_data["temperature"])
+            weather = weather_data["weather"]
+            degraded = []
+            async with semaphore:
+                result = await within_budget(
+                    agenerate_advice_and_keywords(recommendations, temperature, weather), "advice"
+                )
+                if result is None:
+                    degraded.append("advice")
+                    result = template_advice(recommendations, temperature, weather)
+                if req.include_image:
+                    result["image_url"] = await _find_image(result["image_keywords"], degraded)
+                result["degraded"] = degraded
+                return result
+
+        generated = await asyncio.gather(*[generate(*args) for args in advice_keys.values()])
+        advice_by_key = dict(zip(advice_keys, generated))
+
+        for item in results:
+            result = advice_by_key[item.pop("_advice_key")]
+            item["suggestion_text"] = result["advice_text"]
+            item["image_keywords"] = result["image_keywords"]
+            item["degraded"] = item["degraded"] + result["degraded"]
+            if req.include_image:
+                item["image_url"] = result["image_url"]
+
+    return {"results": results, "errors": errors}
+
+@router.post("/locations/notify")
+def notify_location(req: LocationNotice):
+    """
+    位置情報の登録を受けて最新位置キャッシュを更新する（Go バックエンドが登録後に呼ぶ）
+    """
+    if req.latitude is not None and req.longitude is not None:
+        remember_location(req.user_id, req.latitude, req.longitude)
+    else:
+        invalidate_location(req.user_id)
+    return {"status": "ok"}
+
+@router.get("/cache/stats")
+def cache_stats():
+    # キャッシュのヒット率（グリッド幅や TTL の調整用）
+    return {"weather": weather_cache_stats(), "advice": advice_cache.stats(), "location": location_cache.stats()}
+
+@router.get("/upstreams")
+def upstream_stats():
+    # 外部 API ごとのサーキットブレーカーの状態
+    return breaker_stats()
+
+@router.get("/db/stats")
+def db_stats():
+    # 接続プールの利用状況（空き待ち回数・待ち時間など）
+    return pool_status()
+
+# /metrics にキャッシュと接続プールの状態も載せる（値はスクレイプ時に読む）
+register_cache("weather", weather_cache_stats)
+register_cache("advice", advice_cache.stats)
+register_cache("location", location_cache.stats)
+metrics.gauge_callback(
+    "db_pool_connections", "同期接続プールの接続数", ("state",),
+    lambda: [(("in_use",), pool.status()["in_use"]), (("idle",), pool.status()["idle"])],
+)
+metrics.gauge_callback(
+    "db_pool_waits", "接続プールで空きを待った回数", ("pool",),
+    lambda: [((name,), stats["waits"]) for name, stats in pool_status().items()],
+)
+metrics.gauge_callback(
+    "db_pool_wait_seconds", "接続プールで空きを待った合計秒数", ("pool",),
+    lambda: [((name,), stats["wait_seconds_total"]) for name, stats in pool_status().items()],
+)
+
 # FastAPIアプリ登録
 app = FastAPI()
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    # リクエスト ID（呼び出し元が X-Request-ID を付けていればそれを引き継ぐ）
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    start = time.perf_counter()
+    status = 500
+    with request_context(request_id) as stages:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            elapsed = time.perf_counter() - start
+            route = request.scope.get("route")
+            # 未定義パスで系列が増えないよう、ルートのテンプレートでまとめる
+            path = route.path if route is not None else "unmatched"
+            http_request_duration.observe(elapsed, path, request.method, str(status))
+            log_event(
+                "request",
+                method=request.method,
+                path=path,
+                status=status,
+                duration_ms=round(elapsed * 1000, 2),
+                stages_ms={stage: round(seconds * 1000, 2) for stage, seconds in stages.items()},
+            )
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    # Prometheus のテキスト形式（ワーカープロセスごとの値）
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ウォームアップ（モデル読み込み・初回推論・SDK 設定）の状態。/ready で返す
+readiness = {"ready": False, "models": [], "warmup_seconds": None, "error": None}
+_warmup_task = None
+
+_WARMUP_FEATURES = {
+    "temperature": 20.0, "weather": "clear", "user_id": 0,
+    "month": 1, "day": 1, "hour": 12, "weekday": 0,
+}
+
+def check_schema():
+    try:
+        missing = missing_indexes()
+    except Exception as e:
+        print(f"⚠ スキーマ確認失敗: {e}")
+        return
+    if missing:
+        print(f"⚠ DB にインデックスがありません: {missing}（init.sql のマイグレーションを既存DBに流してください）")
+
+def warmup():
+    """
+    重い初期化をまとめて行う（起動直後の最初のリクエストに遅延を押し付けない）
+
+    - 全カテゴリのモデル読み込み（sklearn / xgboost の import を含む）
+    - 推論エンジンの組み立てとダミー入力での推論1回
+    - Gemini SDK の設定
+    - DB に前提のインデックスがあるかの確認（なければ警告だけ出す）
+    """
+    start = time.perf_counter()
+    check_schema()
+    try:
+        registry.load_all()
+        _get_engine().predict(_WARMUP_FEATURES)
+        get_model()
+    except Exception as e:
+        readiness["error"] = str(e)
+        print(f"❌ ウォームアップ失敗: {e}")
+        return
+    readiness["models"] = registry.loaded_categories
+    readiness["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    readiness["error"] = None
+    # モデルが1つもなければ推薦できないので ready にしない
+    readiness["ready"] = bool(readiness["models"])
+    print(f"✅ ウォームアップ完了 ({readiness['warmup_seconds']}s): {readiness['models']}")
+
+@app.on_event("startup")
+async def start_warmup():
+    # ウォームアップはスレッドで進め、その間もプロセスは接続を受け付ける（/ready は 503）
+    global _warmup_task
+    _warmup_task = asyncio.ensure_future(run_in_threadpool(warmup))
+    save_choice.start_choice_writer()
+
+@app.get("/health", include_in_schema=False)
+def health():
+    # 生存確認（プロセスが応答できれば OK）
+    return {"status": "ok"}
+
+@app.get("/ready", include_in_schema=False)
+def ready():
+    # モデル読み込みとウォームアップが終わるまでは 503（ロードバランサの振り分け判定用）
+    if readiness["ready"]:
+        return {"status": "ready", **readiness}
+    return JSONResponse(status_code=503, content={"status": "starting", **readiness})
+
+@app.on_event("shutdown")
+async def close_clients():
+    # write-behind キューを書き切ってから、共有している HTTP / DB の接続プールを閉じる
+    await run_in_threadpool(save_choice.stop_choice_writer)
+    await aclose_clients()
+    await close_async_pool()
+    pool.close()
+
 app.include_router(router)
-app.include_router(save_choice.router)
\ No newline at end of file
+app.include_router(save_choice.router)
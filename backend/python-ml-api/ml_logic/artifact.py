@@ -0,0 +1,281 @@
+"""
+推論用のモデルファイル（.bin）
+
+学習済み Pipeline（OneHotEncoder + XGBClassifier）と LabelEncoder の pickle から、
+推論に必要なものだけを1ファイルに書き出す。読み込み側は sklearn / pandas を必要とせず、
+pickle を復元しない分だけ読み込みが速い。
+
+ファイルの大きさは .pkl とほぼ同じ（大半は XGBoost の木）。ワーカー間で物理メモリを
+共有できるのはページキャッシュに載るファイル本体だけで、XGBoost の木と語彙の辞書は
+読み込み時にワーカーごとに作られる。
+
+    オフセット  内容
+    0           マジック b"CLOSETMD"
+    8           フォーマットのバージョン（uint32, little endian）
+    12          ヘッダー長（uint32）
+    16          ヘッダー（UTF-8 JSON: 特徴量の並び・語彙数・クラス名・各セクションの位置）
+    以降        セクション（8バイト境界に揃える）
+                  vocab_offsets … 語彙文字列の開始位置（int64, 全特徴量を連結）
+                  vocab_blob    … 語彙文字列（UTF-8 を連結）
+                  booster       … XGBoost のネイティブ形式（UBJSON）
+
+既存の .pkl からの変換:
+
+    python -m ml_logic.artifact models/
+"""
+import argparse
+import ctypes
+import json
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from ml_logic.features import TEMP_BIN_WIDTH
+
+MAGIC = b"CLOSETMD"
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGN = 8
+
+
+class ArtifactError(Exception):
+    """モデルファイルが壊れている・バージョンが合わない場合の例外"""
+
+
+def describe_pipeline(pipeline: Any) -> Dict[str, Any]:
+    """
+    Pipeline（ColumnTransformer(OneHotEncoder) + 分類器）から推論に必要な情報を取り出す
+
+    Raises:
+        ValueError: 想定外の構成の場合
+    """
+    steps = dict(pipeline.steps)
+    preprocessor = steps["preprocessor"]
+    transformers = [t for t in preprocessor.transformers_ if t[0] != "remainder"]
+    if len(pipeline.steps) != 2 or len(transformers) != 1:
+        raise ValueError("想定外の Pipeline 構成です")
+    _, encoder, columns = transformers[0]
+    if type(encoder).__name__ != "OneHotEncoder" or getattr(encoder, "drop", None) is not None:
+        raise ValueError("OneHotEncoder(drop=None) 以外には対応していません")
+    return {
+        "columns": list(columns),
+        "categories": [list(values) for values in encoder.categories_],
+        "classifier": steps["classifier"],
+        # 学習時の密度で疎/密が決まるので同じ形式で分類器に渡す
+        "sparse_output": bool(getattr(preprocessor, "sparse_output_", True)),
+    }
+
+
+def _pad(buffer: bytearray) -> None:
+    buffer.extend(b"\0" * (-len(buffer) % _ALIGN))
+
+
+def build_artifact(pipeline: Any, label_encoder: Any, category: str,
+                   metadata: Optional[Dict[str, Any]] = None) -> bytes:
+    """学習済みモデルをモデルファイルのバイト列にする"""
+    import xgboost as xgb
+
+    spec = describe_pipeline(pipeline)
+    classifier = spec["classifier"]
+
+    strings = [str(value).encode("utf-8") for values in spec["categories"] for value in values]
+    vocab_offsets = np.zeros(len(strings) + 1, dtype="<i8")
+    vocab_offsets[1:] = np.cumsum([len(s) for s in strings])
+    sections = {
+        "vocab_offsets": vocab_offsets.tobytes(),
+        "vocab_blob": b"".join(strings),
+        "booster": bytes(classifier.get_booster().save_raw(raw_format="ubj")),
+    }
+
+    header = {
+        "category": category,
+        "features": spec["columns"],
+        "vocab_sizes": [len(values) for values in spec["categories"]],
+        "sparse_output": spec["sparse_output"],
+        "temp_bin_width": TEMP_BIN_WIDTH,
+        "classes": [str(c) for c in label_encoder.classes_],
+        "objective": str(classifier.objective),
+        "best_iteration": getattr(classifier, "best_iteration", None),
+        "xgboost_version": xgb.__version__,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "metadata": metadata or {},
+    }
+
+    # セクションの位置はヘッダー長に依存するので、ヘッダー長が確定するまで組み直す
+    header_len = 0
+    while True:
+        offset = _PREAMBLE.size + header_len
+        offset += -offset % _ALIGN
+        locations = {}
+        for name, data in sections.items():
+            locations[name] = [offset, len(data)]
+            offset += len(data)
+            offset += -offset % _ALIGN
+        header["sections"] = locations
+        encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if len(encoded) == header_len:
+            break
+        header_len = len(encoded)
+
+    out = bytearray(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+    out.extend(encoded)
+    _pad(out)
+    for name, data in sections.items():
+        assert len(out) == locations[name][0]
+        out.extend(data)
+        _pad(out)
+    return bytes(out)
+
+
+def write_artifact(path: str, pipeline: Any, label_encoder: Any, category: str,
+                   metadata: Optional[Dict[str, Any]] = None) -> int:
+    """
+    モデルファイルを書き出す（一時ファイル + os.replace で差し替えるので、読み込み側が書きかけを見ない）
+
+    Returns:
+        書き出したバイト数
+    """
+    data = build_artifact(pipeline, label_encoder, category, metadata)
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp は 0600 で作るので、通常のファイルと同じ権限（umask に従う）にする
+        os.chmod(tmp_path, default_file_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(data)
+
+
+def default_file_mode() -> int:
+    """open() で新しく作るファイルと同じ権限（0666 から umask を除いたもの）"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class NativeModel:
+    """
+    mmap したモデルファイル
+
+    ヘッダーと語彙の配列（vocab_offsets / vocab_blob）はファイル上のものをそのまま参照する。
+    XGBoost の木はライブラリの内部形式に、語彙は {値: 列番号} の辞書（vocabulary()）に
+    変換する必要があるため、これらはワーカーごとに1つずつ持つ。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, header_len = _PREAMBLE.unpack_from(self._mm, 0)
+        except struct.error as e:
+            raise ArtifactError(f"モデルファイルが短すぎます: {path}") from e
+        if magic != MAGIC:
+            raise ArtifactError(f"モデルファイルではありません: {path}")
+        if version != FORMAT_VERSION:
+            raise ArtifactError(f"未対応のフォーマットバージョン {version}: {path}")
+        self.header = json.loads(bytes(self._mm[_PREAMBLE.size:_PREAMBLE.size + header_len]))
+
+        self.category: str = self.header["category"]
+        self.columns: List[str] = self.header["features"]
+        self.vocab_sizes: List[int] = self.header["vocab_sizes"]
+        self.n_columns = sum(self.vocab_sizes)
+        self.sparse_output: bool = self.header["sparse_output"]
+        self.classes = np.asarray(self.header["classes"], dtype=object)
+        self.objective: str = self.header["objective"]
+        self.best_iteration: Optional[int] = self.header.get("best_iteration")
+        if self.header.get("temp_bin_width") not in (None, TEMP_BIN_WIDTH):
+            # 温度帯の幅が違うと既知の温度帯でも列がずれるので、読み込ませない
+            raise ArtifactError(
+                f"温度帯の幅が推論側と違います（モデル {self.header['temp_bin_width']}℃ / "
+                f"推論 {TEMP_BIN_WIDTH}℃）: {path}"
+            )
+
+        offset, length = self.header["sections"]["vocab_offsets"]
+        self.vocab_offsets = np.frombuffer(self._mm, dtype="<i8", count=length // 8, offset=offset)
+        offset, length = self.header["sections"]["vocab_blob"]
+        self._vocab_blob = memoryview(self._mm)[offset:offset + length]
+        if len(self.vocab_offsets) != self.n_columns + 1:
+            raise ArtifactError(f"語彙の件数がヘッダーと一致しません: {path}")
+
+        self.booster = self._load_booster()
+
+    def _load_booster(self):
+        import xgboost as xgb
+
+        offset, length = self.header["sections"]["booster"]
+        booster = xgb.Booster()
+        # mmap 上のバイト列を直接渡す（Booster.load_model は bytearray へのコピーを要求する）
+        raw = np.frombuffer(self._mm, dtype=np.uint8, count=length, offset=offset)
+        try:
+            xgb.core._check_call(xgb.core._LIB.XGBoosterLoadModelFromBuffer(
+                booster.handle, ctypes.c_void_p(raw.ctypes.data), xgb.core.c_bst_ulong(length),
+            ))
+        except AttributeError:
+            # 内部 API が変わった版ではコピーして読む
+            booster.load_model(bytearray(raw))
+        return booster
+
+    def vocabulary(self) -> Dict[str, Dict[str, int]]:
+        """特徴量ごとの {値: OneHot 列番号}"""
+        vocab = {}
+        index = 0
+        for column, size in zip(self.columns, self.vocab_sizes):
+            values = {}
+            for _ in range(size):
+                start, end = self.vocab_offsets[index], self.vocab_offsets[index + 1]
+                values[bytes(self._vocab_blob[start:end]).decode("utf-8")] = index
+                index += 1
+            vocab[column] = values
+        return vocab
+
+    def predict_index(self, X) -> np.ndarray:
+        """OneHot 済みの入力行列からクラス番号を返す（XGBClassifier.predict と同じ判定）"""
+        kwargs = {}
+        if self.best_iteration is not None:
+            kwargs["iteration_range"] = (0, self.best_iteration + 1)
+        out = self.booster.inplace_predict(X, missing=np.nan, validate_features=False, **kwargs)
+        out = np.asarray(out)
+        if out.ndim == 2:
+            return out.argmax(axis=1)
+        if self.objective.startswith("binary"):
+            return (out > 0.5).astype(int)
+        return out.astype(int)
+
+
+def main():
+    import joblib
+    from ml_logic.model_registry import CATEGORIES, artifact_path, model_path, unpack_bundle
+
+    parser = argparse.ArgumentParser(description=".pkl のモデルを推論用のモデルファイルに変換する")
+    parser.add_argument("model_dir", nargs="?", default=os.getenv("MODEL_DIR", "models"))
+    args = parser.parse_args()
+
+    for category in CATEGORIES:
+        source = model_path(category, args.model_dir)
+        if not os.path.exists(source):
+            print(f"⚠ モデルファイルなし: {source}")
+            continue
+        unpacked = unpack_bundle(joblib.load(source))
+        if unpacked is None:
+            print(f"❌ 想定外のモデル形式 [{category}]")
+            continue
+        target = artifact_path(category, args.model_dir)
+        size = write_artifact(target, *unpacked, category=category)
+        print(f"✅ {target} ({size / 1024:.1f} KiB, 元の .pkl は {os.path.getsize(source) / 1024:.1f} KiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import os
+from typing import Dict
+
+import httpx
+
+# 外部 API 用の keep-alive 接続プール設定（ワーカーごと）
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_async_client(name: str = "default", verify: bool = True) -> httpx.AsyncClient:
+    """
+    用途ごとに共有する httpx.AsyncClient を返す（初回呼び出し時に作成）
+
+    リクエストのたびに接続を張り直さないよう、プロセス内で使い回す
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            verify=verify,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+        _clients[name] = client
+    return client
+
+
+async def aclose_clients() -> None:
+    """シャットダウン時に全クライアントの接続を閉じる"""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
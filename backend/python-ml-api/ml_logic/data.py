@@ -1,77 +1,226 @@
-from db import get_connection
+from db import connection
 from datetime import datetime
+from ml_logic.cache import AsyncSingleFlight, SingleFlight, TTLCache
+from ml_logic.clients import get_async_client
+from ml_logic.metrics import log_event, track_call
+from ml_logic.resilience import guarded_call
+import asyncio
 import requests
 import os
 
+# テスト時はローカルのフェイクサーバーに向けられるようにする
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org")
+
+# 1回の呼び出しのタイムアウト上限（秒）。リクエストの時間予算が残り少なければそちらに合わせる
+OPENWEATHER_TIMEOUT = float(os.getenv("OPENWEATHER_TIMEOUT", "3"))
+
+# 天気キャッシュ: 緯度経度を WEATHER_GRID_DEG 度のマスに丸めて共有する（0.05度 ≒ 5km）
+WEATHER_GRID_DEG = float(os.getenv("WEATHER_GRID_DEG", "0.05"))
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "10000"))
+
+weather_cache = TTLCache(maxsize=WEATHER_CACHE_SIZE, ttl=WEATHER_CACHE_TTL)
+_weather_flight = SingleFlight()
+_async_weather_flight = AsyncSingleFlight()
+
+# 最後に取得できた天気（天気 API が使えないときの縮退応答用。通常のキャッシュより長く持つ）
+LAST_KNOWN_WEATHER_TTL = float(os.getenv("LAST_KNOWN_WEATHER_TTL", str(6 * 3600)))
+_last_known_weather = TTLCache(maxsize=WEATHER_CACHE_SIZE, ttl=LAST_KNOWN_WEATHER_TTL)
+
+def weather_cell(lat, lon, grid=None):
+    """緯度経度をキャッシュ用のマス（整数の組）に変換する"""
+    grid = grid or WEATHER_GRID_DEG
+    return round(float(lat) / grid), round(float(lon) / grid)
+
+def _cell_center(cell, grid=None):
+    grid = grid or WEATHER_GRID_DEG
+    return round(cell[0] * grid, 6), round(cell[1] * grid, 6)
+
+def _weather_params(lat, lon, api_key):
+    return {"lat": lat, "lon": lon, "appid": api_key, "units": "metric", "lang": "ja"}
+
+def _parse_weather(data):
+    return {
+        "temperature": data["main"]["temp"],
+        "weather": data["weather"][0]["main"].lower()  # ex: "clear", "rain"
+    }
+
+def _request_weather(lat, lon, api_key):
+    url = f"{OPENWEATHER_BASE_URL}/data/2.5/weather"
+    try:
+        with guarded_call("openweather", OPENWEATHER_TIMEOUT) as call, track_call("openweather"):
+            response = requests.get(url, params=_weather_params(lat, lon, api_key), timeout=call.timeout)
+            response.raise_for_status()
+            return _parse_weather(response.json())
+    except Exception as e:
+        log_event("weather_fetch_failed", service="openweather", error=str(e))
+        return None
+
+async def _arequest_weather(lat, lon, api_key):
+    url = f"{OPENWEATHER_BASE_URL}/data/2.5/weather"
+    try:
+        with guarded_call("openweather", OPENWEATHER_TIMEOUT) as call, track_call("openweather"):
+            response = await asyncio.wait_for(
+                get_async_client().get(url, params=_weather_params(lat, lon, api_key), timeout=call.timeout),
+                call.timeout,
+            )
+            response.raise_for_status()
+            return _parse_weather(response.json())
+    except Exception as e:
+        log_event("weather_fetch_failed", service="openweather", error=str(e))
+        return None
+
 def fetch_weather(lat, lon):
     API_KEY = os.getenv("OPENWEATHER_API_KEY")
     if not API_KEY:
         raise ValueError("OPENWEATHER_API_KEY is not set in environment variables")
-    
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={API_KEY}&units=metric&lang=ja"
-    try:
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        return {
-            "temperature": data["main"]["temp"],
-            "weather": data["weather"][0]["main"].lower()  # ex: "clear", "rain"
+
+    cell = weather_cell(lat, lon)
+    cached = weather_cache.get(cell)
+    if cached is not None:
+        return dict(cached)
+
+    def load():
+        # 待っている間に他のリクエストが取得済みならそれを使う
+        cached = weather_cache.peek(cell)
+        if cached is not None:
+            return cached
+        weather = _request_weather(*_cell_center(cell), API_KEY)
+        if weather is not None:  # 失敗はキャッシュしない
+            weather_cache.set(cell, weather)
+            _last_known_weather.set(cell, weather)
+        return weather
+
+    weather = _weather_flight.do(cell, load)
+    return dict(weather) if weather is not None else None
+
+async def afetch_weather(lat, lon):
+    """fetch_weather の非同期版（キャッシュは同期版と共有）"""
+    API_KEY = os.getenv("OPENWEATHER_API_KEY")
+    if not API_KEY:
+        raise ValueError("OPENWEATHER_API_KEY is not set in environment variables")
+
+    cell = weather_cell(lat, lon)
+    cached = weather_cache.get(cell)
+    if cached is not None:
+        return dict(cached)
+
+    async def load():
+        cached = weather_cache.peek(cell)
+        if cached is not None:
+            return cached
+        weather = await _arequest_weather(*_cell_center(cell), API_KEY)
+        if weather is not None:
+            weather_cache.set(cell, weather)
+            _last_known_weather.set(cell, weather)
+        return weather
+
+    weather = await _async_weather_flight.do(cell, load)
+    return dict(weather) if weather is not None else None
+
+def last_known_weather(lat, lon):
+    """そのマスで最後に取得できた天気（LAST_KNOWN_WEATHER_TTL 以内のもの）。なければ None"""
+    weather = _last_known_weather.peek(weather_cell(lat, lon))
+    return dict(weather) if weather is not None else None
+
+def _parse_forecast(data):
+    return [
+        {
+            "dt": item["dt"],
+            "temperature": item["main"]["temp"],
+            "weather": item["weather"][0]["main"].lower(),
         }
+        for item in data.get("list", [])
+    ]
+
+async def afetch_forecast(lat, lon):
+    """
+    OpenWeather の5日間予報（3時間刻み）を取得する
+
+    Returns:
+        [{"dt": UNIX時刻, "temperature": 気温, "weather": 天気}] 失敗時は None
+    """
+    API_KEY = os.getenv("OPENWEATHER_API_KEY")
+    if not API_KEY:
+        raise ValueError("OPENWEATHER_API_KEY is not set in environment variables")
+
+    url = f"{OPENWEATHER_BASE_URL}/data/2.5/forecast"
+    try:
+        with guarded_call("openweather_forecast", 10) as call, track_call("openweather_forecast"):
+            response = await asyncio.wait_for(
+                get_async_client().get(url, params=_weather_params(lat, lon, API_KEY), timeout=call.timeout),
+                call.timeout,
+            )
+            response.raise_for_status()
+            return _parse_forecast(response.json())
     except Exception as e:
-        print(f"天気情報の取得に失敗: {e}")
+        log_event("weather_fetch_failed", service="openweather_forecast", error=str(e))
         return None
 
-def create_training_data():
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
+def pick_forecast(entries, when, max_gap_hours=1.5):
+    """
+    when（ローカル時刻）に最も近い予報を天気情報の形で返す（離れすぎていれば None）
+    """
+    if not entries:
+        return None
+    target = when.timestamp()
+    nearest = min(entries, key=lambda e: abs(e["dt"] - target))
+    if abs(nearest["dt"] - target) > max_gap_hours * 3600:
+        return None
+    return {"temperature": nearest["temperature"], "weather": nearest["weather"]}
+
+def weather_cache_stats():
+    stats = weather_cache.stats()
+    stats["grid_deg"] = WEATHER_GRID_DEG
+    stats["coalesced"] = _weather_flight.shared + _async_weather_flight.shared
+    return stats
+
+# 学習データ抽出で一度に読み込む行数
+TRAINING_FETCH_CHUNK = int(os.getenv("TRAINING_FETCH_CHUNK", "5000"))
 
-    cursor.execute("""
-        SELECT c.user_id, c.clothing_item_name, c.created_at, i.category
-        FROM user_clothing_choices c
-        JOIN clothing_items i ON c.clothing_item_name = i.name
-        ORDER BY c.created_at
-    """)
-    choices = cursor.fetchall()
+_TRAINING_DATA_SQL = """
+    SELECT c.user_id, i.name AS clothing_item_name, c.created_at, i.category,
+           c.weather, c.temperature
+    FROM user_clothing_choices c
+    JOIN clothing_items i ON c.clothing_id = i.clothing_id
+    WHERE c.weather IS NOT NULL AND c.temperature IS NOT NULL
+    ORDER BY c.created_at
+"""
 
-    training_data = []
+def iter_training_data(chunk_size=TRAINING_FETCH_CHUNK):
+    """
+    学習データを1クエリで取り出し、chunk_size 行ずつ (特徴量, ラベル) を返すジェネレータ
 
-    for choice in choices:
+    天気・気温は選択時に user_clothing_choices へ保存された値を使う
+    （過去の選択に対して現在の天気を引かない）。
+    サーバー側カーソル（unbuffered）で読むので全件をメモリに載せない。
+    """
+    with connection() as conn:
+        cursor = conn.cursor(dictionary=True, buffered=False)
         try:
-            user_id = choice["user_id"]
-            chosen_item = choice["clothing_item_name"]
-            category = choice["category"]
-            choice_time = choice["created_at"]
-
-            # 最新の位置情報を取得（選択時点以前）
-            cursor.execute("""
-                SELECT * FROM user_locations
-                WHERE user_id=%s AND created_at <= %s
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (user_id, choice_time))
-            location = cursor.fetchone()
-            if not location:
-                continue
-
-            weather = fetch_weather(location["latitude"], location["longitude"])
-            if not weather:
-                continue
-
-            features = {
-                "temperature": weather["temperature"],
-                "weather": weather["weather"],  # ← 数値ではなく文字列
-                "user_id": user_id,
-                "month": choice_time.month,
-                "day": choice_time.day,
-                "hour": choice_time.hour,
-                "weekday": choice_time.weekday(),
-                "category": category,
-            }
-
-            training_data.append((features, chosen_item))
-        except Exception as e:
-            print(f"データ処理中にエラー: {e}")
-            continue
-
-    conn.close()
-    return training_data
+            cursor.execute(_TRAINING_DATA_SQL)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    choice_time = row["created_at"]
+                    features = {
+                        "temperature": row["temperature"],
+                        "weather": row["weather"],  # ← 数値ではなく文字列
+                        "user_id": row["user_id"],
+                        "month": choice_time.month,
+                        "day": choice_time.day,
+                        "hour": choice_time.hour,
+                        "weekday": choice_time.weekday(),
+                        "category": row["category"],
+                    }
+                    yield features, row["clothing_item_name"]
+        finally:
+            # 途中で打ち切られた場合も残りの結果を読み捨ててから接続をプールに返す
+            if conn.unread_result:
+                conn.consume_results()
+            cursor.close()
+
+def create_training_data():
+    return list(iter_training_data())
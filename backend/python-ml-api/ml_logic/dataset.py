@@ -0,0 +1,171 @@
+import glob
+import json
+import os
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# 学習データの列（特徴量の定義を変えても作り直さずに済むよう、加工前の値を持つ）
+COLUMNS = ["id", "user_id", "created_at", "category", "label", "weather", "temperature"]
+
+# カテゴリ値は辞書エンコードして保存する
+DICTIONARY_COLUMNS = ["category", "label", "weather"]
+
+SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("created_at", pa.timestamp("s")),
+    ("category", pa.dictionary(pa.int32(), pa.string())),
+    ("label", pa.dictionary(pa.int32(), pa.string())),
+    ("weather", pa.dictionary(pa.int32(), pa.string())),
+    ("temperature", pa.float32()),
+])
+
+STATE_FILE = "_state.json"
+
+# パーティション列は文字列のまま扱う（"YYYY-MM-DD" は文字列比較で日付順になる）
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+
+class TrainingDataset:
+    """
+    学習データの列指向キャッシュ（Parquet, 日付パーティション）
+
+        <root>/date=2025-07-13/part-00003-00000.parquet
+        <root>/_state.json  … 取り込み済みのウォーターマーク (created_at, id)
+
+    - MySQL からは前回のウォーターマーク以降の行だけを追記する
+    - 読み込みはバッチ単位（iter_batches）で、全件を一度に Python オブジェクトにしない
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    # --- 状態 ---
+
+    def _state_path(self) -> str:
+        return os.path.join(self.root, STATE_FILE)
+
+    def load_state(self) -> Dict[str, Any]:
+        try:
+            with open(self._state_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"watermark": None, "sync_seq": 0, "rows": 0}
+
+    def _save_state(self, state: Dict[str, Any]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._state_path())
+
+    @property
+    def watermark(self):
+        """取り込み済みの最新行 (created_at, id)。未取り込みなら None"""
+        mark = self.load_state()["watermark"]
+        if mark is None:
+            return None
+        return datetime.fromisoformat(mark["created_at"]), mark["id"]
+
+    # --- 書き込み ---
+
+    def _remove_orphans(self, seq: int) -> None:
+        # 前回の取り込みが途中で落ちた場合、状態に反映されていない part を消す
+        for path in glob.glob(os.path.join(self.root, "date=*", "part-*.parquet")):
+            file_seq = int(os.path.basename(path).split("-")[1])
+            if file_seq >= seq:
+                os.remove(path)
+
+    def _write_part(self, date: str, seq: int, index: int, rows: List[Dict[str, Any]]) -> None:
+        columns = {name: [row[name] for row in rows] for name in COLUMNS}
+        arrays = []
+        for field in SCHEMA:
+            if field.name in DICTIONARY_COLUMNS:
+                arrays.append(pa.array(columns[field.name], type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(columns[field.name], type=field.type))
+        table = pa.Table.from_arrays(arrays, schema=SCHEMA)
+
+        directory = os.path.join(self.root, f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.close(fd)
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, os.path.join(directory, f"part-{seq:05d}-{index:05d}.parquet"))
+
+    def append(self, chunks: Iterable[List[Dict[str, Any]]]) -> int:
+        """
+        (created_at, id) 順の行チャンクを日付パーティションに追記する
+
+        全チャンクを書き終えてからウォーターマークを進めるので、
+        途中で失敗しても次回の取り込みで同じ行からやり直せる
+
+        Returns:
+            追記した行数
+        """
+        state = self.load_state()
+        seq = state["sync_seq"] + 1
+        self._remove_orphans(seq)
+
+        appended = 0
+        index = 0
+        last = None
+        for rows in chunks:
+            by_date = defaultdict(list)
+            for row in rows:
+                by_date[row["created_at"].date().isoformat()].append(row)
+            for date, date_rows in sorted(by_date.items()):
+                self._write_part(date, seq, index, date_rows)
+                index += 1
+            appended += len(rows)
+            if rows:
+                last = rows[-1]
+
+        if appended:
+            state.update({
+                "watermark": {"created_at": last["created_at"].isoformat(), "id": last["id"]},
+                "sync_seq": seq,
+                "rows": state["rows"] + appended,
+            })
+            self._save_state(state)
+        return appended
+
+    # --- 読み込み ---
+
+    def dataset(self) -> Optional[ds.Dataset]:
+        if not glob.glob(os.path.join(self.root, "date=*", "part-*.parquet")):
+            return None
+        return ds.dataset(self.root, format="parquet", partitioning=PARTITIONING)
+
+    def iter_batches(self, columns: Optional[List[str]] = None, since_date: Optional[str] = None,
+                     batch_size: int = 65536) -> Iterator[pa.RecordBatch]:
+        """
+        列・日付を絞ってバッチ単位で読む
+
+        Args:
+            since_date: "YYYY-MM-DD"。指定するとそれより前のパーティションは読まない
+        """
+        dataset = self.dataset()
+        if dataset is None:
+            return
+        flt = ds.field("date") >= since_date if since_date else None
+        yield from dataset.to_batches(columns=columns or COLUMNS, filter=flt, batch_size=batch_size)
+
+    def to_pandas(self, columns: Optional[List[str]] = None, since_date: Optional[str] = None) -> pd.DataFrame:
+        """
+        DataFrame として読む（辞書エンコード列は pandas の category 型になる）
+        """
+        batches = list(self.iter_batches(columns=columns, since_date=since_date))
+        if not batches:
+            return pd.DataFrame(columns=columns or COLUMNS)
+        df = pa.Table.from_batches(batches).unify_dictionaries().to_pandas()
+        if "created_at" in df and "id" in df:
+            df = df.sort_values(["created_at", "id"], kind="stable", ignore_index=True)
+        return df
@@ -0,0 +1,97 @@
+from datetime import datetime
+from typing import Any, Dict, List, Sequence
+
+
+# 学習時に使った特徴量の順序
+FEATURE_ORDER = ["weather", "user_id", "month", "day", "hour", "weekday", "temp_bin"]
+
+# 温度帯の幅（℃）。学習と推論の両方がここを参照する
+# （デプロイ済みのモデルは2℃刻みで学習されている）
+TEMP_BIN_WIDTH = 2
+
+
+def temp_bin(temperature: Any) -> str:
+    """気温を温度帯（文字列）に変換する"""
+    return str(int(float(temperature) // TEMP_BIN_WIDTH))
+
+
+def build_features(user_id: int, weather_data: dict, when: datetime) -> Dict[str, Any]:
+    """ユーザー・天気・日時から推論用の特徴量 dict を作る（when は推薦対象の日時）"""
+    features = dict(weather_data)
+    features["user_id"] = user_id
+    features.update({
+        "month": when.month,
+        "day": when.day,
+        "hour": when.hour,
+        "weekday": when.weekday(),
+    })
+    return features
+
+
+def build_feature_row(features: Dict[str, Any]) -> Dict[str, str]:
+    """
+    推論用の特徴量 dict をモデル入力（全カテゴリ共通の文字列特徴量）に変換する
+
+    Raises:
+        KeyError: 必要な特徴量が不足している場合
+    """
+    return {
+        "weather": str(features["weather"]),
+        "user_id": str(features["user_id"]),
+        "month": str(features["month"]),
+        "day": str(features["day"]),
+        "hour": str(features["hour"]),
+        "weekday": str(features["weekday"]),
+        "temp_bin": temp_bin(features["temperature"]),
+    }
+
+
+class FeatureEncoder:
+    """
+    学習済み OneHotEncoder(handle_unknown="ignore") と同じ変換を、語彙の表引きだけで行う
+
+    pandas / sklearn を通さず、特徴量 dict から OneHot の列番号（疎ベクトルの添字）を直接作る
+    """
+
+    def __init__(self, columns: Sequence[str], vocab: Dict[str, Dict[Any, int]]):
+        # columns: ColumnTransformer に渡した列順、vocab: 特徴量ごとの {値: OneHot 列番号}
+        self.columns = list(columns)
+        self.vocab = vocab
+        self.n_columns = sum(len(values) for values in vocab.values())
+        self._lookups = [vocab[column] for column in self.columns]
+
+    @classmethod
+    def from_categories(cls, columns: Sequence[str], categories: Sequence[Sequence[Any]]) -> "FeatureEncoder":
+        """OneHotEncoder.categories_ の並びから作る"""
+        vocab: Dict[str, Dict[Any, int]] = {}
+        offset = 0
+        for column, values in zip(columns, categories):
+            vocab[column] = {value: offset + i for i, value in enumerate(values)}
+            offset += len(values)
+        return cls(columns, vocab)
+
+    def indices(self, row: Dict[str, str]) -> List[int]:
+        """1行分の OneHot 列番号（昇順。未知値の特徴量は含めない）"""
+        out = []
+        for column, lookup in zip(self.columns, self._lookups):
+            col = lookup.get(row.get(column))
+            if col is not None:
+                out.append(col)
+        return out
+
+    def transform(self, rows: List[Dict[str, str]], sparse_output: bool = True):
+        """複数行を OneHot 行列（CSR または密行列）にする"""
+        # numpy / scipy は推論するときまで読み込まない（import main を軽くする）
+        import numpy as np
+        from scipy import sparse
+
+        indices = []
+        indptr = [0]
+        for row in rows:
+            indices.extend(self.indices(row))
+            indptr.append(len(indices))
+        X = sparse.csr_matrix(
+            (np.ones(len(indices)), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(rows), self.n_columns),
+        )
+        return X if sparse_output else X.toarray()
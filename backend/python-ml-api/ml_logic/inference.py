@@ -0,0 +1,208 @@
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from scipy import sparse
+
+from ml_logic.artifact import describe_pipeline
+from ml_logic.features import FEATURE_ORDER, FeatureEncoder, build_feature_row
+from ml_logic.model_registry import CATEGORIES, ModelBundle, registry
+
+
+class CompiledCategoryModel:
+    """
+    OneHot の語彙と分類器だけを持ち、DataFrame を経由せずに入力行列を組み立てる
+
+    学習済み Pipeline（from_pipeline）と推論用モデルファイル（from_artifact）のどちらからも作れる
+    """
+
+    def __init__(self, encoder: FeatureEncoder, classes: Any, sparse_output: bool, predict_index: Any):
+        self.encoder = encoder
+        # 出力列の並び（ColumnTransformer に渡した列順）と各特徴量の語彙
+        self.columns = encoder.columns
+        self.vocab = encoder.vocab
+        self.n_columns = encoder.n_columns
+        self.classes = np.asarray(classes)
+        self.sparse_output = sparse_output
+        self._predict_index = predict_index
+
+    @classmethod
+    def from_pipeline(cls, pipeline: Any, label_encoder: Any) -> "CompiledCategoryModel":
+        spec = describe_pipeline(pipeline)
+        encoder = FeatureEncoder.from_categories(spec["columns"], spec["categories"])
+        return cls(encoder, label_encoder.classes_, spec["sparse_output"], spec["classifier"].predict)
+
+    @classmethod
+    def from_artifact(cls, native: Any) -> "CompiledCategoryModel":
+        encoder = FeatureEncoder(native.columns, native.vocabulary())
+        return cls(encoder, native.classes, native.sparse_output, native.predict_index)
+
+    def predict_row(self, row: Dict[str, str]) -> Any:
+        """1行分の予測ラベル（語彙の表引きで直接 OneHot ベクトルを作る）"""
+        X = self.encoder.transform([row], sparse_output=self.sparse_output)
+        return self.classes[int(np.asarray(self._predict_index(X))[0])]
+
+    def predict_columns(self, cols: np.ndarray) -> np.ndarray:
+        """
+        各行の OneHot 列番号（未知値は -1）から予測ラベルを返す
+
+        Args:
+            cols: shape (行数, len(self.columns)) の列番号
+        """
+        n_rows = cols.shape[0]
+        mask = cols >= 0
+        if self.sparse_output:
+            indptr = np.concatenate(([0], np.cumsum(mask.sum(axis=1))))
+            indices = cols[mask]
+            X = sparse.csr_matrix(
+                (np.ones(len(indices)), indices, indptr), shape=(n_rows, self.n_columns)
+            )
+        else:
+            X = np.zeros((n_rows, self.n_columns))
+            rows = np.nonzero(mask)[0]
+            X[rows, cols[mask]] = 1.0
+        pred_index = np.asarray(self._predict_index(X)).astype(int)
+        return self.classes[pred_index]
+
+
+class InferenceEngine:
+    """
+    全カテゴリのモデルをまとめて推論するエンジン
+
+    特徴量はカテゴリ横断の語彙で一度だけ ID 化し、
+    各カテゴリでは ID → OneHot 列番号の表引きだけで入力を作る
+    """
+
+    def __init__(self, bundles: Dict[str, ModelBundle]):
+        self.bundles = bundles
+        self.compiled: Dict[str, CompiledCategoryModel] = {}
+        self.fallback: Dict[str, ModelBundle] = {}
+
+        for category, bundle in bundles.items():
+            try:
+                if bundle.artifact is not None:
+                    self.compiled[category] = CompiledCategoryModel.from_artifact(bundle.artifact)
+                else:
+                    self.compiled[category] = CompiledCategoryModel.from_pipeline(bundle.pipeline, bundle.label_encoder)
+            except Exception as e:
+                # 構成が読めないモデルは従来通り Pipeline.predict で推論する
+                print(f"⚠ 高速推論に未対応のため Pipeline で推論 [{category}]: {e}")
+                self.fallback[category] = bundle
+
+        # カテゴリ横断の語彙: 特徴量ごとに 値 → 共通ID
+        self.union_vocab: Dict[str, Dict[Any, int]] = {f: {} for f in FEATURE_ORDER}
+        for model in self.compiled.values():
+            for column, vocab in model.vocab.items():
+                ids = self.union_vocab.setdefault(column, {})
+                for value in vocab:
+                    ids.setdefault(value, len(ids))
+
+        # カテゴリごとの 共通ID → OneHot 列番号 の表（末尾は未知値用の -1）
+        self.remap: Dict[str, List[np.ndarray]] = {}
+        for category, model in self.compiled.items():
+            tables = []
+            for column in model.columns:
+                ids = self.union_vocab[column]
+                table = np.full(len(ids) + 1, -1, dtype=np.int64)
+                for value, col in model.vocab[column].items():
+                    table[ids[value]] = col
+                tables.append(table)
+            self.remap[category] = tables
+
+        self._feature_pos = {f: i for i, f in enumerate(self.union_vocab)}
+
+    def encode(self, rows: List[Dict[str, str]]) -> np.ndarray:
+        """入力行を共通ID行列 shape (行数, 特徴量数) に変換する（未知値は -1）"""
+        features = list(self.union_vocab)
+        uids = np.full((len(rows), len(features)), -1, dtype=np.int64)
+        for i, row in enumerate(rows):
+            for j, feature in enumerate(features):
+                uids[i, j] = self.union_vocab[feature].get(row.get(feature), -1)
+        return uids
+
+    def predict_rows(self, rows: List[Dict[str, str]],
+                     categories: Optional[Iterable[str]] = None) -> Dict[str, Optional[List[Any]]]:
+        """
+        複数行をまとめて推論する（カテゴリごとに predict は1回）
+
+        Returns:
+            {カテゴリ: 行ごとの予測ラベル} の辞書（モデルなし・失敗時は None）
+        """
+        categories = list(categories or CATEGORIES)
+        uids = self.encode(rows)
+        df = None
+        results: Dict[str, Optional[List[Any]]] = {}
+
+        for category in categories:
+            try:
+                if category in self.compiled:
+                    model = self.compiled[category]
+                    cols = np.column_stack([
+                        table[uids[:, self._feature_pos[column]]]
+                        for column, table in zip(model.columns, self.remap[category])
+                    ])
+                    results[category] = list(model.predict_columns(cols))
+                elif category in self.fallback:
+                    if df is None:
+                        import pandas as pd  # フォールバック時だけ必要なので遅延 import
+                        df = pd.DataFrame(rows, columns=FEATURE_ORDER)
+                    bundle = self.fallback[category]
+                    pred_index = bundle.pipeline.predict(df)
+                    results[category] = list(bundle.label_encoder.inverse_transform(pred_index))
+                else:
+                    results[category] = None
+            except Exception as e:
+                print(f"❌ 推論失敗 [{category}]: {e}")
+                results[category] = None
+        return results
+
+    def predict(self, features: Dict[str, Any],
+                categories: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+        """
+        1件の特徴量から全カテゴリの推薦をまとめて返す
+        """
+        categories = list(categories or CATEGORIES)
+        try:
+            row = build_feature_row(features)
+        except KeyError as e:
+            print(f"❌ 必要な特徴量が不足: {e}")
+            return {category: None for category in categories}
+
+        results: Dict[str, Optional[str]] = {}
+        rest = []
+        for category in categories:
+            model = self.compiled.get(category)
+            if model is None:
+                rest.append(category)
+                continue
+            try:
+                results[category] = model.predict_row(row)
+            except Exception as e:
+                print(f"❌ 推論失敗 [{category}]: {e}")
+                results[category] = None
+
+        # Pipeline でしか推論できないカテゴリ（とモデルがないカテゴリ）
+        if rest:
+            for category, labels in self.predict_rows([row], rest).items():
+                results[category] = labels[0] if labels else None
+        return {category: results[category] for category in categories}
+
+
+_engine: Optional[InferenceEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> InferenceEngine:
+    """
+    レジストリの現行モデルに対応するエンジンを返す
+    （モデルが差し替わったときだけ組み立て直す）
+    """
+    global _engine
+    bundles = registry.snapshot()
+    engine = _engine
+    if engine is None or engine.bundles is not bundles:
+        with _engine_lock:
+            if _engine is None or _engine.bundles is not bundles:
+                _engine = InferenceEngine(bundles)
+            engine = _engine
+    return engine
@@ -0,0 +1,272 @@
+import bisect
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# レイテンシ用のバケット境界（秒）。LLM 呼び出しが数秒かかるので上は 10 秒まで
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 構造化ログ（JSON 1行）を出すか
+STRUCTURED_LOGS = os.getenv("STRUCTURED_LOGS", "1") == "1"
+
+logger = logging.getLogger("suggest")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.propagate = False
+
+# リクエスト単位の文脈（asyncio のタスクや run_in_threadpool にも引き継がれる）
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_stage_times_var: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("stage_times", default=None)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """単調増加のカウンター（ラベル付き）"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    バケット付きヒストグラム（ラベル付き）
+
+    observe はバケット位置の二分探索と加算だけなので、本番でも常時有効にしておける
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels → [バケットごとの件数..., +Inf の件数, 合計値]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return int(sum(series[:-1])) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    メトリクスの登録先。/metrics で Prometheus のテキスト形式に書き出す
+
+    キャッシュや接続プールのように既に自前で数えている値は、
+    スクレイプ時に呼ぶコールバック（gauge）として登録する
+    """
+
+    def __init__(self):
+        self._metrics: List = []
+        # 名前 → (説明, ラベル名, コールバック一覧)。同じ名前の gauge はまとめて書き出す
+        self._gauges: Dict[str, Tuple[str, Tuple[str, ...], List[Callable]]] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name: str, documentation: str, labelnames: Sequence[str],
+                       collect: Callable[[], Iterable[Tuple[Sequence[str], float]]]) -> None:
+        """collect() は (ラベル値の並び, 値) を返す"""
+        entry = self._gauges.setdefault(name, (documentation, tuple(labelnames), []))
+        entry[2].append(collect)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, (documentation, labelnames, collectors) in self._gauges.items():
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge"])
+            for collect in collectors:
+                try:
+                    samples = list(collect())
+                except Exception as e:  # 1つの取得失敗で /metrics 全体を落とさない
+                    logger.warning(json.dumps({"event": "metrics_collect_failed", "metric": name, "error": str(e)}))
+                    continue
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "HTTP リクエストの処理時間", ("route", "method", "status"))
+stage_duration = metrics.histogram(
+    "suggest_stage_duration_seconds", "/suggest の各段階の処理時間", ("stage",))
+stage_errors = metrics.counter(
+    "suggest_stage_errors_total", "/suggest の各段階で発生した例外の数", ("stage",))
+external_call_duration = metrics.histogram(
+    "external_call_duration_seconds", "外部 API 呼び出しの所要時間", ("service",))
+external_call_errors = metrics.counter(
+    "external_call_errors_total", "外部 API 呼び出しの失敗数", ("service", "reason"))
+cache_lookups = metrics.counter(
+    "cache_lookups_total", "キャッシュの参照結果（gauge を持たないキャッシュ用）", ("cache", "result"))
+
+
+def _record_stage(stage: str, elapsed: float) -> None:
+    stage_duration.observe(elapsed, stage)
+    times = _stage_times_var.get()
+    if times is not None:
+        times[stage] = times.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    with ブロックの所要時間を段階として記録する（同期・非同期どちらの中でも使える）
+
+    例外は数えてそのまま送出する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage)
+        raise
+    finally:
+        _record_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def track_call(service: str):
+    """
+    外部 API 呼び出し1回分の所要時間と失敗を記録する
+
+    呼び出し側の try の内側で使い、例外の種類を失敗理由として数える
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        external_call_errors.inc(service, type(e).__name__)
+        log_event("external_call_failed", service=service, error=str(e))
+        raise
+    finally:
+        external_call_duration.observe(time.perf_counter() - start, service)
+
+
+def record_call_failure(service: str, reason: str) -> None:
+    """例外にならない失敗（API のエラーステータスなど）を数える"""
+    external_call_errors.inc(service, reason)
+
+
+def log_event(event: str, **fields) -> None:
+    """リクエスト ID 付きの JSON 1行ログ"""
+    if not STRUCTURED_LOGS:
+        return
+    record = {"event": event, "request_id": request_id_var.get()}
+    record.update(fields)
+    logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def request_context(request_id: str):
+    """
+    リクエスト ID と段階ごとの所要時間を集める文脈を設定する
+
+    Yields:
+        段階名 → 合計秒 の辞書（リクエスト終了時のログに使う）
+    """
+    id_token = request_id_var.set(request_id)
+    stages: Dict[str, float] = {}
+    stages_token = _stage_times_var.set(stages)
+    try:
+        yield stages
+    finally:
+        _stage_times_var.reset(stages_token)
+        request_id_var.reset(id_token)
+
+
+def register_cache(name: str, stats: Callable[[], dict]) -> None:
+    """TTLCache.stats() 形式の辞書を返すキャッシュを gauge として登録する"""
+    fields = [("hits", "cache_hits"), ("misses", "cache_misses"), ("evictions", "cache_evictions"),
+              ("size", "cache_entries"), ("hit_ratio", "cache_hit_ratio")]
+    for key, metric_name in fields:
+        metrics.gauge_callback(
+            metric_name, f"キャッシュの {key}", ("cache",),
+            lambda key=key: [((name,), stats()[key])],
+        )
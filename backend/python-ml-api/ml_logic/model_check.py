@@ -0,0 +1,284 @@
+"""
+モデルの性能測定と回帰ゲート
+
+カテゴリごとに、候補のモデル（再学習したもの）とデプロイ済みのモデルを同じ条件で測って比べる。
+
+- モデルファイルのサイズ
+- 読み込み時間と、読み込み後の常駐メモリ（RSS の増分）
+- 1行推論・まとめて推論のレイテンシ（API と同じ ModelRegistry / InferenceEngine を通す）
+- 学習データセットの held-out（カテゴリごとに新しい側 CHECK_HOLDOUT_FRACTION の行）での精度
+
+読み込み時間・メモリが前の測定に左右されないよう、1モデルずつ新しいプロセス（spawn）で測る。
+サイズ・読み込み時間・レイテンシ・メモリ・精度のどれかがしきい値を超えて悪化したら不合格にする。
+
+held-out の行は候補の学習には使わないが、デプロイ済みのモデルは学習時に見ていることがある
+（その分デプロイ済みの精度が高めに出るので、ゲートは厳しめに働く）。
+
+    python check_model.py                                  # デプロイ済みモデルを測るだけ
+    python check_model.py --candidate models/candidate    # 候補と比べて、悪化していれば終了コード 1
+"""
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ml_logic.features import FEATURE_ORDER
+
+# カテゴリごとに新しい側のこの割合を精度の検証に使う（ゲートを使う学習ではこの行を学習に使わない）
+CHECK_HOLDOUT_FRACTION = float(os.getenv("CHECK_HOLDOUT_FRACTION", "0.1"))
+# 1行推論のレイテンシを測る回数 / まとめて推論の行数
+CHECK_ITERATIONS = int(os.getenv("CHECK_ITERATIONS", "300"))
+CHECK_BATCH_SIZE = int(os.getenv("CHECK_BATCH_SIZE", "256"))
+
+# 悪化の許容幅（デプロイ済みに対する割合 + 測定の揺れを吸収する絶対値）
+CHECK_MAX_LATENCY_REGRESSION = float(os.getenv("CHECK_MAX_LATENCY_REGRESSION", "0.25"))
+CHECK_LATENCY_SLACK_MS = float(os.getenv("CHECK_LATENCY_SLACK_MS", "0.05"))
+CHECK_MAX_RSS_REGRESSION = float(os.getenv("CHECK_MAX_RSS_REGRESSION", "0.25"))
+CHECK_RSS_SLACK_MB = float(os.getenv("CHECK_RSS_SLACK_MB", "2"))
+# サイズは学習データが増えれば自然に大きくなるので、割合は緩めにしておく
+CHECK_MAX_SIZE_REGRESSION = float(os.getenv("CHECK_MAX_SIZE_REGRESSION", "0.5"))
+CHECK_SIZE_SLACK_KB = float(os.getenv("CHECK_SIZE_SLACK_KB", "64"))
+# 読み込み時間はディスクキャッシュの状態で揺れるので、絶対値の幅を大きめに取る
+CHECK_MAX_LOAD_REGRESSION = float(os.getenv("CHECK_MAX_LOAD_REGRESSION", "0.5"))
+CHECK_LOAD_SLACK_MS = float(os.getenv("CHECK_LOAD_SLACK_MS", "20"))
+# 精度はデプロイ済みからこのポイント数（0〜1）まで下がってよい
+CHECK_MAX_ACCURACY_DROP = float(os.getenv("CHECK_MAX_ACCURACY_DROP", "0.01"))
+
+
+def split_holdout(frame, fraction: Optional[float] = None):
+    """
+    カテゴリごとに新しい側 fraction の行を検証用に分ける（frame は (created_at, id) 順）
+
+    Returns:
+        (学習用の行, 検証用の行)
+    """
+    fraction = CHECK_HOLDOUT_FRACTION if fraction is None else fraction
+    groups = frame.groupby("category", observed=True, sort=False)
+    position_from_end = groups.cumcount(ascending=False)
+    n_holdout = (groups["category"].transform("size") * fraction).astype(int)
+    held = position_from_end < n_holdout
+    return frame[~held].reset_index(drop=True), frame[held].reset_index(drop=True)
+
+
+def holdout_examples(df) -> Tuple[List[Dict[str, str]], List[str]]:
+    """特徴量 + label 列の DataFrame を (推論用の行, 正解ラベル) にする"""
+    if df is None or len(df) == 0:
+        return [], []
+    rows = df[FEATURE_ORDER].astype(str).to_dict("records")
+    return rows, df["label"].astype(str).tolist()
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # /proc がない環境では最大 RSS で代用（Linux は KiB 単位）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile_ms(samples: List[float], q: float) -> float:
+    return float(np.percentile(samples, q) * 1000)
+
+
+def _probe_rows(engine: Any, n: int) -> List[Dict[str, str]]:
+    """モデルの語彙を巡回して n 行の入力を作る"""
+    values = {feature: list(vocab) or [""] for feature, vocab in engine.union_vocab.items()}
+    return [{feature: vs[i % len(vs)] for feature, vs in values.items()} for i in range(n)]
+
+
+def _measure(model_dir: str, category: str, rows: List[Dict[str, str]], labels: List[str],
+             iterations: int, batch_size: int) -> Optional[Dict[str, Any]]:
+    """（測定用プロセスで実行）1カテゴリのモデルを読み込んで測る。モデルがなければ None"""
+    # ライブラリの読み込み分はモデルのメモリに数えない
+    import joblib  # noqa: F401
+    import xgboost  # noqa: F401
+    from ml_logic.inference import InferenceEngine
+    from ml_logic.model_registry import ModelRegistry, model_path
+
+    registry = ModelRegistry(model_dir, [category])
+    path, signature = registry._source(category)
+    if signature is None:
+        return None
+
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    bundle = registry._load_one(category)
+    if bundle is None:
+        raise RuntimeError(f"モデルを読み込めません: {path}")
+    engine = InferenceEngine({category: bundle})
+    load_seconds = time.perf_counter() - start
+    rss_delta = _rss_bytes() - rss_before
+    if bundle.artifact is None and path.endswith(".bin"):
+        path = model_path(category, model_dir)  # .bin が読めず .pkl で読み込んだ
+
+    result = {
+        "path": path,
+        "format": "bin" if bundle.artifact is not None else "pkl",
+        "artifact_bytes": os.path.getsize(path),
+        "load_ms": round(load_seconds * 1000, 3),
+        "rss_mb": round(rss_delta / 1024 / 1024, 3),
+        "accuracy": None,
+        "n_holdout": len(rows),
+    }
+    # 学習データがなくてもレイテンシは測れるよう、語彙から入力行を作る
+    probe = rows or _probe_rows(engine, batch_size)
+
+    # 1行推論（/suggest と同じく1件ずつ）
+    single = []
+    for i in range(iterations + 10):
+        row = probe[i % len(probe)]
+        start = time.perf_counter()
+        engine.predict_rows([row], [category])
+        if i >= 10:  # 最初の数回は暖機
+            single.append(time.perf_counter() - start)
+    result["single_p50_ms"] = round(_percentile_ms(single, 50), 4)
+    result["single_p95_ms"] = round(_percentile_ms(single, 95), 4)
+
+    # まとめて推論（事前計算・バッチ API と同じく複数行を1回で）
+    batch = [probe[i % len(probe)] for i in range(batch_size)]
+    batched = []
+    for i in range(max(10, iterations // 10) + 2):
+        start = time.perf_counter()
+        engine.predict_rows(batch, [category])
+        if i >= 2:
+            batched.append(time.perf_counter() - start)
+    result["batch_p50_ms"] = round(_percentile_ms(batched, 50), 4)
+    result["batch_row_us"] = round(_percentile_ms(batched, 50) * 1000 / batch_size, 3)
+
+    if not rows:
+        return result
+    predicted = engine.predict_rows(rows, [category])[category]
+    if predicted is not None:
+        result["accuracy"] = round(float(np.mean([p == l for p, l in zip(predicted, labels)])), 4)
+    return result
+
+
+def measure_model(model_dir: str, category: str, rows: Optional[List[Dict[str, str]]] = None,
+                  labels: Optional[List[str]] = None, iterations: Optional[int] = None,
+                  batch_size: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    model_dir のカテゴリのモデルを新しいプロセスで読み込んで測る
+
+    Returns:
+        測定結果（モデルファイルがなければ None）
+
+    Raises:
+        RuntimeError: モデルファイルはあるが読み込めない場合
+    """
+    # 学習側のスレッド（OpenMP）を引き継がないよう fork ではなく spawn で起動する
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(
+            _measure, model_dir, category, rows or [], labels or [],
+            iterations or CHECK_ITERATIONS, batch_size or CHECK_BATCH_SIZE,
+        ).result()
+
+
+def _regressed(candidate: float, deployed: float, ratio: float, slack: float) -> bool:
+    return candidate > deployed * (1 + ratio) + slack
+
+
+def compare(candidate: Dict[str, Any], deployed: Optional[Dict[str, Any]]) -> List[str]:
+    """候補がデプロイ済みよりしきい値を超えて悪化している項目（なければ空）"""
+    if deployed is None:
+        return []
+    failures = []
+    if _regressed(candidate["artifact_bytes"], deployed["artifact_bytes"],
+                  CHECK_MAX_SIZE_REGRESSION, CHECK_SIZE_SLACK_KB * 1024):
+        failures.append(f"artifact_bytes: {deployed['artifact_bytes']} → {candidate['artifact_bytes']}")
+    if _regressed(candidate["load_ms"], deployed["load_ms"], CHECK_MAX_LOAD_REGRESSION, CHECK_LOAD_SLACK_MS):
+        failures.append(f"load_ms: {deployed['load_ms']} → {candidate['load_ms']}")
+    for key in ("single_p95_ms", "batch_p50_ms"):
+        if key in candidate and key in deployed and _regressed(
+            candidate[key], deployed[key], CHECK_MAX_LATENCY_REGRESSION, CHECK_LATENCY_SLACK_MS,
+        ):
+            failures.append(f"{key}: {deployed[key]} → {candidate[key]}")
+    if _regressed(candidate["rss_mb"], deployed["rss_mb"], CHECK_MAX_RSS_REGRESSION, CHECK_RSS_SLACK_MB):
+        failures.append(f"rss_mb: {deployed['rss_mb']} → {candidate['rss_mb']}")
+    if candidate["accuracy"] is not None and deployed["accuracy"] is not None and (
+        candidate["accuracy"] < deployed["accuracy"] - CHECK_MAX_ACCURACY_DROP
+    ):
+        failures.append(f"accuracy: {deployed['accuracy']} → {candidate['accuracy']}")
+    return failures
+
+
+def check_category(category: str, candidate_dir: str, deployed_dir: str,
+                   rows: Optional[List[Dict[str, str]]] = None,
+                   labels: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    候補とデプロイ済みのモデルを測って比べる（デプロイ済みがなければ候補が読めれば合格）
+
+    Returns:
+        {"category", "candidate", "deployed", "failures", "passed"}
+    """
+    deployed = None
+    try:
+        deployed = measure_model(deployed_dir, category, rows, labels)
+    except Exception as e:
+        # 今のモデルが壊れているなら比べる相手はいない
+        print(f"⚠ デプロイ済みモデルを測れません [{category}]: {e}", flush=True)
+    try:
+        candidate = measure_model(candidate_dir, category, rows, labels)
+    except Exception as e:
+        candidate = None
+        failures = [f"候補モデルを読み込めません: {e}"]
+    else:
+        failures = ["候補モデルがありません"] if candidate is None else compare(candidate, deployed)
+    return {
+        "category": category,
+        "candidate": candidate,
+        "deployed": deployed,
+        "failures": failures,
+        "passed": not failures,
+    }
+
+
+def check_candidate(category: str, pipeline: Any, label_encoder: Any, deployed_dir: str,
+                    holdout=None) -> Dict[str, Any]:
+    """
+    学習直後のモデルを deployed_dir 内の一時ディレクトリに .pkl / .bin で書き出し、デプロイ済みと比べる
+    （学習スクリプトが上書き前に呼ぶ）
+
+    Args:
+        category: モデルファイル名のカテゴリ（tops など）
+        holdout: 精度を測る行（学習に使っていない、特徴量 + label 列の DataFrame）
+    """
+    import joblib
+    from ml_logic.artifact import write_artifact
+    from ml_logic.model_registry import artifact_path, model_path
+
+    staging = tempfile.mkdtemp(dir=deployed_dir, prefix=".candidate-")
+    try:
+        joblib.dump((pipeline, label_encoder), model_path(category, staging))
+        write_artifact(artifact_path(category, staging), pipeline, label_encoder, category)
+        rows, labels = holdout_examples(holdout)
+        return check_category(category, staging, deployed_dir, rows, labels)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def format_measurement(m: Optional[Dict[str, Any]]) -> str:
+    if m is None:
+        return "なし"
+    accuracy = "-" if m["accuracy"] is None else f"{m['accuracy']:.4f}"
+    latency = ""
+    if "single_p95_ms" in m:
+        latency = (f" | 1行 p50 {m['single_p50_ms']:.3f} / p95 {m['single_p95_ms']:.3f} ms"
+                   f" | {CHECK_BATCH_SIZE}行 {m['batch_p50_ms']:.2f} ms ({m['batch_row_us']:.1f} µs/行)")
+    return (f"{m['format']} {m['artifact_bytes'] / 1024:.1f} KiB | 読み込み {m['load_ms']:.1f} ms"
+            f" | RSS +{m['rss_mb']:.1f} MB{latency} | 精度 {accuracy}（{m['n_holdout']} 件）")
+
+
+def print_check(result: Dict[str, Any]) -> None:
+    mark = "✅" if result["passed"] else "❌"
+    print(f"{mark} [{result['category']}]", flush=True)
+    print(f"   デプロイ済み: {format_measurement(result['deployed'])}", flush=True)
+    print(f"   候補        : {format_measurement(result['candidate'])}", flush=True)
+    for failure in result["failures"]:
+        print(f"   ⚠ 悪化: {failure}", flush=True)
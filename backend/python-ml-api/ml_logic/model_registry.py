@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+# モデルを持つカテゴリ一覧
+CATEGORIES = ["bottoms", "shoes", "outer", "tops", "accessory"]
+
+# モデル置き場（起動ディレクトリ基準）
+MODEL_DIR = os.getenv("MODEL_DIR", "models")
+
+# 何秒おきにモデルファイルの更新を確認するか（0以下で毎回確認）
+RELOAD_CHECK_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "30"))
+
+# 読み込むモデル形式: auto（.bin が .pkl 以降に書かれていれば .bin）/ pickle（常に .pkl）
+MODEL_FORMAT = os.getenv("MODEL_FORMAT", "auto")
+
+
+class ModelBundle(NamedTuple):
+    pipeline: Any
+    label_encoder: Any
+    # (mtime_ns, size) — ファイルが差し替わったかの判定に使う
+    signature: Tuple[int, int]
+    # .bin から読んだ場合の NativeModel（このとき pipeline / label_encoder は None）
+    artifact: Any = None
+
+
+def model_path(category: str, model_dir: str = MODEL_DIR) -> str:
+    return os.path.join(model_dir, f"{category}_model.pkl")
+
+
+def artifact_path(category: str, model_dir: str = MODEL_DIR) -> str:
+    return os.path.join(model_dir, f"{category}_model.bin")
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def unpack_bundle(bundle: Any) -> Optional[Tuple[Any, Any]]:
+    """.pkl の中身（(pipeline, label_encoder) のタプル、または dict）を取り出す"""
+    if isinstance(bundle, dict):
+        return bundle["model"], bundle["label_encoder"]
+    if isinstance(bundle, tuple) and len(bundle) == 2:
+        return bundle[0], bundle[1]
+    return None
+
+
+class ModelRegistry:
+    """
+    カテゴリ別モデルをプロセス内で1つだけ保持するレジストリ
+
+    - 起動時に load_all() で全カテゴリを読み込む
+    - get() のたびに（RELOAD_CHECK_INTERVAL 秒間隔で）ファイルの mtime を確認し、
+      再学習でモデルファイル（.bin / .pkl）が差し替わっていれば読み込み直す
+    - 差し替えは新しい dict を組み立ててから参照を入れ替えるだけなので、
+      処理中のリクエストが読み込み途中のモデルを見ることはない
+    """
+
+    def __init__(self, model_dir: str = MODEL_DIR, categories=CATEGORIES,
+                 check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.model_dir = model_dir
+        self.categories = list(categories)
+        self.check_interval = check_interval
+        self._bundles: Dict[str, ModelBundle] = {}
+        self._reload_lock = threading.Lock()
+        self._last_check = 0.0
+        self._loaded = False
+
+    def _source(self, category: str) -> Tuple[str, Optional[Tuple[int, int]]]:
+        """読み込むファイルとそのシグネチャ（.bin が .pkl と同時かそれ以降に書かれていれば .bin）"""
+        pkl = model_path(category, self.model_dir)
+        pkl_signature = _file_signature(pkl)
+        if MODEL_FORMAT != "pickle":
+            binary = artifact_path(category, self.model_dir)
+            binary_signature = _file_signature(binary)
+            if binary_signature is not None and (
+                pkl_signature is None or binary_signature[0] >= pkl_signature[0]
+            ):
+                return binary, binary_signature
+        return pkl, pkl_signature
+
+    def _load_one(self, category: str) -> Optional[ModelBundle]:
+        path, signature = self._source(category)
+        if signature is None:
+            print(f"⚠ モデルファイルが見つかりません: {path}")
+            return None
+
+        if path.endswith(".bin"):
+            try:
+                from ml_logic.artifact import NativeModel
+                return ModelBundle(None, None, signature, NativeModel(path))
+            except Exception as e:
+                # 読めなければ .pkl で続ける
+                print(f"⚠ モデルファイル読み込み失敗のため .pkl を使用 [{category}]: {e}")
+                path = model_path(category, self.model_dir)
+                signature = _file_signature(path)
+                if signature is None:
+                    return None
+
+        try:
+            import joblib  # 起動時の import を軽くするため、実際に読み込むときまで遅らせる
+            unpacked = unpack_bundle(joblib.load(path))
+        except Exception as e:
+            print(f"❌ モデル読み込み失敗 [{category}]: {e}")
+            return None
+
+        if unpacked is None:
+            print(f"❌ 想定外のモデル形式 [{category}]")
+            return None
+
+        pipeline, label_encoder = unpacked
+        return ModelBundle(pipeline, label_encoder, signature)
+
+    def load_all(self) -> Dict[str, ModelBundle]:
+        """全カテゴリを読み込み直してまとめて差し替える"""
+        with self._reload_lock:
+            bundles = {}
+            for category in self.categories:
+                bundle = self._load_one(category)
+                if bundle is not None:
+                    bundles[category] = bundle
+            self._bundles = bundles
+            self._last_check = time.monotonic()
+            self._loaded = True
+            print(f"✅ モデル読み込み完了: {sorted(bundles)}")
+            return bundles
+
+    def refresh(self) -> bool:
+        """
+        mtime / サイズが変わったカテゴリだけ読み込み直す
+
+        Returns:
+            1つでも差し替えたら True
+        """
+        # 他スレッドが再読み込み中なら待たずに現行モデルで応答する
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            current = self._bundles
+            updated = {}
+            for category in self.categories:
+                _, signature = self._source(category)
+                old = current.get(category)
+                if signature is None or (old is not None and old.signature == signature):
+                    continue
+                bundle = self._load_one(category)
+                # 書き込み途中などで読めなかった場合は旧モデルのまま次回に再試行
+                if bundle is not None:
+                    updated[category] = bundle
+                    print(f"🔄 モデル再読み込み [{category}]")
+
+            if not updated:
+                return False
+            bundles = dict(current)
+            bundles.update(updated)
+            self._bundles = bundles
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def _maybe_refresh(self) -> None:
+        if not self._loaded:
+            self.load_all()
+            return
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+
+    def snapshot(self) -> Dict[str, ModelBundle]:
+        """
+        現在のモデル一式を返す（1リクエスト内で一貫したモデルを使うため）
+        """
+        self._maybe_refresh()
+        return self._bundles
+
+    def get(self, category: str) -> Optional[ModelBundle]:
+        return self.snapshot().get(category)
+
+    @property
+    def loaded_categories(self):
+        return sorted(self._bundles)
+
+
+# ワーカー内で共有するレジストリ
+registry = ModelRegistry()
@@ -1,54 +1,268 @@
+import asyncio
+import json
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
 import requests
 import urllib3
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from ml_logic.cache import TTLCache
+from ml_logic.clients import get_async_client
+from ml_logic.metrics import cache_lookups, log_event, record_call_failure, track_call
+from ml_logic.resilience import guarded_call
 
 # SSL警告を無効化（ローカル用途）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# .env読み込み
-load_dotenv()
+# .env は起動スクリプト（main.py など）で読み込み済みの前提
 PIXABAY_API_KEY = os.getenv("PIXABAY_API_KEY")
+PIXABAY_API_URL = os.getenv("PIXABAY_API_URL", "https://pixabay.com/api/")
+PIXABAY_TIMEOUT = float(os.getenv("PIXABAY_TIMEOUT", "3"))
+# 画像が用意できないとき（縮退応答）に返す画像 URL
+PIXABAY_PLACEHOLDER_URL = os.getenv("PIXABAY_PLACEHOLDER_URL", "")
 
-def search_pixabay_image(query: str) -> str:
-    """
-    Pixabay API を使って画像を1件だけ取得し、画像URLを返す。
-    """
-    if not PIXABAY_API_KEY:
-        print("❌ Pixabay APIキーが設定されていません (.env の PIXABAY_API_KEY を確認してください)")
-        return ""
+# キーワード → 画像URL のキャッシュ（SQLite ファイルなので再起動後も uvicorn ワーカー間でも共有される）
+PIXABAY_CACHE_PATH = os.getenv("PIXABAY_CACHE_PATH", "cache/pixabay_cache.sqlite3")
+# この秒数を過ぎたエントリは古いものを返しつつ裏で取り直す
+PIXABAY_CACHE_TTL = float(os.getenv("PIXABAY_CACHE_TTL", str(7 * 24 * 3600)))
+# この秒数を過ぎたエントリは使わずに取り直す
+PIXABAY_CACHE_MAX_STALE = float(os.getenv("PIXABAY_CACHE_MAX_STALE", str(30 * 24 * 3600)))
+# SQLite の手前に置くプロセス内キャッシュの件数
+# （SQLite は他のワーカーが書き込み中だと最大5秒待つので、イベントループ上ではこちらだけを引く）
+PIXABAY_MEMORY_CACHE_SIZE = int(os.getenv("PIXABAY_MEMORY_CACHE_SIZE", "2000"))
 
+# 接続を使い回すための共有セッション
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("PIXABAY_POOL_SIZE", "10"))))
+_session.verify = False
+
+_local = threading.local()
+# キー → (画像URL一覧, 取得時刻)
+_memory = TTLCache(maxsize=PIXABAY_MEMORY_CACHE_SIZE, ttl=PIXABAY_CACHE_MAX_STALE)
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pixabay-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def normalize_query(query: str) -> str:
     # 前処理: 全角スペース → 半角、最大3語に制限
     safe_query = query.replace("　", " ").strip()
     keywords = safe_query.split()
-    limited_query = " ".join(keywords[:3])  # 最大3語
+    return " ".join(keywords[:3])  # 最大3語
 
-    if not limited_query:
-        print("⚠️ 空の検索クエリです")
-        return ""
+def cache_key(limited_query: str) -> str:
+    """語順・大文字小文字・重複を無視したキーワード集合をキーにする"""
+    return " ".join(sorted(set(limited_query.lower().split())))
 
-    url = "https://pixabay.com/api/"
-    params = {
+def _search_params(limited_query: str) -> dict:
+    return {
         "key": PIXABAY_API_KEY,
-        "q": limited_query,  # requestsが自動でURLエンコード
+        "q": limited_query,  # URLエンコードはHTTPクライアントに任せる
         "image_type": "photo",
         "safesearch": "true",
         "per_page": 3
     }
 
+def _is_upstream_failure(status_code: int) -> bool:
+    # ブレーカーに数えるのはサービス側の不調だけ（4xx はリクエストの問題）
+    return status_code >= 500 or status_code == 429
+
+def _image_urls(status_code: int, text: str, load_json) -> Optional[List[str]]:
+    """レスポンスから画像URL一覧を取り出す（APIエラー時は None）"""
+    if status_code != 200:
+        record_call_failure("pixabay", f"http_{status_code}")
+        log_event("pixabay_api_error", status=status_code, body=text)
+        return None
+    data = load_json()
+    urls = [hit["webformatURL"] for hit in data.get("hits", []) if hit.get("webformatURL")]
+    if not urls:
+        log_event("pixabay_no_images")
+    return urls
+
+# --- SQLite キャッシュ ---
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        directory = os.path.dirname(PIXABAY_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(PIXABAY_CACHE_PATH, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")  # 複数ワーカーからの読み書きを並行させる
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pixabay_cache (
+                query TEXT PRIMARY KEY,
+                urls TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+def _cache_get(key: str):
+    """(画像URL一覧, 取得からの経過秒) を返す。なければ None"""
     try:
-        print(f"🔍 Pixabay 検索クエリ: {limited_query}")
-        response = requests.get(url, params=params, verify=False)
-        if response.status_code != 200:
-            print(f"❗ APIエラー (ステータスコード: {response.status_code})")
-            print(f"🔴 エラーレスポンス本文: {response.text}")
-            return ""
-        data = response.json()
-        if data.get("hits"):
-            return data["hits"][0].get("webformatURL", "")
-        else:
-            print("❌ 画像が見つかりませんでした")
-            return ""
+        row = _db().execute(
+            "SELECT urls, fetched_at FROM pixabay_cache WHERE query = ?", (key,)
+        ).fetchone()
+    except sqlite3.Error as e:
+        log_event("pixabay_cache_error", operation="read", error=str(e))
+        return None
+    if row is None:
+        return None
+    return json.loads(row[0]), time.time() - row[1]
+
+def _remember(key: str, urls: List[str], fetched_at: float) -> None:
+    # 使えなくなる（PIXABAY_CACHE_MAX_STALE を過ぎる）まで覚えておく
+    _memory.set(key, (urls, fetched_at), ttl=max(0.0, PIXABAY_CACHE_MAX_STALE - (time.time() - fetched_at)))
+
+def _cache_set(key: str, urls: List[str]) -> None:
+    _remember(key, urls, time.time())
+    try:
+        conn = _db()
+        conn.execute(
+            "INSERT OR REPLACE INTO pixabay_cache (query, urls, fetched_at) VALUES (?, ?, ?)",
+            (key, json.dumps(urls), time.time()),
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        log_event("pixabay_cache_error", operation="write", error=str(e))
+
+# --- Pixabay API 呼び出し ---
+
+def _fetch_urls(limited_query: str) -> Optional[List[str]]:
+    try:
+        log_event("pixabay_search", query=limited_query)
+        with guarded_call("pixabay", PIXABAY_TIMEOUT) as call, track_call("pixabay"):
+            response = _session.get(PIXABAY_API_URL, params=_search_params(limited_query), timeout=call.timeout)
+            if _is_upstream_failure(response.status_code):
+                call.fail()
+        return _image_urls(response.status_code, response.text, response.json)
     except Exception as e:
-        print("Pixabay API error:", e)
+        log_event("pixabay_request_failed", query=limited_query, error=str(e))
+        return None
+
+async def _afetch_urls(limited_query: str) -> Optional[List[str]]:
+    try:
+        log_event("pixabay_search", query=limited_query)
+        client = get_async_client("pixabay", verify=False)
+        with guarded_call("pixabay", PIXABAY_TIMEOUT) as call, track_call("pixabay"):
+            response = await asyncio.wait_for(
+                client.get(PIXABAY_API_URL, params=_search_params(limited_query), timeout=call.timeout),
+                call.timeout,
+            )
+            if _is_upstream_failure(response.status_code):
+                call.fail()
+        return _image_urls(response.status_code, response.text, response.json)
+    except Exception as e:
+        log_event("pixabay_request_failed", query=limited_query, error=str(e))
+        return None
+
+def _refresh(key: str, limited_query: str) -> None:
+    try:
+        urls = _fetch_urls(limited_query)
+        if urls is not None:
+            _cache_set(key, urls)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+def _schedule_refresh(key: str, limited_query: str) -> None:
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    _refresh_executor.submit(_refresh, key, limited_query)
+
+def _lookup(limited_query: str):
+    """
+    キャッシュを引く。新しければ URL 一覧、古ければ返しつつ裏で更新、
+    使えるものがなければ None（呼び出し側で API を叩く）
+    """
+    key = cache_key(limited_query)
+    remembered = _memory.get(key)
+    if remembered is not None:
+        cached = remembered[0], time.time() - remembered[1]
+    else:
+        cached = _cache_get(key)
+        if cached is not None:
+            _remember(key, cached[0], time.time() - cached[1])
+    if cached is None:
+        cache_lookups.inc("pixabay", "miss")
+        return key, None
+    urls, age = cached
+    if age > PIXABAY_CACHE_MAX_STALE:
+        cache_lookups.inc("pixabay", "expired")
+        return key, None
+    if age > PIXABAY_CACHE_TTL:
+        cache_lookups.inc("pixabay", "stale")
+        _schedule_refresh(key, limited_query)
+    else:
+        cache_lookups.inc("pixabay", "fresh")
+    return key, urls
+
+async def _alookup(limited_query: str):
+    """_lookup の非同期版（プロセス内キャッシュになければ SQLite はスレッドで引く）"""
+    if _memory.peek(cache_key(limited_query)) is None:
+        return await asyncio.to_thread(_lookup, limited_query)
+    return _lookup(limited_query)
+
+def _prepare(query: str) -> str:
+    if not PIXABAY_API_KEY:
+        log_event("pixabay_not_configured")  # .env の PIXABAY_API_KEY を確認
+        return ""
+    limited_query = normalize_query(query)
+    if not limited_query:
+        log_event("pixabay_empty_query")
+    return limited_query
+
+def search_pixabay_image(query: str) -> str:
+    """
+    Pixabay API を使って画像を1件だけ取得し、画像URLを返す。
+    （キーワード集合ごとに SQLite にキャッシュする）
+    """
+    limited_query = _prepare(query)
+    if not limited_query:
+        return ""
+
+    key, urls = _lookup(limited_query)
+    if urls is None:
+        urls = _fetch_urls(limited_query)
+        if urls is None:
+            return ""
+        _cache_set(key, urls)
+    return urls[0] if urls else ""
+
+async def asearch_pixabay_image(query: str) -> str:
+    """
+    search_pixabay_image の非同期版（共有の接続プールを使う）
+    """
+    limited_query = _prepare(query)
+    if not limited_query:
         return ""
+
+    key, urls = await _alookup(limited_query)
+    if urls is None:
+        urls = await _afetch_urls(limited_query)
+        if urls is None:
+            return ""
+        await asyncio.to_thread(_cache_set, key, urls)
+    return urls[0] if urls else ""
+
+def cached_pixabay_image(query: str) -> str:
+    """
+    API を呼ばずにキャッシュだけから画像URLを返す（縮退応答用）
+
+    イベントループから呼ぶので、待たされることのないプロセス内キャッシュだけを見る（SQLite は引かない）。
+    なければ PIXABAY_PLACEHOLDER_URL
+    """
+    limited_query = normalize_query(query)
+    if limited_query:
+        remembered = _memory.peek(cache_key(limited_query))
+        if remembered is not None and remembered[0]:
+            return remembered[0][0]
+    return PIXABAY_PLACEHOLDER_URL
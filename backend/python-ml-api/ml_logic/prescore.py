@@ -0,0 +1,180 @@
+"""
+推薦の事前計算（天気予報を使ってアプリを開く前に推薦を作っておく）
+
+    cd backend/python-ml-api
+    python prescore_job.py            # 1回だけ実行
+    python prescore_job.py --loop     # 1時間ごとに実行
+
+1. 最近使われたユーザーと、そのユーザーが服を選ぶことの多い時刻を調べる
+2. 最新位置を天気キャッシュと同じマスにまとめ、マスごとに予報を1回だけ取得する
+3. 対象時刻の予報でカテゴリごとにまとめて推論する
+4. アドバイス文・画像は同じ服装・天気の組み合わせごとに1回だけ生成する
+5. precomputed_suggestions に保存する（/suggest は実際の天気と一致するときだけ使う）
+
+外部呼び出し・保存はすべて引数で差し替えられるので、ローカルのフェイクでも動かせる。
+"""
+import asyncio
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from crud import (
+    aget_latest_locations, delete_precomputed_before, get_active_user_hours, save_precomputed_suggestions,
+)
+from ml_logic.data import _cell_center, afetch_forecast, pick_forecast, weather_cell
+from ml_logic.features import build_feature_row, build_features, temp_bin
+from ml_logic.pixabay import asearch_pixabay_image
+from ml_logic.textgen import advice_cache_key, agenerate_advice_and_keywords
+
+# この日数以内に服の選択・位置登録をしたユーザーを対象にする
+PRESCORE_ACTIVE_DAYS = int(os.getenv("PRESCORE_ACTIVE_DAYS", "14"))
+# 選択履歴がないユーザーの想定時刻（カンマ区切り）
+PRESCORE_DEFAULT_HOURS = [int(h) for h in os.getenv("PRESCORE_DEFAULT_HOURS", "7").split(",") if h.strip()]
+# 1ユーザーあたり何時刻分を用意するか（選択の多い時刻から順に）
+PRESCORE_HOURS_PER_USER = int(os.getenv("PRESCORE_HOURS_PER_USER", "1"))
+# Gemini / Pixabay の同時呼び出し数
+PRESCORE_CONCURRENCY = int(os.getenv("PRESCORE_CONCURRENCY", "8"))
+
+
+def _get_engine():
+    # numpy / scipy ごと読み込むので、import は推論するときにスレッドで行う
+    from ml_logic.inference import get_engine
+    return get_engine()
+
+
+def truncate_hour(when: datetime) -> datetime:
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def expected_hours(hour_counts: Dict[int, int], limit: int = None) -> List[int]:
+    """選択の多い時刻から limit 件（履歴がなければ既定の時刻）"""
+    limit = limit or PRESCORE_HOURS_PER_USER
+    if not hour_counts:
+        return PRESCORE_DEFAULT_HOURS[:limit]
+    return [hour for hour, _ in Counter(hour_counts).most_common(limit)]
+
+
+def next_occurrence(now: datetime, hour: int) -> datetime:
+    """now より後で最初に来る hour 時ちょうど"""
+    target = truncate_hour(now).replace(hour=hour)
+    return target if target > now else target + timedelta(days=1)
+
+
+def matches_conditions(stored: Dict[str, Any], location: Dict[str, Any], weather_data: Dict[str, Any]) -> bool:
+    """
+    保存済みの推薦が今の状況でも使えるか（同じ天気マス・同じ天気・同じ温度帯）
+    """
+    cell = weather_cell(location["latitude"], location["longitude"])
+    return (
+        (stored["cell_lat"], stored["cell_lon"]) == cell
+        and stored["weather"] == weather_data["weather"]
+        and temp_bin(stored["temperature"]) == temp_bin(weather_data["temperature"])
+    )
+
+
+async def run_prescore(now: Optional[datetime] = None, dry_run: bool = False, *,
+                       load_active=get_active_user_hours,
+                       load_locations=aget_latest_locations,
+                       fetch_forecast=afetch_forecast,
+                       generate=agenerate_advice_and_keywords,
+                       search_image=asearch_pixabay_image,
+                       store=save_precomputed_suggestions,
+                       purge=delete_precomputed_before) -> Dict[str, Any]:
+    """
+    事前計算を1回実行する
+
+    Returns:
+        件数のまとめ（dry_run のときは保存する予定だった行も "rows" に入る）
+    """
+    now = now or datetime.now()
+    summary: Dict[str, Any] = {"users": 0, "cells": 0, "forecast_failed": 0, "rows": 0, "advice_calls": 0}
+
+    active = await asyncio.to_thread(load_active, now - timedelta(days=PRESCORE_ACTIVE_DAYS))
+    locations = await load_locations(list(active)) if active else {}
+    summary["users"] = len(locations)
+
+    # マスごとに予報を1回だけ取得
+    points_by_cell: Dict[Tuple[int, int], Tuple[float, float]] = {}
+    for location in locations.values():
+        cell = weather_cell(location["latitude"], location["longitude"])
+        points_by_cell.setdefault(cell, _cell_center(cell))
+    forecasts = await asyncio.gather(*[fetch_forecast(*point) for point in points_by_cell.values()])
+    forecast_by_cell = dict(zip(points_by_cell, forecasts))
+    summary["cells"] = len(forecast_by_cell)
+    summary["forecast_failed"] = sum(1 for f in forecasts if not f)
+
+    targets = []
+    feature_rows = []
+    for user_id, location in locations.items():
+        cell = weather_cell(location["latitude"], location["longitude"])
+        forecast = forecast_by_cell.get(cell)
+        if not forecast:
+            continue
+        for hour in expected_hours(active.get(user_id, {})):
+            target_hour = next_occurrence(now, hour)
+            weather_data = pick_forecast(forecast, target_hour)
+            if weather_data is None:
+                continue
+            targets.append((user_id, target_hour, cell, weather_data))
+            feature_rows.append(build_feature_row(build_features(user_id, weather_data, target_hour)))
+
+    labels_by_category = {}
+    if feature_rows:
+        engine = await asyncio.to_thread(_get_engine)
+        labels_by_category = await asyncio.to_thread(engine.predict_rows, feature_rows)
+
+    rows = []
+    advice_keys = {}
+    for i, (user_id, target_hour, cell, weather_data) in enumerate(targets):
+        recommendations = {
+            category: labels[i] if labels else None
+            for category, labels in labels_by_category.items()
+        }
+        # アドバイスのキャッシュと同じキー（温度帯で丸める）で、同じ文になる組み合わせをまとめる
+        key = advice_cache_key(recommendations, weather_data["temperature"], weather_data["weather"])
+        advice_keys.setdefault(key, (recommendations, weather_data))
+        rows.append({
+            "user_id": user_id,
+            "target_hour": target_hour,
+            "cell_lat": cell[0],
+            "cell_lon": cell[1],
+            "temperature": weather_data["temperature"],
+            "weather": weather_data["weather"],
+            "recommendations": recommendations,
+            "_advice_key": key,
+        })
+
+    # 同じ服装・温度帯・天気の組み合わせはまとめて1回だけ生成
+    semaphore = asyncio.Semaphore(PRESCORE_CONCURRENCY)
+
+    async def advise(recommendations, weather_data):
+        async with semaphore:
+            try:
+                result = await generate(recommendations, float(weather_data["temperature"]), weather_data["weather"])
+            except Exception as e:
+                # 生成できなかった組み合わせは保存しない（/suggest がその場で生成する）
+                print(f"⚠ 事前計算のアドバイス生成に失敗: {e}")
+                return None
+            result["image_url"] = await search_image(result["image_keywords"])
+            return result
+
+    generated = await asyncio.gather(*[advise(*args) for args in advice_keys.values()])
+    advice_by_key = dict(zip(advice_keys, generated))
+    summary["advice_calls"] = len(advice_by_key)
+
+    rows = [row for row in rows if advice_by_key[row["_advice_key"]] is not None]
+    for row in rows:
+        result = advice_by_key[row.pop("_advice_key")]
+        row["suggestion_text"] = result["advice_text"]
+        row["image_keywords"] = result["image_keywords"]
+        row["image_url"] = result["image_url"]
+
+    if dry_run:
+        summary["rows"] = rows
+        return summary
+
+    summary["rows"] = await asyncio.to_thread(store, rows)
+    # 対象時刻を過ぎたものは使われないので消す
+    summary["purged"] = await asyncio.to_thread(purge, truncate_hour(now))
+    return summary
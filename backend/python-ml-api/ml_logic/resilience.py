@@ -0,0 +1,230 @@
+"""
+外部 API 呼び出しの時間予算とサーキットブレーカー
+
+- リクエストごとの時間予算（締め切り）を contextvar に持ち、外部呼び出しのタイムアウトは
+  「サービスごとの上限」と「予算の残り」の短い方にする
+- サービスごとのサーキットブレーカーで、失敗が続いたら一定時間は呼ばずにすぐ失敗させる
+  （時間をおいて1件だけ試し、成功すれば戻す）
+- 予算切れ・ブレーカー作動時の代替（縮退応答）は呼び出し側で決める
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Dict, Optional
+
+from ml_logic.metrics import log_event, metrics, record_call_failure
+
+# 連続でこの回数失敗したらブレーカーを開く
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# 開いてからこの秒数が経ったら1件だけ試す
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+_deadline_var: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class BudgetExhausted(Exception):
+    """リクエストの時間予算を使い切った"""
+
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いているので呼び出さなかった"""
+
+
+# --- 時間予算 ---
+
+@contextmanager
+def request_budget(seconds: Optional[float] = None, deadline: Optional[float] = None):
+    """
+    この with の中の外部呼び出しを合計 seconds 秒以内（または time.monotonic() の deadline まで）に収める
+
+    既に外側で短い予算が設定されていればそちらを優先する
+    """
+    if deadline is None:
+        deadline = time.monotonic() + seconds
+    outer = _deadline_var.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = _deadline_var.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline_var.reset(token)
+
+
+def current_deadline() -> Optional[float]:
+    """設定中の締め切り（time.monotonic() の値。別のタスクに予算を引き継ぐとき用）"""
+    return _deadline_var.get()
+
+
+def remaining() -> Optional[float]:
+    """予算の残り秒（予算が設定されていなければ None）"""
+    deadline = _deadline_var.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def call_timeout(cap: float) -> float:
+    """
+    外部呼び出し1回のタイムアウト（上限 cap と予算の残りの短い方）
+
+    Raises:
+        BudgetExhausted: 予算が残っていない場合
+    """
+    left = remaining()
+    if left is None:
+        return cap
+    if left <= 0:
+        raise BudgetExhausted("時間予算を使い切りました")
+    return min(cap, left)
+
+
+async def within_budget(awaitable: Awaitable[Any], stage: str, default: Any = None) -> Any:
+    """
+    awaitable を予算の残り時間内で待つ。時間切れ・失敗なら default を返す（縮退）
+
+    呼び出し元のタスク自体がキャンセルされた場合はそのまま送出する
+    """
+    left = remaining()
+    try:
+        if left is not None and left <= 0:
+            raise BudgetExhausted("時間予算を使い切りました")
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.CancelledError:
+        # 相乗りしていた先の呼び出しが打ち切られた場合も縮退扱い（自分が止められたときは除く）
+        task = asyncio.current_task()
+        if task is not None and task.cancelling():
+            raise
+        reason = "cancelled"
+    except (asyncio.TimeoutError, BudgetExhausted):
+        reason = "budget"
+    except CircuitOpenError:
+        reason = "circuit_open"
+    except Exception as e:
+        print(f"⚠ {stage} に失敗したので縮退応答にします: {e}")
+        reason = type(e).__name__
+    if asyncio.iscoroutine(awaitable):
+        awaitable.close()  # 予算切れで一度も待たなかった場合の "never awaited" 警告を出さない
+    log_event("degraded", stage=stage, reason=reason)
+    return default
+
+
+# --- サーキットブレーカー ---
+
+class CircuitBreaker:
+    """
+    失敗が続いたサービスへの呼び出しを一時的に止める（closed → open → half_open → closed）
+    """
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, reset_seconds: Optional[float] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or CIRCUIT_FAILURE_THRESHOLD
+        self.reset_seconds = reset_seconds or CIRCUIT_RESET_SECONDS
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half_open のときは試しの1件だけ通す）"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                log_event("circuit_closed", service=self.name)
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    log_event("circuit_opened", service=self.name, failures=self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(service: str) -> CircuitBreaker:
+    """サービスごとのブレーカー（初回に作成）"""
+    with _breakers_lock:
+        found = _breakers.get(service)
+        if found is None:
+            found = _breakers[service] = CircuitBreaker(service)
+        return found
+
+
+def breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: b.stats() for name, b in list(_breakers.items())}
+
+
+class _GuardedCall:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.failed = False
+
+    def fail(self) -> None:
+        """例外にならない失敗（5xx など）をブレーカーに数える"""
+        self.failed = True
+
+
+@contextmanager
+def guarded_call(service: str, cap: float):
+    """
+    外部呼び出し1回をブレーカーと時間予算で守る
+
+    Yields:
+        timeout 属性（この呼び出しに使ってよい秒数）と fail() を持つオブジェクト
+
+    Raises:
+        CircuitOpenError: ブレーカーが開いている場合（呼び出さずにすぐ失敗）
+        BudgetExhausted: 予算が残っていない場合
+    """
+    circuit = breaker(service)
+    timeout = call_timeout(cap)
+    if not circuit.allow():
+        record_call_failure(service, "circuit_open")
+        raise CircuitOpenError(f"{service} のブレーカーが開いています")
+    call = _GuardedCall(timeout)
+    try:
+        yield call
+    except BaseException:
+        circuit.record_failure()
+        raise
+    if call.failed:
+        circuit.record_failure()
+    else:
+        circuit.record_success()
+
+
+_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+metrics.gauge_callback(
+    "circuit_breaker_state", "外部 API のブレーカーの状態（0=closed, 1=half_open, 2=open）", ("service",),
+    lambda: [((name,), _STATE_VALUES[stats["state"]]) for name, stats in breaker_stats().items()],
+)
@@ -1,3 +1,7 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
 from ml_logic.pixabay import search_pixabay_image
 
 # テスト用クエリ（例：単語1〜2個で試すと確実）
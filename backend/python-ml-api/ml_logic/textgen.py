@@ -1,47 +1,298 @@
+import asyncio
+import json
 import os
 import random
 import re
-import google.generativeai as genai
-from dotenv import load_dotenv
+import threading
+import time
+import typing
+from ml_logic.cache import AsyncSingleFlight, SingleFlight, TTLCache
+from ml_logic.metrics import track_call
+from ml_logic.resilience import guarded_call
 
-load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-1.5-flash-latest')
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest")
+# 1回の生成のタイムアウト上限（秒）。リクエストの時間予算が残り少なければそちらに合わせる
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "6"))
 
-# アドバイス文を生成（日本語）
-def generate_advice_text(recommendations: dict, temperature: float, weather: str) -> str:
-    prompt = (
-        "以下の情報をもとに、自然な日本語の服装アドバイス文を1〜2文で生成してください。\n"
+# Gemini SDK は import も configure も重いので、初回利用時（またはウォームアップ時）に作る
+# （ベンチマーク等ではここに代わりのオブジェクトを入れられる）
+model = None
+_generation_config = None
+_model_lock = threading.Lock()
+
+# アドバイスキャッシュ: 同じ服装の組み合わせ・温度帯・天気なら Gemini を呼ばずに使い回す
+ADVICE_CACHE_TTL = float(os.getenv("ADVICE_CACHE_TTL", "21600"))
+ADVICE_CACHE_SIZE = int(os.getenv("ADVICE_CACHE_SIZE", "5000"))
+ADVICE_TEMP_BUCKET = float(os.getenv("ADVICE_TEMP_BUCKET", "3"))
+
+advice_cache = TTLCache(maxsize=ADVICE_CACHE_SIZE, ttl=ADVICE_CACHE_TTL)
+_advice_flight = SingleFlight()
+_async_advice_flight = AsyncSingleFlight()
+
+
+class AdviceResult(typing.TypedDict):
+    advice_text: str
+    image_keywords: list[str]
+
+
+def get_model():
+    """Gemini のモデルを返す（初回だけ SDK の import と設定を行う）"""
+    global model, _generation_config
+    if model is None:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                _generation_config = genai.GenerationConfig(
+                    response_mime_type="application/json",
+                    response_schema=AdviceResult,
+                )
+                model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return model
+
+def _advice_prompt(recommendations: dict, temperature: float, weather: str) -> str:
+    return (
+        "以下の情報をもとに、次の2つを JSON で出力してください。\n"
+        "advice_text: 自然な日本語の服装アドバイス文を1〜2文。"
+        "気温や天気と矛盾しないように注意しつつ、季節感のある親しみやすい表現でお願いします。"
+        "気温の具体的な数値は書かないでください。\n"
+        "image_keywords: そのアドバイスに合う画像を Pixabay で検索するための英単語を3〜5語（例: jeans, jacket, sneakers）\n"
         f"気温: {temperature}℃\n"
         f"天気: {weather}\n"
         f"提案された服装: {recommendations}\n"
-        "気温や天気と矛盾しないように注意しつつ、季節感のある親しみやすい表現でお願いします。"
-    )
-    response = model.generate_content(prompt)
-    return response.text.strip()
-
-# 画像検索用キーワードを生成（英語・整形・最大3語）
-def generate_image_keywords(advice_text: str, max_keywords: int = 3) -> str:
-    prompt = (
-        "以下の服装アドバイス文をもとに、Pixabayで画像検索するための英単語を3〜5語、スペース区切りで抽出してください。\n"
-        f"{advice_text}\n"
-        "例: jeans jacket sneakers\n"
-        "出力はキーワードのみ。記号・番号・文は不要。"
     )
-    response = model.generate_content(prompt)
-    raw_output = response.text.strip()
 
+def _pick_keywords(raw_output: str, max_keywords: int) -> str:
     # 🔧 英単語のみにフィルタ（記号や番号除去）
     words = re.findall(r'\b[a-zA-Z]+\b', raw_output.lower())
     keywords = random.sample(words, min(len(words), max_keywords))
     return " ".join(keywords)
 
-# アドバイス文 + 画像キーワードをまとめて返す関数
-def generate_advice_and_keywords(recommendations: dict, temperature: float, weather: str) -> dict:
-    advice = generate_advice_text(recommendations, temperature, weather)
-    keywords = generate_image_keywords(advice)
+def _parse_response(text: str, max_keywords: int = 3) -> dict:
+    try:
+        data = json.loads(text)
+        advice = str(data.get("advice_text", "")).strip()
+        raw_keywords = " ".join(str(k) for k in data.get("image_keywords", []))
+    except (ValueError, AttributeError):
+        # JSON で返ってこなかった場合は本文をそのままアドバイスとして使う
+        advice = text.strip()
+        raw_keywords = advice
+    return {"advice_text": advice, "image_keywords": _pick_keywords(raw_keywords, max_keywords)}
+
+_WEATHER_JA = {
+    "clear": "晴れ", "clouds": "くもり", "rain": "雨", "drizzle": "小雨", "thunderstorm": "雷雨",
+    "snow": "雪", "mist": "霧", "fog": "霧", "haze": "もや",
+}
+
+def template_advice(recommendations: dict, temperature: float, weather: str) -> dict:
+    """
+    Gemini を使わずに推薦と天気から定型のアドバイス文を作る（縮退応答用）
+
+    戻り値は agenerate_advice_and_keywords と同じ形
+    """
+    weather = str(weather).lower()
+    items = [item for item in recommendations.values() if item]
+    text = f"今日は{_WEATHER_JA.get(weather, weather)}。"
+    if items:
+        text += f"{'、'.join(items)}のコーディネートがおすすめです。"
+    temperature = float(temperature)
+    if temperature >= 25:
+        text += "暑くなりそうなので、涼しく過ごせる服装で出かけましょう。"
+    elif temperature >= 18:
+        text += "過ごしやすい気温です。"
+    elif temperature >= 10:
+        text += "少し肌寒いので、羽織るものがあると安心です。"
+    else:
+        text += "寒いので、暖かくして出かけましょう。"
+    if weather in ("rain", "drizzle", "thunderstorm", "snow"):
+        text += "傘も忘れずに。"
+    return _with_items({"advice_text": text, "image_keywords": f"{weather} outfit fashion"}, recommendations)
+
+def advice_cache_key(recommendations: dict, temperature: float, weather: str) -> tuple:
+    """推薦セット（カテゴリ順に正規化）・温度帯・天気からキャッシュキーを作る"""
+    items = tuple(sorted((category, item) for category, item in recommendations.items() if item))
+    return items, int(float(temperature) // ADVICE_TEMP_BUCKET), str(weather).lower()
+
+def _with_items(result: dict, recommendations: dict) -> dict:
     return {
-        "advice_text": advice,
-        "image_keywords": keywords,
+        "advice_text": result["advice_text"],
+        "image_keywords": result["image_keywords"],
         "recommendation_items": recommendations
     }
+
+# アドバイス文 + 画像キーワードを1回の Gemini 呼び出しでまとめて返す関数
+def generate_advice_and_keywords(recommendations: dict, temperature: float, weather: str) -> dict:
+    key = advice_cache_key(recommendations, temperature, weather)
+    cached = advice_cache.get(key)
+    if cached is not None:
+        return _with_items(cached, recommendations)
+
+    def load():
+        cached = advice_cache.peek(key)
+        if cached is not None:
+            return cached
+        with guarded_call("gemini", GEMINI_TIMEOUT) as call, track_call("gemini"):
+            response = get_model().generate_content(
+                _advice_prompt(recommendations, temperature, weather),
+                generation_config=_generation_config,
+                request_options={"timeout": call.timeout},
+            )
+        result = _parse_response(response.text)
+        if result["advice_text"]:
+            advice_cache.set(key, result)
+        return result
+
+    return _with_items(_advice_flight.do(key, load), recommendations)
+
+async def agenerate_advice_and_keywords(recommendations: dict, temperature: float, weather: str) -> dict:
+    """generate_advice_and_keywords の非同期版（キャッシュは共有）"""
+    key = advice_cache_key(recommendations, temperature, weather)
+    cached = advice_cache.get(key)
+    if cached is not None:
+        return _with_items(cached, recommendations)
+
+    async def load():
+        cached = advice_cache.peek(key)
+        if cached is not None:
+            return cached
+        with guarded_call("gemini", GEMINI_TIMEOUT) as call, track_call("gemini"):
+            response = await asyncio.wait_for(get_model().generate_content_async(
+                _advice_prompt(recommendations, temperature, weather),
+                generation_config=_generation_config,
+                request_options={"timeout": call.timeout},
+            ), call.timeout)
+        result = _parse_response(response.text)
+        if result["advice_text"]:
+            advice_cache.set(key, result)
+        return result
+
+    return _with_items(await _async_advice_flight.do(key, load), recommendations)
+
+class _AdviceTextStream:
+    """
+    ストリーミング中の JSON 断片から advice_text の値だけを少しずつ取り出す
+
+    構造化出力は {"advice_text": "...", "image_keywords": [...]} の JSON が断片で届くので、
+    advice_text の文字列が始まってから閉じ引用符までを、届いた分だけ返す。
+    """
+
+    _KEY = re.compile(r'"advice_text"\s*:\s*"')
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = None      # advice_text の値の読み取り位置（値が始まるまでは None）
+        self.done = False
+
+    @property
+    def started(self) -> bool:
+        return self._pos is not None
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = self._KEY.search(self.buffer)
+            if match is None:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        i = self._pos
+        while i < len(self.buffer):
+            ch = self.buffer[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch == "\\":
+                # エスケープは続きが揃うまで待つ（\uXXXX は6文字）
+                end = i + (6 if self.buffer[i + 1:i + 2] == "u" else 2)
+                if end > len(self.buffer):
+                    break
+                try:
+                    out.append(json.loads(f'"{self.buffer[i:end]}"'))
+                except ValueError:
+                    pass
+                i = end
+                continue
+            out.append(ch)
+            i += 1
+        self._pos = i
+        return "".join(out)
+
+# 読み手が離れた後も最後まで読むストリーム（タスクが GC されないよう参照を持つ）
+_pumping_streams: typing.Set[asyncio.Task] = set()
+
+async def _pump_advice_stream(recommendations: dict, temperature: float, weather: str, key: tuple,
+                              out: asyncio.Queue) -> None:
+    """
+    Gemini のストリームを読み、("delta", 文字列) / ("done", 結果) / ("error", 例外) を out に積む
+
+    読み手とは別のタスクで動くので、ブレーカーと所要時間には Gemini 側の時間と失敗だけが数えられる
+    （読み手が接続を切っても失敗にはならず、最後まで読んだ結果はキャッシュに入る）
+    """
+    extractor = _AdviceTextStream()
+    try:
+        with guarded_call("gemini", GEMINI_TIMEOUT) as call, track_call("gemini"):
+            # 最初の応答から最後の断片までを合わせて call.timeout 秒に収める
+            deadline = time.monotonic() + call.timeout
+            response = await asyncio.wait_for(get_model().generate_content_async(
+                _advice_prompt(recommendations, temperature, weather),
+                generation_config=_generation_config,
+                request_options={"timeout": call.timeout},
+                stream=True,
+            ), call.timeout)
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                delta = extractor.feed(chunk.text)
+                if delta:
+                    out.put_nowait(("delta", delta))
+    except asyncio.CancelledError as e:
+        out.put_nowait(("error", e))
+        raise
+    except Exception as e:
+        out.put_nowait(("error", e))
+        return
+
+    result = _parse_response(extractor.buffer)
+    if not extractor.started and result["advice_text"]:
+        # JSON で返ってこなかった場合は、本文をまとめて返す
+        out.put_nowait(("delta", result["advice_text"]))
+    if result["advice_text"]:
+        advice_cache.set(key, result)
+    out.put_nowait(("done", result))
+
+async def astream_advice_and_keywords(recommendations: dict, temperature: float, weather: str):
+    """
+    アドバイス文を Gemini のストリーミングで届いた分から返す非同期ジェネレータ
+
+    Yields:
+        ("delta", 追加された文字列) を0回以上、最後に ("done", agenerate_advice_and_keywords と同じ dict)
+        キャッシュにあれば全文を1回の delta で返す
+    """
+    key = advice_cache_key(recommendations, temperature, weather)
+    cached = advice_cache.get(key)
+    if cached is not None:
+        yield "delta", cached["advice_text"]
+        yield "done", _with_items(cached, recommendations)
+        return
+
+    # Gemini の読み取りは別タスクで行い、ここでは届いた断片を渡すだけ
+    # （yield で待つ時間や切断を Gemini の呼び出しに含めない）
+    out: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(_pump_advice_stream(recommendations, temperature, weather, key, out))
+    _pumping_streams.add(task)
+    task.add_done_callback(_pumping_streams.discard)
+    while True:
+        kind, value = await out.get()
+        if kind == "error":
+            raise value
+        if kind == "done":
+            yield "done", _with_items(value, recommendations)
+            return
+        yield kind, value
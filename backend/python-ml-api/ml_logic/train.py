@@ -1,70 +1,94 @@
 import os
+import sys
+import argparse
 import pandas as pd
-from sklearn.preprocessing import OneHotEncoder, LabelEncoder
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
-from xgboost import XGBClassifier
+from sklearn.preprocessing import LabelEncoder
 import joblib
 
 from ml_logic.data import create_training_data  # data.py の関数をimport
+from ml_logic.artifact import write_artifact
+from ml_logic.features import temp_bin
+from ml_logic.model_check import check_candidate, print_check, split_holdout
+from ml_logic.model_registry import artifact_path
+from ml_logic.train_config import (
+    TRAIN_SWEEP_GRID, TrainConfig, best_result, parse_grid, print_reports, run_configs, sweep_configs,
+)
 
 # ✅ モデル保存先を train.py の位置基準に固定
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(CURRENT_DIR, "models")
 os.makedirs(MODEL_DIR, exist_ok=True)
 
-def prepare_and_train_models_by_category(training_data):
+def prepare_and_train_models_by_category(training_data, configs=None, jobs=1, gate=False):
+    """
+    gate のときは各カテゴリの最新側を学習から外して検証に使い、
+    デプロイ済みのモデルより悪化したカテゴリは保存しない（保存しなかったカテゴリは report の "gate" が "failed"）
+    """
+    configs = configs or [TrainConfig.from_env()]
     df = pd.DataFrame([x[0] for x in training_data])
     df["label"] = [x[1] for x in training_data]
-    df["temp_bin"] = df["temperature"].apply(lambda x: str(int(float(x) // 5)))
+    df["temp_bin"] = df["temperature"].apply(temp_bin)
+    holdout = df.iloc[:0]
+    if gate:
+        # 学習データは選択日時順なので、カテゴリごとの末尾が最新
+        df, holdout = split_holdout(df)
 
+    categorical_features = ["weather", "user_id", "month", "day", "hour", "weekday", "temp_bin"]
+    reports = []
     for category in df["category"].unique():
         subset = df[df["category"] == category]
         if subset.empty:
             print(f"スキップ: {category}（データが空）")
             continue
 
-        X = subset.drop(["label", "category", "temperature"], axis=1)
+        X = subset.drop(["label", "category", "temperature"], axis=1).reset_index(drop=True)
         y = subset["label"]
 
         print(f"\n--- [{category}] ---", flush=True)
         print(y.value_counts(), flush=True)
 
-        categorical_features = ["weather", "user_id", "month", "day", "hour", "weekday", "temp_bin"]
-
-        preprocessor = ColumnTransformer(
-            transformers=[("cat", OneHotEncoder(handle_unknown="ignore"), categorical_features)]
-        )
-
         le = LabelEncoder()
         y_encoded = le.fit_transform(y)
 
-        clf = Pipeline([
-            ("preprocessor", preprocessor),
-            ("classifier", XGBClassifier(
-                use_label_encoder=False,
-                eval_metric="mlogloss",
-                random_state=42
-            )),
-        ])
+        # 設定ごとに学習して（early stopping 付き）、検証データの精度が最も高いものを使う
+        results = run_configs(
+            [(category, X, y_encoded, categorical_features, config, le) for config in configs], jobs=jobs,
+        )
+        _, clf, report = best_result(results)
+        reports.extend(r for _, _, r in results)
+        accuracy = "-" if report["accuracy"] is None else f"{report['accuracy']:.4f}"
+        print(f"[{category}] Accuracy: {accuracy}（{report['config']}, {report['n_rounds']} ラウンド）")
 
-        if len(subset) < 2:
-            print(f"[{category}] データ数が少ないため全データで学習", flush=True)
-            clf.fit(X, y_encoded)
-        else:
-            X_train, X_test, y_train, y_test = train_test_split(X, y_encoded, test_size=0.2, random_state=42)
-            clf.fit(X_train, y_train)
-            y_pred = clf.predict(X_test)
-            acc = accuracy_score(y_test, y_pred)
-            print(f"[{category}] Accuracy: {acc:.4f}")
+        if gate:
+            held = holdout[holdout["category"] == category].drop(["category", "temperature"], axis=1)
+            result = check_candidate(category, clf, le, MODEL_DIR, held)
+            print_check(result)
+            report["gate"] = "passed" if result["passed"] else "failed"
+            if not result["passed"]:
+                print(f"⛔ [{category}] デプロイ済みのモデルより悪化したため保存しません")
+                continue
 
         # ✅ 絶対パスで models に保存
         model_path = os.path.join(MODEL_DIR, f"{category}_model.pkl")
         joblib.dump((clf, le), model_path)
         print(f"✅ モデル保存: {model_path}")
+        write_artifact(artifact_path(category, MODEL_DIR), clf, le, category, metadata={"training": report})
+
+    print_reports(reports)
+    return reports
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="カテゴリ別モデルの学習（簡易版）")
+    parser.add_argument("--sweep", action="store_true", help="--grid の設定をすべて試して最も精度の高いものを保存する")
+    parser.add_argument("--grid", default=TRAIN_SWEEP_GRID, help="スイープで試す値")
+    parser.add_argument("--jobs", type=int, default=1, help="同時に学習する設定の数")
+    parser.add_argument("--gate", action="store_true", help="保存前にデプロイ済みのモデルと比べ、悪化したカテゴリは上書きしない")
+    args = parser.parse_args()
+
+    configs = [TrainConfig.from_env()]
+    if args.sweep:
+        configs = sweep_configs(configs[0], parse_grid(args.grid))
     training_data = create_training_data()
-    prepare_and_train_models_by_category(training_data)
+    reports = prepare_and_train_models_by_category(training_data, configs=configs, jobs=args.jobs, gate=args.gate)
+    if any(r.get("gate") == "failed" for r in reports):
+        sys.exit(1)
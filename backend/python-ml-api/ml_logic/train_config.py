@@ -0,0 +1,226 @@
+"""
+学習設定（XGBoost のハイパーパラメータ）と、設定ごとの学習結果の記録
+
+- 木はヒストグラム法（tree_method="hist"）で作り、One-Hot の疎行列をそのまま渡す
+- 学習データの一部を検証用に取り分け、検証データの mlogloss が early_stopping_rounds 回
+  改善しなくなったら打ち切る（n_estimators は上限）。精度もこの検証データで測る
+- 保存するモデルは、打ち切りで決まったラウンド数で全行（検証用の行も含む）を学習し直したもの
+  （ラウンド数は学習結果の n_rounds としてメタ情報に残る）
+- 複数の設定を並列に試し（スイープ）、カテゴリごとに学習時間・モデルサイズ・精度を比べる
+
+    TRAIN_SWEEP_GRID="max_depth=3,6;learning_rate=0.1,0.3" python -m ml_logic.train_models_by_category --sweep
+"""
+import itertools
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder
+from xgboost import XGBClassifier
+
+from ml_logic.artifact import build_artifact
+
+# スイープで試す値（"パラメータ=値,値;パラメータ=値,..."）
+TRAIN_SWEEP_GRID = os.getenv("TRAIN_SWEEP_GRID", "max_depth=3,6;learning_rate=0.1,0.3")
+
+
+@dataclass(frozen=True)
+class TrainConfig:
+    max_depth: int = 6
+    learning_rate: float = 0.1
+    n_estimators: int = 200            # ラウンド数の上限（early stopping で止まればそれより少ない）
+    early_stopping_rounds: int = 10    # 検証データの mlogloss がこの回数改善しなければ打ち切る
+    min_child_weight: float = 1.0
+    tree_method: str = "hist"
+    validation_fraction: float = 0.2   # 検証用に取り分ける割合（クラスごと）
+    random_state: int = 42
+
+    @classmethod
+    def from_env(cls) -> "TrainConfig":
+        """TRAIN_* 環境変数で既定値を上書きした設定"""
+        return cls(
+            max_depth=int(os.getenv("TRAIN_MAX_DEPTH", cls.max_depth)),
+            learning_rate=float(os.getenv("TRAIN_LEARNING_RATE", cls.learning_rate)),
+            n_estimators=int(os.getenv("TRAIN_N_ESTIMATORS", cls.n_estimators)),
+            early_stopping_rounds=int(os.getenv("TRAIN_EARLY_STOPPING_ROUNDS", cls.early_stopping_rounds)),
+            min_child_weight=float(os.getenv("TRAIN_MIN_CHILD_WEIGHT", cls.min_child_weight)),
+            tree_method=os.getenv("TRAIN_TREE_METHOD", cls.tree_method),
+            validation_fraction=float(os.getenv("TRAIN_VALIDATION_FRACTION", cls.validation_fraction)),
+        )
+
+    @property
+    def name(self) -> str:
+        return f"depth={self.max_depth},lr={self.learning_rate},mcw={self.min_child_weight}"
+
+    def classifier(self, num_class: int, n_jobs: Optional[int] = None, early_stopping: bool = True) -> XGBClassifier:
+        return XGBClassifier(
+            objective="multi:softprob",
+            num_class=num_class,        # 2クラスでも推論側と同じく softprob の形で出力する
+            eval_metric="mlogloss",
+            tree_method=self.tree_method,
+            max_depth=self.max_depth,
+            learning_rate=self.learning_rate,
+            n_estimators=self.n_estimators,
+            min_child_weight=self.min_child_weight,
+            early_stopping_rounds=self.early_stopping_rounds if early_stopping else None,
+            random_state=self.random_state,
+            n_jobs=n_jobs,
+        )
+
+
+_FIELD_TYPES = {"max_depth": int, "learning_rate": float, "n_estimators": int,
+                "early_stopping_rounds": int, "min_child_weight": float, "tree_method": str}
+
+
+def parse_grid(spec: str) -> Dict[str, List[Any]]:
+    """
+    "max_depth=3,6;learning_rate=0.1,0.3" を {"max_depth": [3, 6], "learning_rate": [0.1, 0.3]} にする
+
+    Raises:
+        ValueError: 知らないパラメータ・値の形式が不正な場合
+    """
+    grid = {}
+    for part in spec.split(";"):
+        if not part.strip():
+            continue
+        key, _, values = part.partition("=")
+        key = key.strip()
+        if key not in _FIELD_TYPES:
+            raise ValueError(f"スイープできないパラメータです: {key}（{', '.join(_FIELD_TYPES)}）")
+        grid[key] = [_FIELD_TYPES[key](v.strip()) for v in values.split(",") if v.strip()]
+    return grid
+
+
+def sweep_configs(base: TrainConfig, grid: Dict[str, List[Any]]) -> List[TrainConfig]:
+    """base の一部を grid の値の全組み合わせで置き換えた設定の一覧"""
+    if not grid:
+        return [base]
+    keys = list(grid)
+    return [replace(base, **dict(zip(keys, values))) for values in itertools.product(*grid.values())]
+
+
+def validation_split(y: np.ndarray, fraction: float, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    クラスごとに fraction の割合を検証用に取り分ける（学習用・検証用の行番号）
+
+    1件しかないクラスは学習用に残す（学習データに全クラスが揃っていないと学習できない）
+    """
+    rng = np.random.default_rng(seed)
+    train, valid = [], []
+    for label in np.unique(y):
+        rows = rng.permutation(np.flatnonzero(y == label))
+        n_valid = int(len(rows) * fraction)
+        valid.append(rows[:n_valid])
+        train.append(rows[n_valid:])
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(valid))
+
+
+def _preprocessor(features: List[str]) -> ColumnTransformer:
+    return ColumnTransformer(transformers=[("cat", OneHotEncoder(handle_unknown="ignore"), features)])
+
+
+def fit_pipeline(X, y: np.ndarray, features: List[str], config: TrainConfig, label_encoder,
+                 category: str = "", n_jobs: Optional[int] = None) -> Tuple[Pipeline, Dict[str, Any]]:
+    """
+    One-Hot（疎行列）+ XGBoost の Pipeline を1つの設定で学習する
+
+    検証用に取り分けた行で early stopping してラウンド数と精度を決め、
+    そのラウンド数で全行を学習し直した Pipeline を返す
+
+    Args:
+        X: features 列を持つ DataFrame
+        y: LabelEncoder で 0..クラス数-1 にしたラベル
+
+    Returns:
+        (学習済み Pipeline, 学習結果の記録)
+    """
+    start = time.perf_counter()
+    num_class = len(label_encoder.classes_)
+    train_rows, valid_rows = validation_split(y, config.validation_fraction, config.random_state)
+    # 検証データがない（少なすぎる）ときは early stopping せずに上限まで学習
+    early_stopping = len(valid_rows) > 0
+    n_rounds = config.n_estimators
+    accuracy = None
+    if early_stopping:
+        probe_preprocessor = _preprocessor(features)
+        X_train = probe_preprocessor.fit_transform(X.iloc[train_rows])
+        X_valid = probe_preprocessor.transform(X.iloc[valid_rows])
+        probe = config.classifier(num_class, n_jobs=n_jobs, early_stopping=True)
+        probe.fit(X_train, y[train_rows], eval_set=[(X_valid, y[valid_rows])], verbose=False)
+        n_rounds = probe.best_iteration + 1
+        # 2クラスの softprob では predict が確率の行列を返すので、確率の最大で判定する（推論側と同じ）
+        predicted = probe.predict_proba(X_valid, iteration_range=(0, n_rounds)).argmax(axis=1)
+        accuracy = float(np.mean(predicted == y[valid_rows]))
+
+    # 決まったラウンド数で全行を学習し直す（検証用の行も保存するモデルの学習に使う）
+    preprocessor = _preprocessor(features)
+    classifier = replace(config, n_estimators=n_rounds).classifier(num_class, n_jobs=n_jobs, early_stopping=False)
+    classifier.fit(preprocessor.fit_transform(X), y, verbose=False)
+    fit_seconds = time.perf_counter() - start
+
+    pipeline = Pipeline([("preprocessor", preprocessor), ("classifier", classifier)])
+
+    report = {
+        "category": category,
+        "config": config.name,
+        "params": asdict(config),
+        "n_train": int(len(y)),               # 保存するモデルの学習に使った行数（全行）
+        "n_valid": int(len(valid_rows)),      # ラウンド数と精度を決めた検証用の行数
+        "n_classes": int(len(label_encoder.classes_)),
+        "n_rounds": int(n_rounds),
+        "fit_seconds": round(fit_seconds, 3),
+        "accuracy": accuracy,
+        "artifact_bytes": len(build_artifact(pipeline, label_encoder, category)),
+        "pickle_bytes": len(pickle.dumps((pipeline, label_encoder))),
+    }
+    return pipeline, report
+
+
+def _fit_task(category, X, y, features, config, label_encoder, n_jobs):
+    pipeline, report = fit_pipeline(X, y, features, config, label_encoder, category=category, n_jobs=n_jobs)
+    return category, pipeline, report
+
+
+def run_configs(tasks: List[Tuple[str, Any, np.ndarray, List[str], TrainConfig, Any]],
+                jobs: int = 1, n_jobs: Optional[int] = None) -> List[Tuple[str, Pipeline, Dict[str, Any]]]:
+    """
+    (カテゴリ, X, y, 特徴量, 設定, LabelEncoder) の組をそれぞれ学習する
+
+    jobs > 1 のときは組ごとにプロセスを分けて並列に学習する
+
+    Returns:
+        [(カテゴリ, 学習済み Pipeline, 学習結果の記録)]（終わった順）
+    """
+    if jobs <= 1:
+        return [_fit_task(*task, n_jobs) for task in tasks]
+    results = []
+    # データの多い組から投入して待ち時間を減らす
+    tasks = sorted(tasks, key=lambda t: len(t[2]), reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_fit_task, *task, n_jobs) for task in tasks]
+        for future in as_completed(futures):
+            results.append(future.result())
+    return results
+
+
+def best_result(results: List[Tuple[str, Pipeline, Dict[str, Any]]]) -> Tuple[str, Pipeline, Dict[str, Any]]:
+    """精度の高いもの（同じならモデルの小さいもの）を選ぶ"""
+    return max(results, key=lambda r: (r[2]["accuracy"] or 0.0, -r[2]["artifact_bytes"]))
+
+
+def print_reports(reports: List[Dict[str, Any]], selected: Optional[Dict[str, str]] = None) -> None:
+    """カテゴリ・設定ごとの学習時間・モデルサイズ・精度の表を出す（selected: {カテゴリ: 採用した設定}）"""
+    selected = selected or {}
+    print("📋 設定別の学習結果：", flush=True)
+    for report in sorted(reports, key=lambda r: (r["category"], r["config"])):
+        accuracy = "-" if report["accuracy"] is None else f"{report['accuracy']:.4f}"
+        mark = " ✅" if selected.get(report["category"]) == report["config"] else ""
+        print(f"- {report['category']} [{report['config']}] "
+              f"精度 {accuracy} | {report['n_rounds']} ラウンド | {report['fit_seconds']:.2f} 秒 | "
+              f"{report['artifact_bytes'] / 1024:.1f} KiB{mark}", flush=True)
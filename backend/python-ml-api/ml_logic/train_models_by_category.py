@@ -1,16 +1,23 @@
 import os
+import sys
+import json
 import time
+import argparse
+import tempfile
 import mysql.connector
 import pandas as pd
-from collections import defaultdict
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
-from sklearn.preprocessing import OneHotEncoder, LabelEncoder
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
-from xgboost import XGBClassifier
+from sklearn.preprocessing import LabelEncoder
+import xgboost as xgb
 import joblib
 from datetime import datetime
+from ml_logic.artifact import default_file_mode, write_artifact
+from ml_logic.dataset import TrainingDataset
+from ml_logic.features import TEMP_BIN_WIDTH
+from ml_logic.model_check import check_candidate, print_check, split_holdout
+from ml_logic.model_registry import artifact_path
+from ml_logic.train_config import (
+    TRAIN_SWEEP_GRID, TrainConfig, best_result, parse_grid, print_reports, run_configs, sweep_configs,
+)
 
 CATEGORY_NAME_MAP = {
     "トップス": "tops",
@@ -22,7 +29,18 @@ CATEGORY_NAME_MAP = {
 
 # モデル保存先を明示的に指定（/app/python-ml-api/models）
 MODEL_DIR = os.path.join("/app/python-ml-api/models")
-print(f"モデル保存先: {MODEL_DIR}")
+
+CATEGORICAL_FEATURES = ["user_id", "month", "day", "hour", "weekday", "weather", "temp_bin"]
+
+# MySQL から取り込んだ学習データの列指向キャッシュ
+DATASET_DIR = os.getenv("TRAINING_DATASET_DIR", os.path.join(MODEL_DIR, "training_dataset"))
+FETCH_CHUNK_SIZE = int(os.getenv("TRAINING_FETCH_CHUNK", "10000"))
+
+# 差分学習で既存モデルに追加する木の本数
+INCREMENTAL_ROUNDS = int(os.getenv("INCREMENTAL_ROUNDS", "20"))
+
+# 設定ごとの学習結果（学習時間・モデルサイズ・精度）の保存先
+TRAINING_REPORT_PATH = os.getenv("TRAINING_REPORT_PATH", os.path.join(MODEL_DIR, "training_report.json"))
 
 
 def get_db_connection(retries=5, delay=3):
@@ -41,141 +59,456 @@ def get_db_connection(retries=5, delay=3):
     raise Exception("DB connection failed after retries")
 
 
-def fetch_training_data():
+def fetch_training_chunks(since=None, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    学習データを (created_at, id) 順に chunk_size 行ずつ返すジェネレータ
+    （サーバー側カーソルで読むので全件をメモリに載せない）
+
+    Args:
+        since: (created_at, id) のウォーターマーク。指定時はそれより新しい行だけ返す
+    """
     conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("""
-        SELECT c.user_id, i.name AS clothing_item_name, c.created_at, i.category,
-               c.weather, c.temperature
-        FROM user_clothing_choices c
-        JOIN clothing_items i ON c.clothing_id = i.clothing_id
-        ORDER BY c.created_at
-    """)
-    results = cursor.fetchall()
-    conn.close()
-    return results
-
-
-def prepare_data(raw_data):
-    data_by_category = defaultdict(list)
-    for row in raw_data:
-        category = row["category"]
-        dt = row["created_at"]
-        features = {
-            "month": str(dt.month),
-            "day": str(dt.day),
-            "hour": str(dt.hour),
-            "weekday": str(dt.weekday()),
-            "user_id": str(row["user_id"]),
-            "weather": row.get("weather", "unknown"),
-            "temp_bin": str(int(row.get("temperature", 0) // 2)),
-        }
-        label = row["clothing_item_name"]
-        data_by_category[category].append((features, label))
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    where = ""
+    params = ()
+    if since is not None:
+        # created_at が同じ行を取りこぼさないよう id で順序を確定させる
+        where = "WHERE (c.created_at > %s OR (c.created_at = %s AND c.id > %s))"
+        params = (since[0], since[0], since[1])
+    try:
+        cursor.execute(f"""
+            SELECT c.id, c.user_id, c.created_at, i.category, i.name AS label,
+                   c.weather, c.temperature
+            FROM user_clothing_choices c
+            JOIN clothing_items i ON c.clothing_id = i.clothing_id
+            {where}
+            ORDER BY c.created_at, c.id
+        """, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def sync_dataset(dataset):
+    """前回取り込み以降の行だけを MySQL から列指向データセットに追記する"""
+    since = dataset.watermark
+    print(f"🚀 Syncing training dataset since {since} ...", flush=True)
+    appended = dataset.append(fetch_training_chunks(since=since))
+    print(f"📁 {dataset.root} に {appended} 件追記（累計 {dataset.load_state()['rows']} 件）", flush=True)
+    return appended
+
+
+def category_watermarks(frame):
+    """カテゴリごとの最新行 (created_at, id) を返す（frame は (created_at, id) 順）"""
+    last_rows = frame.groupby("category", observed=True, sort=False).tail(1)
+    return {
+        row.category: (row.created_at.to_pydatetime(), int(row.id))
+        for row in last_rows.itertuples(index=False)
+    }
+
+
+def prepare_data(frame):
+    """
+    データセットの行から特徴量を作り、カテゴリ別の DataFrame にまとめる
+
+    Returns:
+        {カテゴリ: CATEGORICAL_FEATURES + "label" 列の DataFrame}
+    """
+    created_at = frame["created_at"].dt
+    temperature = frame["temperature"].astype(float).fillna(0)
+    features = pd.DataFrame({
+        "month": created_at.month.astype(str),
+        "day": created_at.day.astype(str),
+        "hour": created_at.hour.astype(str),
+        "weekday": created_at.weekday.astype(str),
+        "user_id": frame["user_id"].astype(str),
+        "weather": frame["weather"].astype(object).fillna("unknown").astype(str),
+        # features.temp_bin と同じ定義（推論側と温度帯の幅を揃える）
+        "temp_bin": (temperature // TEMP_BIN_WIDTH).astype(int).astype(str),
+        "label": frame["label"].astype(str),
+    })
+    data_by_category = {}
+    for category, index in frame.groupby("category", observed=True, sort=False).groups.items():
+        data_by_category[category] = features.loc[index].reset_index(drop=True)
     return data_by_category
 
 
-def save_training_data_as_csv(data_by_category, output_path=os.path.join(MODEL_DIR, "training_data.csv")):
-    all_records = []
-    for category, data in data_by_category.items():
-        for features, label in data:
-            record = features.copy()
-            record["label"] = label
-            record["category"] = category
-            all_records.append(record)
+def model_paths(category):
+    filename_category = CATEGORY_NAME_MAP.get(category, category)
+    model_path = os.path.join(MODEL_DIR, f"{filename_category}_model.pkl")
+    meta_path = os.path.join(MODEL_DIR, f"{filename_category}_model.meta.json")
+    return model_path, meta_path
+
+
+def load_meta(category):
+    _, meta_path = model_paths(category)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    meta["watermark"] = (datetime.fromisoformat(meta["watermark"]["created_at"]), meta["watermark"]["id"])
+    return meta
+
+
+def save_model(category, pipeline, label_encoder, watermark, n_rows, mode, report=None):
+    """
+    モデル本体と、差分学習に必要なメタ情報（ウォーターマーク・語彙・ラベル）を並べて保存する
 
-    df = pd.DataFrame(all_records)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    df.to_csv(output_path, index=False)
-    print(f"📁 Exported training data to {output_path}（{len(df)} 件）", flush=True)
+    Args:
+        report: 全件学習のときの学習結果（採用した設定・精度など。メタ情報に残す）
+    """
+    model_path, meta_path = model_paths(category)
+    encoder = pipeline.named_steps["preprocessor"].named_transformers_["cat"]
+    meta = {
+        "watermark": {"created_at": watermark[0].isoformat(), "id": watermark[1]},
+        "vocabulary": {
+            feature: [str(v) for v in values]
+            for feature, values in zip(CATEGORICAL_FEATURES, encoder.categories_)
+        },
+        "classes": [str(c) for c in label_encoder.classes_],
+        # 保存するモデルのラウンド数（全件学習では early stopping で決めた数、差分学習では追加分を含む）
+        "n_rounds": pipeline.named_steps["classifier"].get_booster().num_boosted_rounds(),
+        "n_rows": n_rows,
+        "mode": mode,
+        "trained_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if report is not None:
+        meta["training"] = report
+    elif mode == "incremental":
+        # 差分更新では設定は変わらないので、前回の記録を引き継ぐ
+        previous = load_meta(category)
+        if previous is not None and "training" in previous:
+            meta["training"] = previous["training"]
+    atomic_write(model_path, lambda f: joblib.dump((pipeline, label_encoder), f))
+    atomic_write(meta_path, lambda f: f.write(json.dumps(meta, ensure_ascii=False, indent=2).encode("utf-8")))
+    print(f"✅ Saved model: {model_path}", flush=True)
 
+    # 推論用のモデルファイル（.pkl より後に書くので、推論側は新しい方として .bin を読む）
+    binary_path = artifact_path(category, MODEL_DIR)
+    size = write_artifact(binary_path, pipeline, label_encoder, category, metadata={
+        "watermark": meta["watermark"], "n_rows": n_rows, "mode": mode, "trained_at": meta["trained_at"],
+    })
+    print(f"✅ Exported model: {binary_path} ({size / 1024:.1f} KiB)", flush=True)
 
-def train_and_save_models(data_by_category):
+
+def gate_and_save(category, pipeline, label_encoder, watermark, n_rows, mode, report=None,
+                  gate=False, holdout=None):
+    """
+    モデルを保存する。gate のときは先に候補を一時ディレクトリに書き出して ml_logic.model_check で
+    デプロイ済みのモデルと比べ、レイテンシ・メモリ・精度が悪化していれば保存しない
+
+    Args:
+        holdout: 精度を測る行（学習に使っていない、特徴量 + label 列の DataFrame）
+
+    Returns:
+        保存したら True
+    """
+    if gate:
+        result = check_candidate(CATEGORY_NAME_MAP.get(category, category), pipeline, label_encoder,
+                                 MODEL_DIR, holdout)
+        print_check(result)
+        if not result["passed"]:
+            print(f"⛔ [{category}] デプロイ済みのモデルより悪化したため保存しません", flush=True)
+            return False
+    save_model(category, pipeline, label_encoder, watermark, n_rows, mode, report=report)
+    return True
+
+
+def atomic_write(path, write):
+    """
+    同じディレクトリの一時ファイルに書いてから os.replace で差し替える
+    （推論側が書き込み途中のファイルを読むことがない）
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, default_file_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def category_task(category, df, config):
+    """カテゴリのデータを1つの設定で学習するための引数（ml_logic.train_config.run_configs に渡す）"""
+    label_encoder = LabelEncoder()
+    y_encoded = label_encoder.fit_transform(df["label"])
+    return category, df.drop(columns=["label"]), y_encoded, CATEGORICAL_FEATURES, config, label_encoder
+
+
+def split_thread_budget(n_categories, jobs=None, threads=None):
+    """
+    スレッド予算をカテゴリ並列数と XGBoost のスレッド数に振り分ける
+
+    Returns:
+        (同時に学習するカテゴリ数, 1モデルあたりのスレッド数)
+    """
+    threads = threads or os.cpu_count() or 1
+    jobs = max(1, min(jobs or threads, n_categories, threads))
+    return jobs, max(1, threads // jobs)
+
+
+def write_report(reports, selected, path=None):
+    """設定ごとの学習結果と、カテゴリごとに採用した設定を JSON に保存する"""
+    path = path or TRAINING_REPORT_PATH
+    content = {
+        "trained_at": datetime.now().isoformat(timespec="seconds"),
+        "selected": selected,
+        "results": sorted(reports, key=lambda r: (r["category"], r["config"])),
+    }
+    atomic_write(path, lambda f: f.write(json.dumps(content, ensure_ascii=False, indent=2).encode("utf-8")))
+    print(f"📝 学習結果: {path}", flush=True)
+
+
+def train_and_save_models(data_by_category, watermarks, jobs=1, threads=None, configs=None, report_path=None,
+                          gate=False, holdout_by_category=None):
+    """
+    カテゴリ別モデルを学習して保存する
+
+    configs に複数の設定を渡すと（スイープ）、カテゴリ × 設定の組をすべて学習し、
+    カテゴリごとに検証データの精度が最も高いものを保存する。
+    jobs > 1 のときは組ごとにプロセスを分けて並列に学習する。
+    gate のときはデプロイ済みのモデルと比べて悪化していないものだけ保存する（gate_and_save）
+
+    Returns:
+        設定ごとの学習結果（ml_logic.train_config.fit_pipeline の記録）の一覧
+        （ゲートで保存しなかったカテゴリは、採用した記録の "gate" が "failed"）
+    """
     os.makedirs(MODEL_DIR, exist_ok=True)
+    configs = configs or [TrainConfig.from_env()]
+    tasks = []
     for category, data in data_by_category.items():
-        if not data:
+        if len(data) == 0:
             print(f"Skip: {category} (no data)", flush=True)
             continue
+        print(f"\n[{category}] データラベルの内訳", flush=True)
+        print(data["label"].value_counts(), flush=True)
+        tasks.extend(category_task(category, data, config) for config in configs)
+    if not tasks:
+        return []
 
-        print(f"\n----- [{category}] モデル学習開始 -----", flush=True)
-
-        df = pd.DataFrame([x[0] for x in data])
-        df["label"] = [x[1] for x in data]
-
-        X = df.drop(columns=["label"])
-        y = df["label"]
-
-        print("[データラベルの内訳]", flush=True)
-        print(y.value_counts(), flush=True)
-
-        categorical_features = ["user_id", "month", "day", "hour", "weekday", "weather", "temp_bin"]
-        preprocessor = ColumnTransformer(
-            transformers=[
-                ("cat", OneHotEncoder(handle_unknown="ignore"), categorical_features)
-            ]
-        )
-
-        label_encoder = LabelEncoder()
-        label_encoder.fit(y)
-        y_encoded = label_encoder.transform(y)
-        num_class = len(label_encoder.classes_)
-
-        pipeline = Pipeline([
-            ("preprocessor", preprocessor),
-            ("classifier", XGBClassifier(
-                use_label_encoder=False,
-                eval_metric='mlogloss',
-                objective="multi:softprob",
-                num_class=num_class,
-                random_state=42,
-                max_depth=6,         # ← 木の深さ（精度向上に効く）
-                learning_rate=0.1,   # ← 学習率（小さいと精度上がるが学習時間増）
-                n_estimators=200     # ← 木の本数（増やすと精度UPすることも）
-            ))
-        ])
-
-        if len(df) < 2:
-            print("⚠️ データが1件以下のため全件で学習", flush=True)
-            pipeline.fit(X, y_encoded)
-        else:
-            X_train, X_test, y_train, y_test = train_test_split(X, y_encoded, test_size=0.2, random_state=42)
-            pipeline.fit(X_train, y_train)
-            y_pred = pipeline.predict(X_test)
-            acc = accuracy_score(y_test, y_pred)
-            print(f"[{category}] Accuracy: {acc:.4f}", flush=True)
-
-            print("\n[予測結果サンプル]", flush=True)
-            for i in range(min(5, len(y_test))):
-                actual = label_encoder.inverse_transform([y_test[i]])[0]
-                pred = label_encoder.inverse_transform([y_pred[i]])[0]
-                print(f"  実際: {actual} | 予測: {pred}", flush=True)
-
-        filename_category = CATEGORY_NAME_MAP.get(category, category)
-        model_path = os.path.join(MODEL_DIR, f"{filename_category}_model.pkl")
-        joblib.dump((pipeline, label_encoder), model_path)
-        print(f"✅ Saved model: {model_path}", flush=True)
-        print(f"----- [{category}] モデル学習終了 -----\n", flush=True)
+    jobs, n_jobs = split_thread_budget(len(tasks), jobs, threads)
+    print(f"⚙️ 並列数: {jobs} 組（{len(tasks) // len(configs)} カテゴリ × {len(configs)} 設定）"
+          f" × XGBoost {n_jobs} スレッド", flush=True)
 
+    started = time.perf_counter()
+    label_encoders = {task[0]: task[5] for task in tasks}
+    results_by_category = {}
+    for category, pipeline, report in run_configs(tasks, jobs=jobs, n_jobs=n_jobs):
+        results_by_category.setdefault(category, []).append((category, pipeline, report))
 
-if __name__ == "__main__":
-    print("🚀 Fetching training data from DB...", flush=True)
-    raw_data = fetch_training_data()
+    selected = {}
+    for category, results in results_by_category.items():
+        _, pipeline, report = best_result(results)
+        selected[category] = report["config"]
+        saved = gate_and_save(category, pipeline, label_encoders[category], watermarks[category],
+                              len(data_by_category[category]), "full", report=report,
+                              gate=gate, holdout=(holdout_by_category or {}).get(category))
+        if gate:
+            report["gate"] = "passed" if saved else "failed"
 
-    if not raw_data:
+    reports = [report for results in results_by_category.values() for _, _, report in results]
+    print_reports(reports, selected)
+    print(f"- 全体: {time.perf_counter() - started:.2f} 秒", flush=True)
+    write_report(reports, selected, report_path)
+    return reports
+
+
+class FullRebuildRequired(Exception):
+    """ラベルや語彙が増えたため差分更新できない"""
+
+
+def update_category(category, df, pipeline, label_encoder, meta):
+    """
+    既存モデルに新しい行だけで木を追加する（ブースターの継続学習）
+
+    Raises:
+        FullRebuildRequired: 未知のラベル・特徴量の値が含まれる場合
+    """
+    labels = df["label"].tolist()
+
+    unknown_labels = set(labels) - set(meta["classes"])
+    if unknown_labels:
+        raise FullRebuildRequired(f"新しいラベル: {sorted(unknown_labels)}")
+    for feature in CATEGORICAL_FEATURES:
+        unknown_values = set(df[feature].astype(str)) - set(meta["vocabulary"][feature])
+        if unknown_values:
+            raise FullRebuildRequired(f"{feature} の新しい値: {sorted(unknown_values)}")
+
+    preprocessor = pipeline.named_steps["preprocessor"]
+    classifier = pipeline.named_steps["classifier"]
+    X_new = preprocessor.transform(df.drop(columns=["label"]))
+    y_new = label_encoder.transform(labels)
+
+    # sklearn ラッパーは y に全クラスが揃っていることを要求するので、ネイティブ API で継続学習する
+    booster = classifier.get_booster()
+    params = classifier.get_xgb_params()
+    params["num_class"] = len(label_encoder.classes_)
+    params = {k: v for k, v in params.items() if v is not None}
+    updated = xgb.train(params, xgb.DMatrix(X_new, label=y_new), num_boost_round=INCREMENTAL_ROUNDS, xgb_model=booster)
+    classifier._Booster = updated
+    classifier.n_estimators = updated.num_boosted_rounds()
+    return pipeline
+
+
+def incremental_train(jobs=None, threads=None, configs=None, gate=False):
+    """
+    前回のウォーターマーク以降の行だけでモデルを更新する
+    （メタ情報がない・ラベルや語彙が増えたカテゴリは全件で作り直す）
+
+    gate のときは新しい行のうち最新側を精度の検証に回し、ウォーターマークは学習に使った行までにする
+    （検証に回した行は次回の差分更新で学習する）
+
+    Returns:
+        ゲートで保存しなかったカテゴリの一覧
+    """
+    metas = {}
+    for category in set(CATEGORY_NAME_MAP) | set(CATEGORY_NAME_MAP.values()):
+        meta = load_meta(category)
+        if meta is not None:
+            metas[CATEGORY_NAME_MAP.get(category, category)] = meta
+
+    dataset = TrainingDataset(DATASET_DIR)
+    sync_dataset(dataset)
+
+    since = min((m["watermark"] for m in metas.values()), default=None)
+    # ウォーターマークの日付より前のパーティションは読まない
+    frame = dataset.to_pandas(since_date=since[0].date().isoformat() if since else None)
+    if since is not None:
+        newer = (frame["created_at"] > since[0]) | ((frame["created_at"] == since[0]) & (frame["id"] > since[1]))
+        frame = frame[newer].reset_index(drop=True)
+    if frame.empty:
+        print("✅ 新しい行はありません", flush=True)
+        return []
+
+    rebuild = set()
+    rejected = []
+    new_watermarks = category_watermarks(frame)
+    for category in new_watermarks:
+        meta = metas.get(CATEGORY_NAME_MAP.get(category, category))
+        model_path, _ = model_paths(category)
+        if meta is None or not os.path.exists(model_path):
+            print(f"[{category}] メタ情報がないため全件で再学習します", flush=True)
+            rebuild.add(category)
+            continue
+
+        # カテゴリごとのウォーターマークより新しい行だけ使う
+        mark_time, mark_id = meta["watermark"]
+        rows = frame[(frame["category"] == category) & (
+            (frame["created_at"] > mark_time) | ((frame["created_at"] == mark_time) & (frame["id"] > mark_id))
+        )]
+        held = None
+        if gate:
+            rows, held = split_holdout(rows)
+        if rows.empty:
+            continue
+        data = prepare_data(rows)[category]
+        pipeline, label_encoder = joblib.load(model_path)
+        try:
+            update_category(category, data, pipeline, label_encoder, meta)
+        except FullRebuildRequired as e:
+            print(f"[{category}] {e} → 全件で再学習します", flush=True)
+            rebuild.add(category)
+            continue
+
+        print(f"[{category}] 差分更新: {len(rows)} 件, 木 {INCREMENTAL_ROUNDS} 本追加", flush=True)
+        holdout = prepare_data(held).get(category) if gate else None
+        if not gate_and_save(category, pipeline, label_encoder, category_watermarks(rows)[category],
+                             meta["n_rows"] + len(rows), "incremental", gate=gate, holdout=holdout):
+            rejected.append(category)
+
+    if rebuild:
+        full = dataset.to_pandas()
+        full = full[full["category"].isin(rebuild)].reset_index(drop=True)
+        holdout_by_category = None
+        if gate:
+            full, held = split_holdout(full)
+            holdout_by_category = prepare_data(held)
+        reports = train_and_save_models(prepare_data(full), category_watermarks(full), jobs=jobs, threads=threads,
+                                        configs=configs, gate=gate, holdout_by_category=holdout_by_category)
+        rejected.extend(r["category"] for r in reports if r.get("gate") == "failed")
+    return rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="カテゴリ別モデルの学習")
+    parser.add_argument("--incremental", action="store_true",
+                        help="前回学習以降の行だけで既存モデルを更新する（必要なカテゴリのみ全件再学習）")
+    parser.add_argument("--jobs", type=int, default=int(os.getenv("TRAIN_JOBS", "0")) or None,
+                        help="同時に学習するカテゴリ数（既定: スレッド予算とカテゴリ数の小さい方）")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("TRAIN_THREADS", "0")) or None,
+                        help="学習全体で使うスレッド数（既定: CPU コア数）")
+    parser.add_argument("--no-sync", action="store_true",
+                        help="MySQL から取り込まず、手元のデータセットだけで学習する")
+    parser.add_argument("--sweep", action="store_true",
+                        help="--grid の設定をすべて試し、カテゴリごとに精度の最も高いモデルを保存する")
+    parser.add_argument("--grid", default=TRAIN_SWEEP_GRID,
+                        help="スイープで試す値（例: \"max_depth=3,6;learning_rate=0.1,0.3\"）")
+    parser.add_argument("--report", default=TRAINING_REPORT_PATH,
+                        help="設定ごとの学習結果（学習時間・モデルサイズ・精度）の保存先")
+    parser.add_argument("--gate", action="store_true", default=os.getenv("TRAIN_GATE", "0") == "1",
+                        help="保存前にデプロイ済みのモデルと比べ、悪化したカテゴリは上書きしない（1つでもあれば終了コード 1）")
+    args = parser.parse_args()
+    print(f"モデル保存先: {MODEL_DIR}")
+
+    configs = [TrainConfig.from_env()]
+    if args.sweep:
+        configs = sweep_configs(configs[0], parse_grid(args.grid))
+        print(f"🔬 スイープ: {len(configs)} 設定", flush=True)
+
+    if args.incremental:
+        rejected = incremental_train(jobs=args.jobs, threads=args.threads, configs=configs, gate=args.gate)
+        if rejected:
+            print(f"❌ ゲートで保存しなかったカテゴリ: {rejected}", flush=True)
+            sys.exit(1)
+        print("✅ Training complete.", flush=True)
+        return
+
+    dataset = TrainingDataset(DATASET_DIR)
+    if not args.no_sync:
+        sync_dataset(dataset)
+
+    print("📂 Loading training dataset...", flush=True)
+    frame = dataset.to_pandas()
+
+    if frame.empty:
         print("⚠ No training data found. Exiting.", flush=True)
-        exit(1)
+        sys.exit(1)
+
+    holdout_by_category = None
+    if args.gate:
+        # 最新側の行は学習に使わず、デプロイ済みとの精度比較に使う（次回の差分更新で学習する）
+        frame, held = split_holdout(frame)
+        holdout_by_category = prepare_data(held)
+        print(f"🧪 ゲート用に {len(held)} 件を学習から外しました", flush=True)
 
     print("🧹 Preparing data...", flush=True)
-    data_by_category = prepare_data(raw_data)
+    data_by_category = prepare_data(frame)
 
     print("📊 カテゴリ別データ数：", flush=True)
     for category, items in data_by_category.items():
         print(f"- {category}: {len(items)} 件", flush=True)
 
-    print("📦 Saving training data to CSV...", flush=True)
-    save_training_data_as_csv(data_by_category)
-
     print("🧠 Training models by category...", flush=True)
-    train_and_save_models(data_by_category)
+    reports = train_and_save_models(data_by_category, category_watermarks(frame), jobs=args.jobs,
+                                    threads=args.threads, configs=configs, report_path=args.report,
+                                    gate=args.gate, holdout_by_category=holdout_by_category)
+
+    rejected = [r["category"] for r in reports if r.get("gate") == "failed"]
+    if rejected:
+        print(f"❌ ゲートで保存しなかったカテゴリ: {rejected}", flush=True)
+        sys.exit(1)
+    print("✅ Training complete.", flush=True)
 
-    print("✅ Training complete.", flush=True)
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""
+書き込みの後回し（write-behind）キュー
+
+受け付けた記録をプロセス内の上限付きキューに積んですぐ応答し、バックグラウンドのスレッドが
+件数（batch_size）か時間（flush_interval 秒）のどちらかに達したらまとめて flush_fn に渡す。
+
+- キューが一杯のときは put_timeout 秒まで空きを待ち、それでも空かなければ QueueFull（呼び出し側で 503）
+- journal_dir を指定すると、受け付けた記録を追記専用のジャーナル（JSON Lines）に書いてからキューに積む。
+  書き込み済みになった位置は {"ack": 連番} の行で記録し、再起動時に ack されていない記録を積み直す
+  （異常終了したプロセスのジャーナルも flock で引き取る）。ジャーナルへの追記（と fsync）は
+  ファイル I/O なので、asubmit ではイベントループの外（スレッド）で行う
+- 引き取りは起動後に別スレッドで行い、終わるまでは新しい記録を受け付けない（ack の順序を崩さないため）
+- stop() はキューに残った記録をすべて書き込んでから止める
+- 一時的な失敗（is_transient が True の例外。DB 接続断など）は間隔を空けて同じまとまりを
+  max_retries 回まで再試行する。それ以外の例外と、再試行しきっても書けなかったまとまりは
+  1件ずつ書き直して、書けないものだけ退避する（退避先は journal_dir の {name}-rejected.jsonl とログ）
+"""
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from ml_logic.metrics import log_event, metrics
+
+write_behind_records = metrics.counter(
+    "write_behind_records_total", "write-behind キューの記録数（結果別）", ("queue", "result"))
+write_behind_flush_duration = metrics.histogram(
+    "write_behind_flush_seconds", "write-behind キューのまとめ書き1回の所要時間", ("queue",))
+
+
+class QueueFull(Exception):
+    """キューが一杯（または停止中）で受け付けられない"""
+
+
+class WriteBehindQueue:
+    def __init__(self, name: str, flush_fn: Callable[[List[Any]], None], *,
+                 max_size: int = 10000, batch_size: int = 500, flush_interval: float = 1.0,
+                 put_timeout: float = 2.0, journal_dir: Optional[str] = None, fsync: bool = False,
+                 is_transient: Callable[[BaseException], bool] = lambda e: False,
+                 retry_max_seconds: float = 30.0, max_retries: int = 8):
+        self.name = name
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.is_transient = is_transient
+        self.retry_max_seconds = retry_max_seconds
+        self.max_retries = max_retries
+
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()     # 連番の採番・ジャーナル追記・キューへの投入をまとめて行う（fsync は外）
+        self._seq = 0
+        self._pending = 0                 # 受け付けてまだ書き込んでいない件数
+        self._journal = None
+        self._journal_path = None
+        self._closed = True
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._recovery: Optional[threading.Thread] = None
+        self.flushed = 0
+        self.batches = 0
+        self.rejected = 0
+        self.dead_letters = 0
+        self.last_error: Optional[str] = None
+
+    # --- 受け付け ---
+
+    def _offer(self, record: Any) -> bool:
+        """空きがあればジャーナルに書いてからキューに積む（一杯なら False）"""
+        with self._lock:
+            if self._closed:
+                raise QueueFull(f"{self.name} の書き込みキューは停止中です")
+            if self._queue.full():
+                return False
+            self._seq += 1
+            self._append_journal({"seq": self._seq, "record": record})
+            # 取り出すのは flusher だけなので、full() を見た後の put が待たされることはない
+            self._queue.put_nowait((self._seq, record))
+            self._pending += 1
+        # fsync はロックの外で（同時に受け付けた記録の fsync はまとめて終わる）
+        self._sync_journal()
+        write_behind_records.inc(self.name, "accepted")
+        return True
+
+    async def _aoffer(self, record: Any) -> bool:
+        if self._journal is None:
+            return self._offer(record)
+        # ジャーナルへの追記はディスク次第で待たされるので、イベントループの外で行う
+        return await asyncio.to_thread(self._offer, record)
+
+    def _reject(self) -> QueueFull:
+        with self._lock:
+            self.rejected += 1
+        write_behind_records.inc(self.name, "rejected")
+        return QueueFull(f"{self.name} の書き込みキューが一杯です")
+
+    def submit(self, record: Any) -> None:
+        """
+        記録を受け付ける（待たない）
+
+        Raises:
+            QueueFull: キューが一杯・停止中の場合
+        """
+        if not self._offer(record):
+            raise self._reject()
+
+    async def asubmit(self, record: Any) -> None:
+        """
+        記録を受け付ける。一杯なら put_timeout 秒まで空きを待つ（イベントループは塞がない）
+
+        Raises:
+            QueueFull: 待っても空かなかった・停止中の場合
+        """
+        deadline = time.monotonic() + self.put_timeout
+        delay = 0.005
+        while not await self._aoffer(record):
+            if time.monotonic() + delay > deadline:
+                raise self._reject()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    # --- 起動・停止 ---
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping = False
+        if self.journal_dir:
+            self._open_journal()
+        self._thread = threading.Thread(target=self._run, name=f"write-behind-{self.name}", daemon=True)
+        self._thread.start()
+        if self.journal_dir:
+            # 引き取りはキューの空きを待つことがあるので、呼び出し元（起動処理）を待たせない
+            self._recovery = threading.Thread(
+                target=self._recover_then_open, name=f"write-behind-{self.name}-recovery", daemon=True)
+            self._recovery.start()
+        else:
+            self._closed = False
+
+    def _recover_then_open(self) -> None:
+        try:
+            self._recover_orphans()
+        except Exception as e:
+            log_event("write_behind_recovery_failed", queue=self.name, error=str(e))
+        finally:
+            with self._lock:
+                if not self._stopping:
+                    self._closed = False
+
+    def stop(self, timeout: float = 30.0) -> bool:
+        """
+        受け付けを止め、キューに残った記録を書き切ってから止める
+
+        Returns:
+            すべて書き込めたら True（書き切れなかった分はジャーナルに残り、次回起動時に書く）
+        """
+        with self._lock:
+            self._closed = True
+            self._stopping = True
+        thread = self._thread
+        if thread is None:
+            return True
+        deadline = time.monotonic() + timeout
+        if self._recovery is not None:
+            # 引き取り中なら積み残しを自分のジャーナルに残して止まる
+            self._recovery.join(max(0.0, deadline - time.monotonic()))
+            self._recovery = None
+        try:
+            # 終了の合図（一杯でも flusher が取り出せば空く）
+            self._queue.put((None, None), timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(max(0.0, deadline - time.monotonic()))
+        self._thread = None
+        drained = not thread.is_alive() and self._pending == 0
+        log_event("write_behind_stopped", queue=self.name, drained=drained, pending=self._pending)
+        if self._journal is not None and drained:
+            # すべて書き込めたのでジャーナルは不要（残すのは書き切れなかったときだけ）
+            self._journal.close()
+            self._journal = None
+            os.remove(self._journal_path)
+        return drained
+
+    # --- 書き込み ---
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            stopping = item[0] is None
+            batch = [] if stopping else [item]
+            # 件数か時間のどちらかに達するまで集める
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not stopping:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item[0] is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._flush(batch)
+            if stopping:
+                self._drain()
+                return
+
+    def _drain(self) -> None:
+        # 停止時: 残りを batch_size ずつ書き切る
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] is not None:
+                    batch.append(item)
+            if not batch:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch: List[tuple]) -> None:
+        records = [record for _, record in batch]
+        delay = min(0.5, self.retry_max_seconds)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                self.flush_fn(records)
+                break
+            except Exception as e:
+                self.last_error = str(e)
+                if not self.is_transient(e):
+                    # 記録の問題かコードの不具合: 待っても直らないので、書けない記録だけを探して退避する
+                    self._flush_one_by_one(records, retry_transient=True)
+                    break
+                if attempt == self.max_retries:
+                    # 再試行しきっても書けない: 止まり続けないよう1件ずつ書き、書けないものだけ退避する
+                    self._flush_one_by_one(records, retry_transient=False)
+                    break
+                # 一時的な失敗: 同じまとまりを間隔を空けて再試行（その間に新しい記録はキューに溜まる）
+                log_event("write_behind_retry", queue=self.name, size=len(records), error=str(e), delay=delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+            finally:
+                write_behind_flush_duration.observe(time.perf_counter() - start, self.name)
+        with self._lock:
+            self._pending -= len(batch)
+            self.flushed += len(batch)
+            self.batches += 1
+            self._append_journal({"ack": batch[-1][0]})
+            if self._pending == 0:
+                self._compact_journal()
+        self._sync_journal()
+        write_behind_records.inc(self.name, "flushed", amount=len(batch))
+
+    def _flush_one_by_one(self, records: List[Any], retry_transient: bool) -> None:
+        """
+        1件ずつ書き、書けない記録だけ退避する
+
+        retry_transient が False（まとまりで再試行しきった後）なら、一時的な失敗も待たずに退避する
+        （接続断が続いている間に1件ずつ再試行すると、flusher が件数分止まる）
+        """
+        for record in records:
+            try:
+                self.flush_fn([record])
+            except Exception as e:
+                self.last_error = str(e)
+                if retry_transient and self.is_transient(e):
+                    # 1件ずつにしても一時的な失敗なら、その1件は max_retries 回まで再試行する
+                    self._retry_single(record)
+                else:
+                    self._dead_letter(record, e)
+
+    def _retry_single(self, record: Any) -> None:
+        delay = min(0.5, self.retry_max_seconds)
+        for attempt in range(self.max_retries):
+            time.sleep(delay)
+            try:
+                self.flush_fn([record])
+                return
+            except Exception as e:
+                self.last_error = str(e)
+                if not self.is_transient(e) or attempt == self.max_retries - 1:
+                    self._dead_letter(record, e)
+                    return
+                delay = min(delay * 2, self.retry_max_seconds)
+
+    def _dead_letter(self, record: Any, error: BaseException) -> None:
+        self.dead_letters += 1
+        write_behind_records.inc(self.name, "dead_letter")
+        log_event("write_behind_dead_letter", queue=self.name, error=str(error), record=record)
+        if self.journal_dir:
+            path = os.path.join(self.journal_dir, f"{self.name}-rejected.jsonl")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"error": str(error), "record": record}, ensure_ascii=False, default=str) + "\n")
+
+    # --- ジャーナル ---
+
+    def _open_journal(self) -> None:
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._journal_path = os.path.join(self.journal_dir, f"{self.name}-{os.getpid()}-{int(time.time())}.jsonl")
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+        # 生きている間はロックを持ち、他プロセスに引き取られないようにする
+        fcntl.flock(self._journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _append_journal(self, entry: Dict[str, Any]) -> None:
+        if self._journal is None:
+            return
+        self._journal.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        self._journal.flush()  # プロセスが落ちても OS には渡っている
+
+    def _sync_journal(self) -> None:
+        # OS ごと落ちても残す（fsync=True のとき。ロックを持たずに呼ぶ）
+        journal = self._journal
+        if not self.fsync or journal is None:
+            return
+        try:
+            os.fsync(journal.fileno())
+        except (OSError, ValueError):
+            # 停止処理で閉じられた後なら、記録はすべて書き込み済み
+            if self._journal is journal:
+                raise
+
+    def _compact_journal(self) -> None:
+        # すべて書き込み済みなら中身は不要なので切り詰める
+        if self._journal is not None:
+            self._journal.truncate(0)
+            self._journal.seek(0)
+
+    def _recover_orphans(self) -> None:
+        """異常終了したプロセスのジャーナルから、書き込まれていない記録を引き取る"""
+        pattern = os.path.join(self.journal_dir, f"{self.name}-*.jsonl")
+        for path in sorted(glob.glob(pattern)):
+            if path == self._journal_path or path.endswith("-rejected.jsonl"):
+                continue
+            try:
+                f = open(path, "r+", encoding="utf-8")
+            except OSError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # 持ち主のプロセスが生きている
+                try:
+                    # 別のプロセスが引き取って消した後のファイルなら何もしない
+                    if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                records = self._unacked(f)
+                # 先に自分のジャーナルへ移してから元のファイルを消す（以降はキューに積めなくても失わない）
+                with self._lock:
+                    items = []
+                    for record in records:
+                        self._seq += 1
+                        self._append_journal({"seq": self._seq, "record": record})
+                        items.append((self._seq, record))
+                    self._pending += len(items)
+                self._sync_journal()
+                os.remove(path)
+            if records:
+                log_event("write_behind_recovered", queue=self.name, path=path, records=len(records))
+            if not self._requeue(items):
+                return
+
+    def _requeue(self, items: List[tuple]) -> bool:
+        """引き取った記録をキューに積む（上限を超えても取りこぼさないよう空きを待つ。停止したら False）"""
+        for item in items:
+            while True:
+                try:
+                    self._queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    if self._stopping:
+                        # 積めなかった分は自分のジャーナルに残っているので、次回起動時に書く
+                        return False
+        return True
+
+    @staticmethod
+    def _unacked(f) -> List[Any]:
+        entries = []
+        acked = 0
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # 書きかけの最終行
+            if "ack" in entry:
+                acked = max(acked, entry["ack"])
+            else:
+                entries.append(entry)
+        return [entry["record"] for entry in entries if entry["seq"] > acked]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self._queue.qsize(),
+            "max_size": self._queue.maxsize,
+            "pending": self._pending,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "rejected": self.rejected,
+            "dead_letters": self.dead_letters,
+            "journal": self._journal_path,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+
+# 各モジュールが import 時に環境変数を読むので先に読み込む
+load_dotenv()
+
+from db import close_async_pool, pool
+from ml_logic.clients import aclose_clients
+from ml_logic.prescore import run_prescore
+
+
+async def run(args):
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                summary = await run_prescore(dry_run=args.dry_run)
+            except Exception as e:
+                print(f"❌ 事前計算に失敗: {e}")
+                if not args.loop:
+                    raise
+            else:
+                if args.dry_run:
+                    for row in summary["rows"]:
+                        print(f"  {row['user_id']} {row['target_hour']:%m/%d %H時} "
+                              f"{row['weather']} {row['temperature']}℃ {row['recommendations']}")
+                    summary["rows"] = len(summary["rows"])
+                print(f"✅ 事前計算 ({time.perf_counter() - start:.1f}s): {summary}")
+            if not args.loop:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        await aclose_clients()
+        await close_async_pool()
+        pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="天気予報から推薦を事前計算して保存する")
+    parser.add_argument("--dry-run", action="store_true", help="保存せずに結果を表示する")
+    parser.add_argument("--loop", action="store_true", help="--interval 秒ごとに繰り返す")
+    parser.add_argument("--interval", type=float, default=3600)
+    asyncio.run(run(parser.parse_args()))
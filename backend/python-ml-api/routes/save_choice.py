@@ -1,6 +1,11 @@
+import os
 from fastapi import APIRouter, HTTPException, Request
-from datetime import date
-from db import get_connection  # ← これを使う
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from datetime import date, datetime
+from crud import is_transient_write_error, save_clothing_choice_batch, save_clothing_choices
+from ml_logic.metrics import metrics
+from ml_logic.write_behind import QueueFull, WriteBehindQueue
 
 router = APIRouter()
 
@@ -12,61 +17,117 @@ CATEGORY_NAME_MAP = {
     "小物": "accessory",
 }
 
-@router.post("/api/v1/save_choice")
-async def save_choice(request: Request):
-    try:
-        body = await request.json()
-        user_id = body.get("user_id")
-        choice = body.get("choice", {})
-        weather = body.get("weather")
-        temperature = body.get("temperature")
-        is_recommended = body.get("is_recommended", 0)
+# 保存方式
+#   sync    … その場で DB に書いてから応答（従来どおり）
+#   queue   … プロセス内のキューに積んで即応答し、裏でまとめて書く（異常終了時は未書き込み分を失う）
+#   journal … queue に加えてローカルのジャーナルに追記してから応答（再起動時に未書き込み分を書く）
+SAVE_CHOICE_MODE = os.getenv("SAVE_CHOICE_MODE", "sync")
+SAVE_CHOICE_QUEUE_SIZE = int(os.getenv("SAVE_CHOICE_QUEUE_SIZE", "10000"))
+SAVE_CHOICE_BATCH_SIZE = int(os.getenv("SAVE_CHOICE_BATCH_SIZE", "500"))
+SAVE_CHOICE_FLUSH_INTERVAL = float(os.getenv("SAVE_CHOICE_FLUSH_INTERVAL", "1"))
+# キューが一杯のとき空きを待つ秒数（過ぎたら 503）
+SAVE_CHOICE_PUT_TIMEOUT = float(os.getenv("SAVE_CHOICE_PUT_TIMEOUT", "2"))
+SAVE_CHOICE_JOURNAL_DIR = os.getenv("SAVE_CHOICE_JOURNAL_DIR", "cache/journal")
+SAVE_CHOICE_JOURNAL_FSYNC = os.getenv("SAVE_CHOICE_JOURNAL_FSYNC", "0") == "1"
+# 一時的な失敗（DB 接続断など）を再試行する回数（超えたらジャーナルの隣の *-rejected.jsonl に退避）
+SAVE_CHOICE_MAX_RETRIES = int(os.getenv("SAVE_CHOICE_MAX_RETRIES", "8"))
+# シャットダウン時にキューを書き切るまで待つ秒数
+SAVE_CHOICE_DRAIN_TIMEOUT = float(os.getenv("SAVE_CHOICE_DRAIN_TIMEOUT", "30"))
+
+choice_writer = None
+if SAVE_CHOICE_MODE in ("queue", "journal"):
+    choice_writer = WriteBehindQueue(
+        "choices",
+        save_clothing_choice_batch,
+        max_size=SAVE_CHOICE_QUEUE_SIZE,
+        batch_size=SAVE_CHOICE_BATCH_SIZE,
+        flush_interval=SAVE_CHOICE_FLUSH_INTERVAL,
+        put_timeout=SAVE_CHOICE_PUT_TIMEOUT,
+        journal_dir=SAVE_CHOICE_JOURNAL_DIR if SAVE_CHOICE_MODE == "journal" else None,
+        fsync=SAVE_CHOICE_JOURNAL_FSYNC,
+        is_transient=is_transient_write_error,
+        max_retries=SAVE_CHOICE_MAX_RETRIES,
+    )
+    metrics.gauge_callback(
+        "write_behind_queue_depth", "write-behind キューに溜まっている記録数", ("queue",),
+        lambda: [(("choices",), choice_writer.stats()["depth"])],
+    )
+
+def start_choice_writer():
+    # 前回異常終了したプロセスのジャーナルがあれば、ここで積み直す
+    if choice_writer is not None:
+        choice_writer.start()
 
-        if not user_id or not choice:
-            raise HTTPException(status_code=400, detail="ユーザーIDと服装データは必須です")
+def stop_choice_writer():
+    # 受け付け済みの選択を書き切ってから終わる（DB の接続プールを閉じる前に呼ぶ）
+    if choice_writer is not None:
+        choice_writer.stop(SAVE_CHOICE_DRAIN_TIMEOUT)
 
-        conn = get_connection()
-        cursor = conn.cursor()
+def _validate(body):
+    """リクエストを検証して保存用の値にする（write-behind では応答後に直せないので先に弾く）"""
+    user_id = body.get("user_id")
+    choice = body.get("choice", {})
+    weather = body.get("weather")
+    temperature = body.get("temperature")
+    is_recommended = body.get("is_recommended", 0)
 
-        for category_jp, item_name in choice.items():
-            category_en = CATEGORY_NAME_MAP.get(category_jp, category_jp)
+    if not user_id or not choice:
+        raise HTTPException(status_code=400, detail="ユーザーIDと服装データは必須です")
+    if not isinstance(choice, dict) or not all(isinstance(v, str) and v for v in choice.values()):
+        raise HTTPException(status_code=400, detail="服装データは {カテゴリ: アイテム名} の形式で指定してください")
+    try:
+        user_id = int(user_id)
+        temperature = float(temperature) if temperature is not None else None
+        is_recommended = int(is_recommended)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="user_id / temperature / is_recommended の形式が不正です")
 
-            # 服装アイテムが既にあるか確認
-            cursor.execute("""
-                SELECT clothing_id FROM clothing_items
-                WHERE name = %s AND category = %s
-            """, (item_name, category_en))
-            result = cursor.fetchone()
+    items = [
+        (item_name, CATEGORY_NAME_MAP.get(category_jp, category_jp))
+        for category_jp, item_name in choice.items()
+    ]
+    return user_id, items, weather, temperature, is_recommended
 
-            if result:
-                clothing_id = result[0]
-            else:
-                # 新規登録
-                cursor.execute("""
-                    INSERT INTO clothing_items (name, category)
-                    VALUES (%s, %s)
-                """, (item_name, category_en))
-                clothing_id = cursor.lastrowid
+@router.post("/api/v1/save_choice")
+async def save_choice(request: Request):
+    try:
+        body = await request.json()
+        user_id, items, weather, temperature, is_recommended = _validate(body)
 
-            # 選択記録を保存
-            cursor.execute("""
-                INSERT INTO user_clothing_choices (
-                    user_id, clothing_id, choice_date, weather, temperature, is_recommended
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                user_id,
-                clothing_id,
-                date.today(),
-                weather,
-                temperature,
-                is_recommended
-            ))
+        if choice_writer is not None:
+            # キューに積んで即応答（DB への書き込みは裏でまとめて行う）
+            try:
+                await choice_writer.asubmit({
+                    "user_id": user_id,
+                    "items": items,
+                    "choice_date": date.today().isoformat(),
+                    "weather": weather,
+                    "temperature": temperature,
+                    "is_recommended": is_recommended,
+                    "created_at": datetime.now().isoformat(sep=" ", timespec="seconds"),
+                })
+            except QueueFull as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+            return JSONResponse(status_code=202, content={"message": "服装の選択を受け付けました"})
 
-        conn.commit()
-        cursor.close()
-        conn.close()
+        # アイテムIDはキャッシュから解決し、選択記録は複数行 INSERT 1回で保存
+        # （DB 処理はブロッキングなのでスレッドプールで実行する）
+        await run_in_threadpool(
+            save_clothing_choices,
+            user_id, items, date.today(), weather, temperature, is_recommended,
+        )
 
         return {"message": "服装の選択を保存しました"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"❌ サーバーエラー: {str(e)}")
+
+@router.get("/api/v1/save_choice/stats")
+def save_choice_stats():
+    # write-behind キューの状態（sync モードでは mode だけ）
+    stats = {"mode": SAVE_CHOICE_MODE}
+    if choice_writer is not None:
+        stats.update(choice_writer.stats())
+    return stats
@@ -0,0 +1,82 @@
+"""
+ClothingItemCache の動作確認（MySQL の代わりに照合順序を真似た偽の接続を使う）
+
+    cd backend/python-ml-api
+    python -m pytest -q test_crud.py
+"""
+import unicodedata
+
+from crud import ClothingItemCache
+
+
+def _collate(value):
+    # utf8mb4_unicode_ci の近似: 全角半角・大文字小文字を区別しない
+    return unicodedata.normalize("NFKC", value).casefold()
+
+
+class FakeCursor:
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+
+    def _find(self, name, category):
+        for clothing_id, stored_name, stored_category in self.table:
+            if _collate(stored_name) == _collate(name) and _collate(stored_category) == _collate(category):
+                return clothing_id, stored_name, stored_category
+        return None
+
+    def execute(self, sql, params=()):
+        sql = " ".join(sql.split())
+        pairs = [tuple(params[i:i + 2]) for i in range(0, len(params), 2)]
+        if sql.startswith("INSERT INTO clothing_items"):
+            for name, category in pairs:
+                if self._find(name, category) is None:  # ユニークキーに当たれば何もしない
+                    self.table.append((len(self.table) + 1, name, category))
+        elif "IN (" in sql:
+            self.rows = list(dict.fromkeys(row for row in (self._find(*pair) for pair in pairs) if row))
+        elif "LIMIT 1" in sql:
+            row = self._find(*params)
+            self.rows = [(row[0],)] if row else []
+        else:
+            self.rows = list(self.table)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, table):
+        self.table = table
+
+    def cursor(self):
+        return FakeCursor(self.table)
+
+    def commit(self):
+        pass
+
+
+def test_resolve_registers_new_items():
+    table = [(1, "Tシャツ", "tops")]
+    ids = ClothingItemCache().resolve(FakeConnection(table), [("Tシャツ", "tops"), ("ブーツ", "shoes")])
+    assert ids == {("Tシャツ", "tops"): 1, ("ブーツ", "shoes"): 2}
+    assert len(table) == 2
+
+
+def test_resolve_reuses_row_for_case_and_width_variants():
+    table = [(1, "Tシャツ", "tops")]
+    cache = ClothingItemCache()
+    conn = FakeConnection(table)
+    cache.resolve(conn, [("Tシャツ", "tops")])
+
+    ids = cache.resolve(conn, [("tシャツ", "tops"), ("Ｔシャツ", "tops")])
+
+    assert ids == {("tシャツ", "tops"): 1, ("Ｔシャツ", "tops"): 1}
+    assert len(table) == 1  # 別表記で行を増やさない
+    # 次からはリクエストの表記のままキャッシュから引ける
+    assert cache.resolve(conn, [("Ｔシャツ", "tops")]) == {("Ｔシャツ", "tops"): 1}